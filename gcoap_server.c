@@ -13,6 +13,19 @@
 #include "tinydtls_keys.h"
 #include "gcoap_server.h"
 #include "saul.h"
+#include "fmt.h"
+#include "mutex.h"
+#include "nanocbor/nanocbor.h"
+
+#ifndef COAP_FORMAT_SENML_CBOR
+#define COAP_FORMAT_SENML_CBOR (112)
+#endif
+
+/* SenML labels in CBOR (RFC 8428) */
+#define SENML_LABEL_NAME  (0)
+#define SENML_LABEL_UNIT  (1)
+#define SENML_LABEL_VALUE (2)
+#define SENML_LABEL_TIME  (6)
 
 /*
     DTLS credentials data defined here.
@@ -44,13 +57,18 @@ static const credman_credential_t credential = {
 };
 #endif
 
-/* CoAP resources */
+/* CoAP resources, gcoap expects them sorted by path */
 static const coap_resource_t _resources[] = {
-    {"/internal_temp", COAP_GET, _internal_temp_handler, NULL},
     {"/external_temp", COAP_GET, _external_temp_handler, NULL},
     {"/hum", COAP_GET, _external_humid_handler, NULL},
+    {"/internal_temp", COAP_GET, _internal_temp_handler, NULL},
+    {"/snapshot", COAP_GET, _snapshot_handler, NULL},
 };
 
+#define EXTERNAL_TEMP_RESOURCE (&_resources[0])
+#define HUM_RESOURCE           (&_resources[1])
+#define INTERNAL_TEMP_RESOURCE (&_resources[2])
+
 
 static gcoap_listener_t _listener = {
     &_resources[0],
@@ -61,17 +79,61 @@ static gcoap_listener_t _listener = {
     NULL
 };
 
+/* Last values sent to the observers of each resource */
+static char _last_internal_temp[INTERNAL_TEMP_SENSOR_BUF_SIZE];
+static char _last_external_temp[EXTERNAL_TEMP_SENSOR_BUF_SIZE];
+static char _last_hum[EXTERNAL_HUM_SENSOR_BUF_SIZE];
+
+/* Last readings of the notifier thread as numbers, sent by /snapshot */
+typedef struct
+{
+    const char *name;
+    const char *unit;
+    float value;
+    /* Seconds since boot of the reading */
+    uint32_t time;
+    bool valid;
+} reading_t;
+
+static reading_t _readings[] = {
+    {"internal_temp", "Cel", 0, 0, false},
+    {"external_temp", "Cel", 0, 0, false},
+    {"hum", "%RH", 0, 0, false},
+};
+static mutex_t _readings_lock = MUTEX_INIT;
+
+#define INTERNAL_TEMP_READING (&_readings[0])
+#define EXTERNAL_TEMP_READING (&_readings[1])
+#define HUM_READING           (&_readings[2])
+
+static char _notifier_stack[THREAD_STACKSIZE_DEFAULT];
 
 /*
-   Handler function for GET /internal_temp -> returns the internal temperature of the board.
+    Writes a text value as payload of a 2.05 response.
 */
-static ssize_t _internal_temp_handler(coap_pkt_t *pdu, uint8_t *buf, size_t len, coap_request_ctx_t *ctx)
+static ssize_t _text_response(coap_pkt_t *pdu, uint8_t *buf, size_t len, const char *value)
 {
-    (void)ctx;
     gcoap_resp_init(pdu, buf, len, COAP_CODE_CONTENT);
     coap_opt_add_format(pdu, COAP_FORMAT_TEXT);
     size_t resp_len = coap_opt_finish(pdu, COAP_OPT_FINISH_PAYLOAD);
 
+    size_t value_len = strlen(value);
+    if (pdu->payload_len < value_len)
+    {
+        return gcoap_response(pdu, buf, len, COAP_CODE_INTERNAL_SERVER_ERROR);
+    }
+    memcpy(pdu->payload, value, value_len);
+    return resp_len + value_len;
+}
+
+/*
+   Handler function for GET /internal_temp -> returns the internal temperature of the board.
+   A GET with Observe registers the client for notifications.
+*/
+static ssize_t _internal_temp_handler(coap_pkt_t *pdu, uint8_t *buf, size_t len, coap_request_ctx_t *ctx)
+{
+    (void)ctx;
+
     /* Read internal temperature sensor */
     char buffer[INTERNAL_TEMP_SENSOR_BUF_SIZE];
     if (get_temp_sensor_formatted(buffer, INTERNAL_TEMP_SENSOR_BUF_SIZE) != 0)
@@ -81,21 +143,17 @@ static ssize_t _internal_temp_handler(coap_pkt_t *pdu, uint8_t *buf, size_t len,
     else
     {
         printf("Interne Temperatursensor Anfrage ergibt: %s\n", buffer);
-        memcpy((char *)pdu->payload, buffer, INTERNAL_TEMP_SENSOR_BUF_SIZE);
-        resp_len += sizeof(pdu->payload);
-        return resp_len;
+        return _text_response(pdu, buf, len, buffer);
     }
 }
 
 /*
     Handler function for GET /external_temp -> returns the DHT11 temperature.
+    A GET with Observe registers the client for notifications.
 */
 static ssize_t _external_temp_handler(coap_pkt_t *pdu, uint8_t *buf, size_t len, coap_request_ctx_t *ctx)
 {
     (void)ctx;
-    gcoap_resp_init(pdu, buf, len, COAP_CODE_CONTENT);
-    coap_opt_add_format(pdu, COAP_FORMAT_TEXT);
-    size_t resp_len = coap_opt_finish(pdu, COAP_OPT_FINISH_PAYLOAD);
     
     /* Read external temperature sensor */
     char buffer[EXTERNAL_TEMP_SENSOR_BUF_SIZE];
@@ -105,21 +163,17 @@ static ssize_t _external_temp_handler(coap_pkt_t *pdu, uint8_t *buf, size_t len,
     else
     {
         printf("DHT Temperatursensor Anfrage ergibt: %s\n", buffer);
-        memcpy((char *)pdu->payload, buffer, EXTERNAL_TEMP_SENSOR_BUF_SIZE);
-        resp_len += sizeof(pdu->payload);
-        return resp_len;
+        return _text_response(pdu, buf, len, buffer);
     }
 }
 
 /*
     Handler function for GET /hum -> returns the DHT11 humidity.
+    A GET with Observe registers the client for notifications.
 */
 static ssize_t _external_humid_handler(coap_pkt_t *pdu, uint8_t *buf, size_t len, coap_request_ctx_t *ctx)
 {
     (void)ctx;
-    gcoap_resp_init(pdu, buf, len, COAP_CODE_CONTENT);
-    coap_opt_add_format(pdu, COAP_FORMAT_TEXT);
-    size_t resp_len = coap_opt_finish(pdu, COAP_OPT_FINISH_PAYLOAD);
 
     /* Read external humidity sensor */
     char buffer[EXTERNAL_HUM_SENSOR_BUF_SIZE];
@@ -129,12 +183,184 @@ static ssize_t _external_humid_handler(coap_pkt_t *pdu, uint8_t *buf, size_t len
     else
     {
         printf("DHT Humidity-Sensor Anfrage ergibt: %s\n", buffer);
-        memcpy((char *)pdu->payload, buffer, EXTERNAL_TEMP_SENSOR_BUF_SIZE);
-        resp_len += sizeof(pdu->payload);
-        return resp_len;
+        return _text_response(pdu, buf, len, buffer);
     }
 }
 
+/*
+    Stores a reading for /snapshot.
+*/
+static void _store_reading(reading_t *reading, float value)
+{
+    mutex_lock(&_readings_lock);
+    reading->value = value;
+    reading->time = xtimer_now_usec64() / US_PER_SEC;
+    reading->valid = true;
+    mutex_unlock(&_readings_lock);
+}
+
+/*
+    Encodes the stored readings as SenML CBOR array, times relative to now.
+    Returns the length of the payload or -1 if it does not fit.
+*/
+static ssize_t _encode_snapshot(uint8_t *payload, size_t payload_len)
+{
+    uint32_t now = xtimer_now_usec64() / US_PER_SEC;
+    nanocbor_encoder_t enc;
+    nanocbor_encoder_init(&enc, payload, payload_len);
+
+    mutex_lock(&_readings_lock);
+    size_t count = 0;
+    for (size_t i = 0; i < ARRAY_SIZE(_readings); i++)
+    {
+        if (_readings[i].valid)
+        {
+            count++;
+        }
+    }
+    nanocbor_fmt_array(&enc, count);
+    for (size_t i = 0; i < ARRAY_SIZE(_readings); i++)
+    {
+        const reading_t *reading = &_readings[i];
+        if (!reading->valid)
+        {
+            continue;
+        }
+        nanocbor_fmt_map(&enc, 4);
+        nanocbor_fmt_int(&enc, SENML_LABEL_NAME);
+        nanocbor_put_tstr(&enc, reading->name);
+        nanocbor_fmt_int(&enc, SENML_LABEL_UNIT);
+        nanocbor_put_tstr(&enc, reading->unit);
+        nanocbor_fmt_int(&enc, SENML_LABEL_VALUE);
+        nanocbor_fmt_float(&enc, reading->value);
+        /* Negative times are seconds before now */
+        nanocbor_fmt_int(&enc, SENML_LABEL_TIME);
+        nanocbor_fmt_int(&enc, -(int64_t)(now - reading->time));
+    }
+    mutex_unlock(&_readings_lock);
+
+    size_t encoded_len = nanocbor_encoded_len(&enc);
+    if (encoded_len > payload_len)
+    {
+        return -1;
+    }
+    return encoded_len;
+}
+
+/*
+    Handler function for GET /snapshot -> returns the last readings of all sensors
+    as SenML CBOR in one response. Other formats asked for by Accept get 4.06.
+*/
+static ssize_t _snapshot_handler(coap_pkt_t *pdu, uint8_t *buf, size_t len, coap_request_ctx_t *ctx)
+{
+    (void)ctx;
+
+    uint32_t accept;
+    if (coap_opt_get_uint(pdu, COAP_OPT_ACCEPT, &accept) == 0 && accept != COAP_FORMAT_SENML_CBOR)
+    {
+        return gcoap_response(pdu, buf, len, COAP_CODE_NOT_ACCEPTABLE);
+    }
+
+    gcoap_resp_init(pdu, buf, len, COAP_CODE_CONTENT);
+    coap_opt_add_format(pdu, COAP_FORMAT_SENML_CBOR);
+    size_t resp_len = coap_opt_finish(pdu, COAP_OPT_FINISH_PAYLOAD);
+
+    ssize_t payload_len = _encode_snapshot(pdu->payload, pdu->payload_len);
+    if (payload_len < 0)
+    {
+        return gcoap_response(pdu, buf, len, COAP_CODE_INTERNAL_SERVER_ERROR);
+    }
+    return resp_len + payload_len;
+}
+
+/*
+    Sends a notification with the value to all observers of the resource.
+    Nothing is sent if the value did not change, unless force is set.
+*/
+static void _notify(const coap_resource_t *resource, char *last_value, size_t last_value_size,
+                    const char *value, bool force)
+{
+    if (!force && strcmp(last_value, value) == 0)
+    {
+        return;
+    }
+
+    uint8_t buf[CONFIG_GCOAP_PDU_BUF_SIZE];
+    coap_pkt_t pdu;
+    switch (gcoap_obs_init(&pdu, buf, CONFIG_GCOAP_PDU_BUF_SIZE, resource))
+    {
+    case GCOAP_OBS_INIT_OK:
+    {
+        coap_opt_add_format(&pdu, COAP_FORMAT_TEXT);
+        size_t resp_len = coap_opt_finish(&pdu, COAP_OPT_FINISH_PAYLOAD);
+        size_t value_len = strlen(value);
+        if (pdu.payload_len < value_len)
+        {
+            return;
+        }
+        memcpy(pdu.payload, value, value_len);
+        gcoap_obs_send(buf, resp_len + value_len, resource);
+        strncpy(last_value, value, last_value_size - 1);
+        last_value[last_value_size - 1] = '\0';
+        break;
+    }
+    case GCOAP_OBS_INIT_UNUSED:
+        /* Nobody is observing this resource */
+        break;
+    case GCOAP_OBS_INIT_ERR:
+        printf("GCoAP: cannot create notification for %s\n", resource->path);
+        break;
+    }
+}
+
+/*
+    Reads all sensors periodically and notifies the observers about changed values.
+    Every OBSERVE_HEARTBEAT_INTERVAL the values are sent even if they did not change,
+    so clients can tell a quiet sensor from a rebooted device.
+*/
+static void *_notifier_thread(void *arg)
+{
+    (void)arg;
+    unsigned elapsed = 0;
+
+    while (1)
+    {
+        xtimer_sleep(OBSERVE_INTERVAL);
+        elapsed += OBSERVE_INTERVAL;
+        bool heartbeat = elapsed >= OBSERVE_HEARTBEAT_INTERVAL;
+        if (heartbeat)
+        {
+            elapsed = 0;
+        }
+
+        char internal_temp[INTERNAL_TEMP_SENSOR_BUF_SIZE];
+        phydat_t result;
+        if (get_temp_sensor_raw(&result) == 0)
+        {
+            phydat_to_buffer(&result, 1, internal_temp, INTERNAL_TEMP_SENSOR_BUF_SIZE);
+            _store_reading(INTERNAL_TEMP_READING, result.val[0] * powf(10, result.scale));
+            _notify(INTERNAL_TEMP_RESOURCE, _last_internal_temp, sizeof(_last_internal_temp),
+                    internal_temp, heartbeat);
+        }
+
+        /* One DHT11 read delivers both temperature and humidity */
+        char external_temp[EXTERNAL_TEMP_SENSOR_BUF_SIZE];
+        char hum[EXTERNAL_HUM_SENSOR_BUF_SIZE];
+        int16_t raw_temp, raw_hum;
+        if (read_dht_sensor_raw(&raw_temp, &raw_hum) == 0)
+        {
+            external_temp[fmt_s16_dfp(external_temp, raw_temp, -1)] = '\0';
+            hum[fmt_s16_dfp(hum, raw_hum, -1)] = '\0';
+            _store_reading(EXTERNAL_TEMP_READING, raw_temp / 10.0f);
+            _store_reading(HUM_READING, raw_hum / 10.0f);
+            _notify(EXTERNAL_TEMP_RESOURCE, _last_external_temp, sizeof(_last_external_temp),
+                    external_temp, heartbeat);
+            _notify(HUM_RESOURCE, _last_hum, sizeof(_last_hum), hum, heartbeat);
+        }
+    }
+    return NULL;
+}
+
 /* 
      Server initialization, called exactly once at startup
 */
@@ -157,4 +383,7 @@ void server_init(void)
 #endif
 
     gcoap_register_listener(&_listener);
+
+    thread_create(_notifier_stack, sizeof(_notifier_stack), THREAD_PRIORITY_MAIN - 1,
+                  THREAD_CREATE_STACKTEST, _notifier_thread, NULL, "coap_notifier");
 }
@@ -8,9 +8,18 @@
 * @}
 */
 
+#include <stdbool.h>
 #include <stdio.h>
+#include <math.h>
 #include <string.h>
 #include "net/gcoap.h"
+#include "thread.h"
+#include "xtimer.h"
+
+/* Seconds between two sensor reads of the notifier thread */
+#define OBSERVE_INTERVAL (10)
+/* Seconds after which observers are notified even if the values did not change */
+#define OBSERVE_HEARTBEAT_INTERVAL (60)
 
 /* 
     Server initialization, is called exactly once at startup.
@@ -19,16 +28,29 @@ void server_init(void);
 
 /*
     Handler function for GET /internal_temp -> returns the internal temperature of the board.
+    A GET with Observe registers the client for notifications.
 */
 static ssize_t _internal_temp_handler(coap_pkt_t *pdu, uint8_t *buf, size_t len, coap_request_ctx_t *ctx);
 
 
 /*
     Handler function for GET /external_temp -> returns the DHT11 temperature.
+    A GET with Observe registers the client for notifications.
 */
 static ssize_t _external_temp_handler(coap_pkt_t *pdu, uint8_t *buf, size_t len, coap_request_ctx_t *ctx);
 
 /*
     Handler function for GET /hum -> returns the DHT11 humidity.
+    A GET with Observe registers the client for notifications.
 */
 static ssize_t _external_humid_handler(coap_pkt_t *pdu, uint8_t *buf, size_t len, coap_request_ctx_t *ctx);
+
+/*
+    Handler function for GET /snapshot -> returns the last readings of all sensors as SenML CBOR.
+*/
+static ssize_t _snapshot_handler(coap_pkt_t *pdu, uint8_t *buf, size_t len, coap_request_ctx_t *ctx);
+
+/*
+    Thread that notifies the observers of all resources about new sensor values.
+*/
+static void *_notifier_thread(void *arg);
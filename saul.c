@@ -20,7 +20,28 @@
 #include "dht.h"
 #include "fmt.h"
 #include "xtimer.h"
+#include "mutex.h"
 
+/* The DHT11 is read by the CoAP handlers and the notifier thread */
+static mutex_t _dht_lock = MUTEX_INIT;
+
+
+/*
+    Finds the temperature sensor and reads it
+*/
+int8_t get_temp_sensor_raw(phydat_t *result)
+{
+    saul_reg_t *tmp = saul_reg_find_type(SAUL_SENSE_TEMP);
+    if (tmp == NULL)
+    {
+        return -2;
+    }
+    if (saul_reg_read(tmp, result) < 0)
+    {
+        return -3;
+    }
+    return 0;
+}
 
 /*
     Finds the temperature sensor, reads it and formats the result
@@ -32,21 +53,14 @@ int8_t get_temp_sensor_formatted(char *buffer, size_t buf_size)
         return -1;
     }
 
-    saul_reg_t *tmp = saul_reg_find_type(SAUL_SENSE_TEMP);
-    if (tmp == NULL)
+    phydat_t result;
+    int8_t res = get_temp_sensor_raw(&result);
+    if (res != 0)
     {
-        return -2;
-    }
-    else
-    {
-        phydat_t result;
-        if (saul_reg_read(tmp, &result) < 0)
-        {
-            return -3;
-        }
-        phydat_to_buffer(&result, 1, buffer, buf_size);
-        return 0;
+        return res;
     }
+    phydat_to_buffer(&result, 1, buffer, buf_size);
+    return 0;
 }
 
 /*
@@ -99,9 +113,9 @@ void phydat_to_buffer(phydat_t *data, uint8_t dim, char *buffer, size_t buf_size
 }
 
 /*
-    Reads the DHT11 sensor and formats the values into a readable format
+    Reads the DHT11 sensor, temperature and humidity are in tenths of °C and %
 */
-int8_t read_dht_sensor(char *temp_fmt, char *hum_fmt)
+int8_t read_dht_sensor_raw(int16_t *temp, int16_t *hum)
 {
     dht_t dev;
     static const dht_params_t dht_params = {
@@ -109,9 +123,11 @@ int8_t read_dht_sensor(char *temp_fmt, char *hum_fmt)
         .pin = GPIO_PIN(0, 31)
     };
 
+    mutex_lock(&_dht_lock);
     if (dht_init(&dev, &dht_params) != DHT_OK)
     {
         printf("Error initializing DHT11 sensor.\n");
+        mutex_unlock(&_dht_lock);
         return -1;
     }
     else
@@ -119,24 +135,35 @@ int8_t read_dht_sensor(char *temp_fmt, char *hum_fmt)
         printf("DHT Init was successfull!\n");
     }
 
+    int8_t res = -1;
+    xtimer_usleep(1000000);
+    if (dht_read(&dev, temp, hum) == DHT_OK)
+    {
+        res = 0;
+    }
+    else
+    {
+        printf("Failed to read data from DHT11 sensor!\n");
+    }
+    mutex_unlock(&_dht_lock);
+    return res;
+}
+
+/*
+    Reads the DHT11 sensor and formats the values into a readable format
+*/
+int8_t read_dht_sensor(char *temp_fmt, char *hum_fmt)
+{
     int16_t temp, hum;
-    while (1)
+    if (read_dht_sensor_raw(&temp, &hum) != 0)
     {
-        xtimer_usleep(1000000);
-        if (dht_read(&dev, &temp, &hum) == DHT_OK)
-        {            
-            size_t fmt_length = fmt_s16_dfp(temp_fmt, temp, -1);
-            temp_fmt[fmt_length] = '\0';
-            fmt_length = fmt_s16_dfp(hum_fmt, hum, -1);
-            hum_fmt[fmt_length] = '\0';
-            return 0;
-        }
-        else
-        {
-            printf("Failed to read data from DHT11 sensor!\n");
-            return -1;
-        }
+        return -1;
     }
+    size_t fmt_length = fmt_s16_dfp(temp_fmt, temp, -1);
+    temp_fmt[fmt_length] = '\0';
+    fmt_length = fmt_s16_dfp(hum_fmt, hum, -1);
+    hum_fmt[fmt_length] = '\0';
+    return 0;
 }
 
 /*
@@ -24,11 +24,21 @@ void print_temp_sensor(void);
 */
 void phydat_to_buffer(phydat_t *data, uint8_t dim, char *buffer, size_t buf_size);
 
+/*
+    Reads the temperature sensor without formatting
+*/
+int8_t get_temp_sensor_raw(phydat_t *result);
+
 /*
     Reads temperature sensor and writes formatted values into a buffer
 */
 int8_t get_temp_sensor_formatted(char* buffer, size_t buf_size);
 
+/*
+    Reads the DHT11 sensor, values are in tenths of °C and %
+*/
+int8_t read_dht_sensor_raw(int16_t *temp, int16_t *hum);
+
 /*
     Reads the DHT11 sensor
 */
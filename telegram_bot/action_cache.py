@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+from pathlib import Path
+from intent_classifier import normalize_text
+from settings_handler import write_json_atomic
+from shared_state import shared_state
+
+# Maximum number of prompts kept in the cache
+ACTION_CACHE_SIZE = int(os.environ.get("ACTION_CACHE_SIZE", 1024))
+# Seconds a classification stays valid
+ACTION_CACHE_TTL = float(os.environ.get("ACTION_CACHE_TTL", 24 * 60 * 60))
+# Optional file to keep the cache across restarts
+ACTION_CACHE_FILE = os.environ.get("ACTION_CACHE_FILE")
+
+def make_fingerprint(model, system_description):
+    """Identifies the model and prompt a classification was made with."""
+    return hashlib.sha256(f"{model}\n{system_description}".encode("utf-8")).hexdigest()
+
+class ActionCache:
+    """Bounded LRU cache of LLM classifications, keyed by the normalized prompt.
+
+    Entries expire after ttl seconds and are all dropped when the fingerprint
+    (model name and system prompt) changes. With several workers a miss is
+    looked up in the shared state, where every classification is stored too.
+    """
+    def __init__(self, fingerprint, max_size=ACTION_CACHE_SIZE, ttl=ACTION_CACHE_TTL, filepath=ACTION_CACHE_FILE, shared=shared_state):
+        self.fingerprint = fingerprint
+        self.shared = shared
+        self.max_size = max_size
+        self.ttl = ttl
+        self.filepath = Path(filepath) if filepath else None
+        # Format: {normalized prompt: (action data, timestamp)}
+        self.entries = OrderedDict()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "invalidations": 0,
+            "shared_hits": 0
+        }
+        self.load()
+
+    def set_fingerprint(self, fingerprint):
+        if fingerprint != self.fingerprint:
+            self.fingerprint = fingerprint
+            self.entries.clear()
+            self.stats["invalidations"] += 1
+            if self.shared is not None:
+                self.shared.submit(self.shared.drop_actions, fingerprint).add_done_callback(self._shared)
+
+    async def get(self, prompt):
+        key = normalize_text(prompt)
+        entry = self.entries.get(key)
+        if entry is None or time.time() - entry[1] > self.ttl:
+            if entry is not None:
+                del self.entries[key]
+            entry = await self._get_shared(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["shared_hits"] += 1
+            self.entries[key] = entry
+            self._trim()
+            return entry[0]
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry[0]
+
+    async def _get_shared(self, key):
+        """Returns (action data, timestamp) another worker stored, or None."""
+        if self.shared is None or not key:
+            return None
+        try:
+            entry = await self.shared.run(self.shared.get_action, key, self.fingerprint)
+        except Exception as e:
+            print(f"Action cache: Could not read the shared cache: {e}")
+            return None
+        if entry is None or time.time() - entry[1] > self.ttl:
+            return None
+        return entry
+
+    def put(self, prompt, action_data):
+        key = normalize_text(prompt)
+        if not key:
+            return
+        now = time.time()
+        self.entries[key] = (action_data, now)
+        if self.shared is not None:
+            future = self.shared.submit(self.shared.put_action, key, self.fingerprint, action_data, now, expired=now - self.ttl)
+            future.add_done_callback(self._shared)
+        self.entries.move_to_end(key)
+        self._trim()
+
+    def _shared(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            print(f"Action cache: Could not update the shared cache: {future.exception()}")
+
+    def _trim(self):
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def load(self):
+        if self.filepath is None or not self.filepath.exists():
+            return
+        try:
+            with self.filepath.open("r", encoding="utf-8") as file:
+                data = json.load(file)
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"Action cache: Could not load {self.filepath}: {e}")
+            return
+        if data.get("fingerprint") != self.fingerprint:
+            print("Action cache: Model or system prompt changed, discarding the stored cache")
+            return
+        now = time.time()
+        for key, action_data, timestamp in data.get("entries", [])[-self.max_size:]:
+            if now - timestamp <= self.ttl:
+                self.entries[key] = (action_data, timestamp)
+
+    def save(self):
+        if self.filepath is None:
+            return
+        write_json_atomic(self.filepath, {
+            "fingerprint": self.fingerprint,
+            "entries": [[key, action_data, timestamp] for key, (action_data, timestamp) in self.entries.items()]
+        })
+
+    def memory_usage(self):
+        """Approximate size of the entries in bytes."""
+        size = sys.getsizeof(self.entries)
+        for key, (action_data, _) in self.entries.items():
+            size += sys.getsizeof(key) + sys.getsizeof(action_data)
+            size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in action_data.items())
+        return size
+
+    def get_stats(self):
+        lookups = self.stats["hits"] + self.stats["misses"] + self.stats["shared_hits"]
+        return {
+            **self.stats,
+            "size": len(self.entries),
+            "hit_rate": (self.stats["hits"] + self.stats["shared_hits"]) / lookups if lookups else 0.0,
+            "memory_bytes": self.memory_usage()
+        }
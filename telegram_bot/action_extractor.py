@@ -0,0 +1,72 @@
+import json
+import re
+
+class ActionExtractor:
+    """Incremental parser of the JSON answer the LLM streams token by token.
+
+    feed() returns the action data as soon as a complete action name of the
+    function registry was emitted, or once the JSON object is complete if
+    the parameters are needed as well or the answer is a list of actions.
+    Until then it returns None.
+    """
+    ACTION_PATTERN = re.compile(r'"action"\s*:\s*"([^"\\]*)"')
+    ACTIONS_KEY = '"actions"'
+
+    def __init__(self, known_actions, wait_for_parameters=False):
+        self.known_actions = known_actions
+        self.wait_for_parameters = wait_for_parameters
+        self.text = ""
+        self.action = None
+        # Position in the JSON text, strings are skipped when counting braces
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.end = None
+
+    def _scan(self, chunk, offset):
+        for i, char in enumerate(chunk):
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char == "{":
+                self.depth += 1
+            elif char == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.end = offset + i + 1
+                    return
+
+    def feed(self, chunk):
+        if self.end is not None:
+            return self.result()
+        offset = len(self.text)
+        self.text += chunk
+        self._scan(chunk, offset)
+        if self.end is not None:
+            return self.result()
+        if self.action is None and not self.wait_for_parameters and self.ACTIONS_KEY in self.text:
+            # Several actions, the first one is not the whole answer
+            self.wait_for_parameters = True
+        if self.action is None:
+            match = self.ACTION_PATTERN.search(self.text)
+            if match is not None and match.group(1) in self.known_actions:
+                self.action = match.group(1)
+        if self.action is not None and not self.wait_for_parameters:
+            return {"action": self.action}
+        return None
+
+    def result(self):
+        """Returns the action data of everything fed so far, also for an incomplete answer."""
+        try:
+            data = json.loads(self.text[:self.end] if self.end is not None else self.text)
+            if isinstance(data, dict):
+                return data
+        except json.JSONDecodeError:
+            pass
+        return {"action": self.action or "unknown", "parameters": {}}
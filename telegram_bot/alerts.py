@@ -0,0 +1,432 @@
+import asyncio
+import os
+from bisect import bisect_left, bisect_right
+from collections import deque
+from device_registry import device_registry
+from sensor_cache import sensor_cache
+from settings_handler import Settings
+from workers import owns
+
+# Alerts one user may have
+ALERT_MAX_RULES = int(os.environ.get("ALERT_MAX_RULES", 10))
+# Seconds notifications are collected before they are sent, one message per user
+ALERT_BATCH_INTERVAL = float(os.environ.get("ALERT_BATCH_INTERVAL", 5))
+# Seconds between two readings of the sensors with alerts if nobody else reads them
+ALERT_SAMPLE_INTERVAL = float(os.environ.get("ALERT_SAMPLE_INTERVAL", 60))
+# How far a value has to move back past the threshold before an alert is over,
+# so a value wobbling around the threshold does not notify again and again
+ALERT_HYSTERESIS = {
+    "internal_temp": 0.5,
+    "external_temp": 0.5,
+    "hum": 2.0
+}
+# Hysteresis of other resources and of rates, relative to the threshold
+RELATIVE_HYSTERESIS = 0.05
+# Rates of change are measured over the readings of the last hour
+RATE_WINDOW = 60 * 60
+# Readings have to span at least this many seconds before a rate is known
+RATE_MIN_SPAN = 5 * 60
+OPERATORS = ("<", ">")
+
+class AlertRule:
+    """One alert of a user, e.g. external_temp < 3 or hum > 70 for 10 minutes.
+
+    kind "value" compares the reading, kind "rate" its change per hour.
+    """
+    __slots__ = ("user_id", "id", "device", "resource", "kind", "op", "threshold", "duration", "hysteresis", "state", "since")
+
+    def __init__(self, user_id, id, device, resource, kind, op, threshold, duration=0):
+        self.user_id = user_id
+        self.id = id
+        self.device = device
+        self.resource = resource
+        self.kind = kind
+        self.op = op
+        self.threshold = threshold
+        # Seconds the condition has to hold before the alert fires
+        self.duration = duration
+        if kind == "value" and resource in ALERT_HYSTERESIS:
+            self.hysteresis = ALERT_HYSTERESIS[resource]
+        else:
+            self.hysteresis = abs(threshold) * RELATIVE_HYSTERESIS
+        # "clear", "pending" (condition holds, waiting for the duration) or "firing"
+        self.state = "clear"
+        # time.time() when the condition started to hold
+        self.since = None
+
+    @classmethod
+    def from_dict(cls, user_id, data):
+        return cls(user_id, data["id"], data["device"], data["resource"], data["kind"], data["op"], data["threshold"], data.get("duration", 0))
+
+    def to_dict(self):
+        return {"id": self.id, "device": self.device, "resource": self.resource, "kind": self.kind,
+                "op": self.op, "threshold": self.threshold, "duration": self.duration}
+
+    def condition(self, value):
+        return value > self.threshold if self.op == ">" else value < self.threshold
+
+    def recovered(self, value):
+        """True once the value is back past the threshold by the hysteresis."""
+        if self.op == ">":
+            return value < self.threshold - self.hysteresis
+        return value > self.threshold + self.hysteresis
+
+class RuleIndex:
+    """Rules on one series (the readings or the rates of a resource) sorted by threshold.
+
+    A rule can only change its state if its threshold lies between the
+    previous and the new value, widened by the hysteresis. Those rules are
+    found by bisection, all others are left alone. Rules waiting for their
+    duration or not evaluated yet are watched on every sample.
+    """
+    def __init__(self):
+        self.thresholds = []
+        self.rules = []
+        self.max_hysteresis = 0.0
+        self.previous = None
+        self.watched = set()
+
+    def __len__(self):
+        return len(self.rules)
+
+    def add(self, rule):
+        i = bisect_right(self.thresholds, rule.threshold)
+        self.thresholds.insert(i, rule.threshold)
+        self.rules.insert(i, rule)
+        self.max_hysteresis = max(self.max_hysteresis, rule.hysteresis)
+        self.watched.add(rule)
+
+    def remove(self, rule):
+        i = self.rules.index(rule)
+        del self.thresholds[i]
+        del self.rules[i]
+        self.watched.discard(rule)
+        self.max_hysteresis = max((rule.hysteresis for rule in self.rules), default=0.0)
+
+    def candidates(self, value):
+        if self.previous is None:
+            return set(self.rules)
+        low = min(self.previous, value) - self.max_hysteresis
+        high = max(self.previous, value) + self.max_hysteresis
+        return set(self.rules[bisect_left(self.thresholds, low):bisect_right(self.thresholds, high)]) | self.watched
+
+    def evaluate(self, value, timestamp):
+        """Returns the rules that fired, the rules that recovered and how many rules were looked at."""
+        fired, recovered = [], []
+        candidates = self.candidates(value)
+        for rule in candidates:
+            holds = rule.condition(value)
+            if rule.state == "firing":
+                if rule.recovered(value):
+                    rule.state = "clear"
+                    rule.since = None
+                    recovered.append(rule)
+            elif not holds:
+                rule.state = "clear"
+                rule.since = None
+                self.watched.discard(rule)
+            else:
+                if rule.since is None:
+                    rule.since = timestamp
+                if timestamp - rule.since >= rule.duration:
+                    rule.state = "firing"
+                    fired.append(rule)
+                    self.watched.discard(rule)
+                else:
+                    rule.state = "pending"
+                    self.watched.add(rule)
+        self.previous = value
+        return fired, recovered, len(candidates)
+
+class AlertEngine:
+    """Evaluates the alerts of all users as readings arrive in the sensor cache.
+
+    Rules are indexed by device and resource, a reading only touches the
+    rules whose state can change. Notifications are collected per user and
+    sent in one message every ALERT_BATCH_INTERVAL; an alert notifies once
+    when it fires and once when the value is back past the hysteresis.
+    The rules are stored with the user settings under "alerts". With several
+    workers every one knows the rules of all users, as a command may come
+    from a group chat another worker handles, but only evaluates those of
+    the users it owns. Rules changed by another worker are taken over when
+    the settings are read again.
+    """
+    def __init__(self, cache=sensor_cache, settings=None, registry=device_registry, batch_interval=ALERT_BATCH_INTERVAL, sample_interval=ALERT_SAMPLE_INTERVAL, owns=owns):
+        self.cache = cache
+        self.owns = owns
+        self.settings = settings or Settings()
+        self.registry = registry
+        self.batch_interval = batch_interval
+        self.sample_interval = sample_interval
+        # Format: {(device, resource, kind): RuleIndex}
+        self.indexes = {}
+        # Format: {user_id: [AlertRule]}
+        self.rules = {}
+        # Readings of resources with rate rules
+        # Format: {(device, resource): deque([(timestamp, value)])}
+        self.readings = {}
+        # Notifications not sent yet, the newest event per rule
+        # Format: {user_id: {rule id: (event, rule, value)}}
+        self.outbox = {}
+        # Sends a text to a user, set by the bot
+        self.send = None
+        # Formats (user_id, resource, value) in the unit of the user, set by the bot
+        self.format_value = lambda user_id, resource, value: f"{value:g}"
+        self._tasks = []
+        self.stats = {
+            "samples": 0,
+            "evaluated": 0,
+            "fired": 0,
+            "recovered": 0,
+            "messages": 0,
+            "send_errors": 0
+        }
+
+    def load(self):
+        """Builds the indexes from the rules in the user settings."""
+        self.indexes.clear()
+        self.rules.clear()
+        self.sync()
+
+    def sync(self):
+        """Takes over the rules that changed in the user settings, unchanged rules keep their state."""
+        user_settings = self.settings.user_settings
+        for user_id in set(self.rules) | set(user_settings):
+            data = user_settings.get(user_id, {}).get("alerts", [])
+            rules = self.rules.pop(user_id, [])
+            if [rule.to_dict() for rule in rules] == data:
+                self.rules[user_id] = rules
+                continue
+            previous = {rule.id: rule for rule in rules}
+            for rule in rules:
+                self._unindex(rule)
+            for item in data:
+                try:
+                    rule = previous.get(item["id"])
+                    if rule is not None and rule.to_dict() == item:
+                        del previous[rule.id]
+                    else:
+                        rule = AlertRule.from_dict(user_id, item)
+                    self._index(rule)
+                except (KeyError, TypeError) as e:
+                    print(f"Alerts: Skipping invalid alert of {user_id}: {e}")
+            for rule in previous.values():
+                self.outbox.get(user_id, {}).pop(rule.id, None)
+
+    def _index(self, rule):
+        self.rules.setdefault(rule.user_id, []).append(rule)
+        if not self.owns(rule.user_id):
+            return
+        key = (rule.device, rule.resource, rule.kind)
+        if key not in self.indexes:
+            self.indexes[key] = RuleIndex()
+        self.indexes[key].add(rule)
+
+    def _unindex(self, rule):
+        key = (rule.device, rule.resource, rule.kind)
+        index = self.indexes.get(key)
+        if index is not None and rule in index.rules:
+            index.remove(rule)
+            if not index:
+                del self.indexes[key]
+
+    def _save(self, user_id):
+        self.settings.set_user_setting(user_id, "alerts", [rule.to_dict() for rule in self.rules.get(user_id, [])])
+
+    def get_rules(self, user_id):
+        return list(self.rules.get(str(user_id), []))
+
+    def add_rule(self, user_id, resource, op, threshold, kind="value", duration=0, device=None):
+        """Adds an alert of the user and returns it, raises ValueError if the user has too many."""
+        user_id = str(user_id)
+        if op not in OPERATORS:
+            raise ValueError(f"Unknown operator: {op}")
+        rules = self.rules.get(user_id, [])
+        if len(rules) >= ALERT_MAX_RULES:
+            raise ValueError(f"At most {ALERT_MAX_RULES} alerts per user")
+        rule_id = max((rule.id for rule in rules), default=0) + 1
+        rule = AlertRule(user_id, rule_id, self.registry.get(device).name, resource, kind, op, float(threshold), duration)
+        self._index(rule)
+        self._save(user_id)
+        return rule
+
+    def remove_rule(self, user_id, rule_id=None):
+        """Removes one alert of the user, all of them without rule_id. Returns the number removed."""
+        user_id = str(user_id)
+        rules = self.rules.get(user_id, [])
+        removed = [rule for rule in rules if rule_id is None or rule.id == rule_id]
+        for rule in removed:
+            rules.remove(rule)
+            self._unindex(rule)
+            self.outbox.get(user_id, {}).pop(rule.id, None)
+        if removed:
+            self._save(user_id)
+        return len(removed)
+
+    def _rate(self, device, resource, value, timestamp):
+        """Returns the change per hour over the readings of the last RATE_WINDOW, None if they are too few."""
+        readings = self.readings.get((device, resource))
+        if readings is None:
+            readings = self.readings[(device, resource)] = deque()
+        readings.append((timestamp, value))
+        while readings and readings[0][0] < timestamp - RATE_WINDOW:
+            readings.popleft()
+        oldest_timestamp, oldest_value = readings[0]
+        if timestamp - oldest_timestamp < RATE_MIN_SPAN:
+            return None
+        return (value - oldest_value) / (timestamp - oldest_timestamp) * 60 * 60
+
+    def record(self, resource, value, timestamp, device=None):
+        """Listener of the sensor cache, evaluates the rules of the reading."""
+        device = device or self.registry.default().name
+        values = {"value": value}
+        if (device, resource, "rate") in self.indexes:
+            values["rate"] = self._rate(device, resource, value, timestamp)
+        events = []
+        for kind, series_value in values.items():
+            index = self.indexes.get((device, resource, kind))
+            if index is None or series_value is None:
+                continue
+            fired, recovered, evaluated = index.evaluate(series_value, timestamp)
+            self.stats["evaluated"] += evaluated
+            events.extend(("fired", rule, series_value) for rule in fired)
+            events.extend(("recovered", rule, series_value) for rule in recovered)
+        self.stats["samples"] += 1
+        for event, rule, series_value in events:
+            self.stats[event] += 1
+            self._queue(event, rule, series_value)
+
+    def _queue(self, event, rule, value):
+        pending = self.outbox.setdefault(rule.user_id, {})
+        previous = pending.get(rule.id)
+        if event == "recovered" and previous is not None and previous[0] == "fired":
+            # Fired and recovered before the user was told, nothing to tell
+            del pending[rule.id]
+            return
+        pending[rule.id] = (event, rule, value)
+
+    def describe(self, rule, language):
+        """Text of the rule in the language and unit of the user."""
+        sensor = self.settings.get_translation(language, rule.resource, default=rule.resource)
+        if rule.kind == "rate":
+            text = self.settings.get_translation(language, "alert_rule_rate", sensor=sensor, op=rule.op,
+                threshold=self.format_rate(rule.user_id, rule.resource, rule.threshold))
+        else:
+            text = self.settings.get_translation(language, "alert_rule_value", sensor=sensor, op=rule.op,
+                threshold=self.format_value(rule.user_id, rule.resource, rule.threshold))
+        if rule.duration:
+            text = self.settings.get_translation(language, "alert_rule_duration", rule=text, minutes=f"{rule.duration / 60:g}")
+        if len(self.registry) > 1:
+            text = f"{self.registry.get(rule.device).friendly_name}: {text}"
+        return text
+
+    def format_rate(self, user_id, resource, rate):
+        # A change in Celsius is 9/5 of the change in Fahrenheit, without the offset
+        if "temp" in resource and self.settings.get_locale(user_id).temp_unit.lower() == "f":
+            return f"{round(rate * 9 / 5, 2):g} °F/h"
+        if "temp" in resource:
+            return f"{round(rate, 2):g} °C/h"
+        if resource == "hum":
+            return f"{round(rate, 2):g} %/h"
+        return f"{round(rate, 2):g}/h"
+
+    def render(self, user_id, events):
+        locale = self.settings.get_locale(user_id)
+        lines = []
+        for event, rule, value in events:
+            if rule.kind == "rate":
+                current = self.format_rate(user_id, rule.resource, value)
+            else:
+                current = self.format_value(user_id, rule.resource, round(value, 2))
+            key = "alert_triggered" if event == "fired" else "alert_recovered"
+            lines.append(locale.translate(key, rule=self.describe(rule, locale.language), value=current))
+        return "\n".join(lines)
+
+    async def flush(self):
+        """Sends every user one message with all of their notifications since the last flush."""
+        outbox, self.outbox = self.outbox, {}
+        for user_id, pending in outbox.items():
+            if not pending or self.send is None:
+                continue
+            try:
+                await self.send(user_id, self.render(user_id, pending.values()))
+                self.stats["messages"] += 1
+            except Exception as e:
+                self.stats["send_errors"] += 1
+                print(f"Alerts: Could not notify {user_id}: {e}")
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.batch_interval)
+            # Picks up rules other workers changed, sync() is called if they did
+            self.settings.refresh_user_settings()
+            await self.flush()
+
+    async def _sample(self):
+        while True:
+            for device, resource in {(device, resource) for device, resource, _ in self.indexes}:
+                try:
+                    # Answered from the cache if fresh, new readings reach record()
+                    await self.cache.get(resource, device)
+                except Exception as e:
+                    print(f"Alerts: Could not read {device}/{resource}: {e}")
+            await asyncio.sleep(self.sample_interval)
+
+    def start(self, send, format_value=None):
+        self.send = send
+        if format_value is not None:
+            self.format_value = format_value
+        self.load()
+        self.settings.add_listener(self.sync)
+        self.cache.add_listener(self.record)
+        self._tasks = [
+            asyncio.create_task(self._flush_periodically()),
+            asyncio.create_task(self._sample())
+        ]
+
+    async def stop(self):
+        self.settings.remove_listener(self.sync)
+        self.cache.remove_listener(self.record)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
+
+    def get_stats(self):
+        return {
+            **self.stats,
+            "rules": sum(len(index) for index in self.indexes.values()),
+            "indexes": len(self.indexes),
+            "queued": sum(len(pending) for pending in self.outbox.values())
+        }
+
+def parse_rule(args, resources):
+    """Parses '<sensor> [rate] <op> <value> [for <minutes>]' into a dict for add_rule, raises ValueError."""
+    args = [arg.lower() for arg in args]
+    if len(args) >= 2 and args[1][:1] in OPERATORS and len(args[1]) > 1:
+        # Operator and value written together, e.g. <3
+        args[1:2] = [args[1][0], args[1][1:]]
+    if len(args) < 3 or args[0] not in resources:
+        raise ValueError("Invalid alert")
+    rule = {"resource": resources[args[0]], "kind": "value", "duration": 0}
+    rest = args[1:]
+    if rest[0] == "rate":
+        rule["kind"] = "rate"
+        rest = rest[1:]
+    if len(rest) < 2 or rest[0] not in OPERATORS:
+        raise ValueError("Invalid alert")
+    rule["op"] = rest[0]
+    rule["threshold"] = float(rest[1].replace(",", "."))
+    rest = rest[2:]
+    if rest:
+        if rest[0] != "for" or len(rest) != 2 or rule["kind"] == "rate":
+            raise ValueError("Invalid alert")
+        minutes = float(rest[1].rstrip("min").replace(",", "."))
+        if minutes <= 0:
+            raise ValueError("Invalid alert")
+        rule["duration"] = minutes * 60
+    return rule
+
+# Alerts shared by the whole bot
+alert_engine = AlertEngine()
@@ -0,0 +1,598 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiocoap
+import aiocoap.credentials
+import aiocoap.resource as resource
+from aiocoap.defaults import dtls_missing_modules
+from telegram import Update
+from telegram.request import BaseRequest
+
+from device_registry import Device, device_registry
+from http_server import HttpServer
+import sensor_cache as sensor_cache_module
+from sensor_cache import sensor_cache
+from client import coap
+import telegram_bot
+from telegram_bot import build_application
+from prompt_processor import Prompt_Processor
+from metrics import metrics
+from senml import encode_senml, SENML_CBOR, SENML_JSON
+from workers import shard
+from send_queue import SendQueue
+from localization import localization
+
+script_dir = Path(__file__).parent
+PHRASES_FILE = script_dir / "intent_phrases.json"
+
+BENCH_HOST = "::1"
+BENCH_USER_ID = 100000
+BENCH_PSK_IDENTITY = b"bench_identity"
+BENCH_PSK_KEY = b"bench_key"
+
+# Payloads like the ones of gcoap_server.c
+SENSOR_PAYLOADS = {
+    "internal_temp": lambda: f"{random.uniform(20, 25):.2f} °C",
+    "external_temp": lambda: f"{random.uniform(5, 15):.1f}",
+    "hum": lambda: f"{random.uniform(30, 60):.1f}"
+}
+# SenML units of the snapshot resource
+SENSOR_UNITS = {
+    "internal_temp": "Cel",
+    "external_temp": "Cel",
+    "hum": "%RH"
+}
+# Commands measured one by one
+BENCH_COMMANDS = ["/internal_temp", "/external_temp", "/humidity", "/help", "/history"]
+# Translations that mean the user did not get the answer asked for
+FAILURE_KEYS = ["llm_busy", "llm_rate_limited", "timeout_error", "unknown_error", "network_error",
+                "connection_failed", "coap_credentials_error", "no_data", "device_error", "device_timeout", "not_authenticated"]
+
+def _free_udp_port(host):
+    with socket.socket(socket.AF_INET6, socket.SOCK_DGRAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+class SensorResource(resource.Resource):
+    def __init__(self, name, latency):
+        super().__init__()
+        self.name = name
+        self.latency = latency
+
+    async def render_get(self, request):
+        # Reading the sensor
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return aiocoap.Message(payload=SENSOR_PAYLOADS[self.name]().encode("utf-8"))
+
+class SnapshotResource(resource.Resource):
+    """All readings as SenML like /snapshot of gcoap_server.c, which also answers SenML JSON."""
+    def __init__(self, latency):
+        super().__init__()
+        self.latency = latency
+
+    async def render_get(self, request):
+        content_format = request.opt.accept if request.opt.accept is not None else SENML_CBOR
+        if content_format not in (SENML_CBOR, SENML_JSON):
+            return aiocoap.Message(code=aiocoap.NOT_ACCEPTABLE)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        now = time.time()
+        readings = {name: (float(payload().split()[0]), now, SENSOR_UNITS.get(name)) for name, payload in SENSOR_PAYLOADS.items()}
+        return aiocoap.Message(payload=encode_senml(readings, content_format, now), content_format=content_format)
+
+class _Upstream(asyncio.DatagramProtocol):
+    def __init__(self, proxy, client_address):
+        self.proxy = proxy
+        self.client_address = client_address
+
+    def datagram_received(self, data, address):
+        self.proxy.forward(data, self.client_address)
+
+class LossyProxy(asyncio.DatagramProtocol):
+    """UDP proxy in front of the fake device dropping datagrams in both directions."""
+    def __init__(self, target, loss):
+        self.target = target
+        self.loss = loss
+        self.transport = None
+        # Format: {client address: Future of the transport to the device}
+        self.upstreams = {}
+        self.dropped = 0
+        self.forwarded = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def _lost(self):
+        if random.random() < self.loss:
+            self.dropped += 1
+            return True
+        self.forwarded += 1
+        return False
+
+    def datagram_received(self, data, address):
+        if self._lost():
+            return
+        upstream = self.upstreams.get(address)
+        if upstream is None:
+            loop = asyncio.get_running_loop()
+            upstream = self.upstreams[address] = asyncio.ensure_future(
+                loop.create_datagram_endpoint(lambda: _Upstream(self, address), remote_addr=self.target))
+        upstream.add_done_callback(lambda future: future.result()[0].sendto(data))
+
+    def forward(self, data, client_address):
+        if not self._lost():
+            self.transport.sendto(data, client_address)
+
+    def close(self):
+        for upstream in self.upstreams.values():
+            if upstream.done() and not upstream.cancelled() and upstream.exception() is None:
+                upstream.result()[0].close()
+        self.transport.close()
+
+class FakeDevice:
+    """aiocoap server with the resources of gcoap_server.c, optionally behind a lossy link.
+
+    DTLS needs the DTLSSocket module; without it the device speaks plain CoAP.
+    """
+    def __init__(self, latency=0.0, loss=0.0, dtls=True, snapshot=True, host=BENCH_HOST):
+        self.latency = latency
+        self.snapshot = snapshot
+        self.loss = loss
+        self.dtls = dtls and not dtls_missing_modules()
+        self.host = host
+        self.context = None
+        self.proxy = None
+
+    async def start(self):
+        site = resource.Site()
+        for name in SENSOR_PAYLOADS:
+            site.add_resource([name], SensorResource(name, self.latency))
+        if self.snapshot:
+            site.add_resource(["snapshot"], SnapshotResource(self.latency))
+        # gcoap answers /.well-known/core on its own
+        site.add_resource([".well-known", "core"], resource.WKCResource(site.get_resources_as_linkheader))
+        port = _free_udp_port(self.host)
+        if self.dtls:
+            credentials = aiocoap.credentials.CredentialsMap()
+            credentials.load_from_dict({":client": {"dtls": {"psk": BENCH_PSK_KEY, "client-identity": BENCH_PSK_IDENTITY}}})
+            self.context = await aiocoap.Context.create_server_context(site, bind=(self.host, port), transports=["tinydtls_server"], server_credentials=credentials)
+        else:
+            self.context = await aiocoap.Context.create_server_context(site, bind=(self.host, port), transports=["udp6"])
+        if self.loss > 0:
+            transport, self.proxy = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: LossyProxy((self.host, port), self.loss), local_addr=(self.host, 0))
+            port = transport.get_extra_info("sockname")[1]
+        return Device("bench", self.host, psk_identity=BENCH_PSK_IDENTITY.decode("utf-8"), psk_key=BENCH_PSK_KEY.decode("utf-8"),
+                      friendly_name="Bench", scheme="coaps" if self.dtls else "coap", port=port)
+
+    async def stop(self):
+        if self.proxy is not None:
+            self.proxy.close()
+        if self.context is not None:
+            await self.context.shutdown()
+
+class FakeOllama:
+    """HTTP endpoint answering /api/generate like Ollama, streamed or not.
+
+    The first token comes after `delay` seconds, every further one after
+    `token_delay`. Like a small model in JSON mode, it pads the answer with
+    whitespace up to num_predict tokens unless the client hangs up.
+    """
+    # Keywords of the answer, the first match wins
+    KEYWORDS = [
+        ("humid", "humidity"), ("feucht", "humidity"),
+        ("inside", "get_internal_temp"), ("innen", "get_internal_temp"), ("room", "get_internal_temp"),
+        ("outside", "get_external_temp"), ("aussen", "get_external_temp"), ("weather", "get_external_temp"),
+        ("temp", "temperature"), ("warm", "temperature"), ("cold", "temperature"),
+        ("help", "help"), ("hilfe", "help")
+    ]
+    # Characters per token
+    TOKEN_SIZE = 4
+
+    def __init__(self, delay=0.5, token_delay=0.02, host="127.0.0.1"):
+        self.delay = delay
+        self.token_delay = token_delay
+        self.server = HttpServer(host, 0)
+        self.server.route("POST", "/api/generate", self.generate)
+        self.requests = 0
+        self.tokens = 0
+        self.cancelled = 0
+
+    @property
+    def url(self):
+        return f"http://{self.server.host}:{self.server.port}"
+
+    def _tokens(self, prompt, num_predict):
+        action = next((action for keyword, action in self.KEYWORDS if keyword in prompt.lower()), "unknown")
+        answer = json.dumps({"action": action})
+        tokens = [answer[i:i + self.TOKEN_SIZE] for i in range(0, len(answer), self.TOKEN_SIZE)]
+        return tokens + ["\n"] * max(num_predict - len(tokens), 0)
+
+    def _final(self, model, text, start, count):
+        duration = int((time.perf_counter() - start) * 1e9)
+        return {
+            "model": model,
+            "response": text,
+            "done": True,
+            "total_duration": duration,
+            "load_duration": 0,
+            "prompt_eval_duration": int(self.delay * 1e9),
+            "eval_count": count,
+            "eval_duration": max(duration - int(self.delay * 1e9), 0)
+        }
+
+    async def generate(self, request):
+        body = json.loads(request.body)
+        self.requests += 1
+        prompt = body.get("prompt", "")
+        model = body.get("model")
+        if not prompt:
+            # Warm-up, the model is loaded
+            return 200, json.dumps({"model": model, "response": "", "done": True, "load_duration": 0}), "application/json"
+        start = time.perf_counter()
+        tokens = self._tokens(prompt, (body.get("options") or {}).get("num_predict") or 128)
+        if not body.get("stream", True):
+            await asyncio.sleep(self.delay + self.token_delay * (len(tokens) - 1))
+            self.tokens += len(tokens)
+            return 200, json.dumps(self._final(model, "".join(tokens), start, len(tokens))), "application/json"
+
+        async def stream():
+            sent = 0
+            try:
+                await asyncio.sleep(self.delay)
+                for token in tokens:
+                    yield json.dumps({"model": model, "response": token, "done": False}) + "\n"
+                    sent += 1
+                    self.tokens += 1
+                    await asyncio.sleep(self.token_delay)
+                yield json.dumps(self._final(model, "", start, sent)) + "\n"
+            except GeneratorExit:
+                self.cancelled += 1
+                raise
+        return 200, stream(), "application/x-ndjson"
+
+    async def start(self):
+        await self.server.start()
+
+    async def stop(self):
+        await self.server.stop()
+
+class FakeTelegramRequest(BaseRequest):
+    """Answers the Bot API calls of the handlers locally and remembers the last reply per chat."""
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        # Format: {chat_id: text}
+        self.replies = {}
+        self._message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        parameters = request_data.parameters if request_data is not None else {}
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif endpoint in ("sendMessage", "editMessageText", "sendSticker"):
+            chat_id = int(parameters.get("chat_id", 0))
+            if "text" in parameters:
+                self.replies[chat_id] = parameters["text"]
+            self._message_id += 1
+            result = {"message_id": self._message_id, "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}, "text": parameters.get("text", "")}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+def make_update(update_id, user_id, text, bot):
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+        "text": text
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return Update.de_json({"update_id": update_id, "message": message}, bot)
+
+def percentile(samples, fraction):
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+class Benchmark:
+    def __init__(self, application, telegram, failure_prefixes):
+        self.application = application
+        self.telegram = telegram
+        self.failure_prefixes = failure_prefixes
+        self._update_id = 0
+
+    async def measure(self, texts, users, requests, unique=False):
+        """Sends the texts round robin from the users at once, each waiting for its reply.
+
+        Unique texts get a running number so no cache can answer them.
+        Returns the latencies, the number of failures and the wall time.
+        """
+        latencies = []
+        failures = 0
+        counter = iter(range(requests))
+
+        async def user(user_id):
+            nonlocal failures
+            telegram_bot.sessions.login(str(user_id))
+            for i in counter:
+                self._update_id += 1
+                text = texts[i % len(texts)]
+                if unique:
+                    text = f"{text} {user_id} {self._update_id}"
+                update = make_update(self._update_id, user_id, text, self.application.bot)
+                self.telegram.replies.pop(user_id, None)
+                start = time.perf_counter()
+                await self.application.process_update(update)
+                latencies.append(time.perf_counter() - start)
+                reply = self.telegram.replies.get(user_id)
+                if reply is None or reply.startswith(self.failure_prefixes):
+                    failures += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(user(user_id) for user_id in users))
+        return latencies, failures, time.perf_counter() - start
+
+    async def run(self, texts, concurrency, requests, unique=False):
+        users = range(BENCH_USER_ID, BENCH_USER_ID + concurrency)
+        return summarize(*await self.measure(texts, users, requests, unique))
+
+def summarize(latencies, failures, wall_time):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "failures": failures,
+        "p50": percentile(latencies, 0.5) * 1000,
+        "p95": percentile(latencies, 0.95) * 1000,
+        "p99": percentile(latencies, 0.99) * 1000,
+        "throughput": len(latencies) / wall_time
+    }
+
+def print_row(scenario, concurrency, stats, file=None):
+    print(f"{scenario:<16} {concurrency:>4} {stats['requests']:>6} {stats['failures']:>6} "
+          f"{stats['p50']:>9.1f} {stats['p95']:>9.1f} {stats['p99']:>9.1f} {stats['throughput']:>9.1f}", file=file)
+
+def compare(results, baseline, tolerance):
+    """Returns the regressions of the results against a saved baseline."""
+    regressions = []
+    for scenario, levels in results.items():
+        for concurrency, stats in levels.items():
+            old = baseline.get(scenario, {}).get(concurrency)
+            if old is None:
+                continue
+            if stats["p95"] > old["p95"] * (1 + tolerance):
+                regressions.append(f"{scenario} x{concurrency}: p95 {old['p95']:.1f} -> {stats['p95']:.1f} ms")
+            if stats["throughput"] < old["throughput"] * (1 - tolerance):
+                regressions.append(f"{scenario} x{concurrency}: throughput {old['throughput']:.1f} -> {stats['throughput']:.1f} req/s")
+    return regressions
+
+async def start_bot(args, bench_device, ollama_url, telegram):
+    device_registry.set_devices([bench_device])
+    if args.sensor_cache_ttl is not None:
+        # The fake device has no DHT11 that limits how often it can be read
+        sensor_cache_module.MIN_TTLS.clear()
+        sensor_cache.ttl = args.sensor_cache_ttl
+    processor = Prompt_Processor(host=ollama_url, keep_warm_interval=0)
+    if not args.user_rate_limit:
+        # One simulated user sends far more than a person would
+        processor.scheduler.user_rate = processor.scheduler.user_burst = 1e9
+    # The simulated users send far faster than Telegram lets a bot answer one chat
+    unlimited = float("inf")
+    rate_limiter = SendQueue() if args.send_limits else SendQueue(rate=unlimited, chat_rate=unlimited, group_rate=unlimited, broadcast_rate=unlimited)
+    application = build_application(processor, "1:BENCH", polling=False, request=telegram, rate_limiter=rate_limiter)
+    await application.initialize()
+    await processor.warm_up()
+    catalog = localization.catalog("en")
+    failure_prefixes = tuple(catalog.text(key).split("{")[0] for key in FAILURE_KEYS if catalog.text(key) is not None)
+    return processor, application, Benchmark(application, telegram, failure_prefixes)
+
+def load_scenarios(args):
+    with PHRASES_FILE.open("r", encoding="utf-8") as file:
+        phrases = [phrase for phrase, _ in json.load(file)]
+    scenarios = {command: [command] for command in BENCH_COMMANDS}
+    scenarios["text"] = phrases
+    # Texts the local classifier is not trusted with, made unique so every one goes to the LLM,
+    # once with the configured LLM_STREAM and once waiting for the whole answer
+    scenarios["llm"] = phrases
+    scenarios["llm_blocking"] = phrases
+    return {scenario: texts for scenario, texts in scenarios.items() if not args.scenario or scenario in args.scenario}
+
+async def run_scenarios(args, processor, benchmark, users, requests):
+    """Yields (scenario, concurrency, latencies, failures, wall time) of every scenario and concurrency level.
+
+    users(concurrency) returns the user IDs sending at once, requests(concurrency) their number of messages.
+    """
+    for scenario, texts in load_scenarios(args).items():
+        threshold, stream = processor.classifier.threshold, processor.stream
+        llm = scenario.startswith("llm")
+        if llm:
+            processor.classifier.threshold = float("inf")
+            processor.stream = stream and scenario == "llm"
+        for concurrency in args.concurrency:
+            yield (scenario, concurrency, *await benchmark.measure(texts, users(concurrency), requests(concurrency), unique=llm))
+        processor.classifier.threshold, processor.stream = threshold, stream
+
+def shard_users(concurrency, index, workers):
+    """The simulated users the dispatcher hands to the worker."""
+    users = []
+    user_id = BENCH_USER_ID
+    while user_id < BENCH_USER_ID + concurrency:
+        if shard(user_id, workers) == index:
+            users.append(user_id)
+        user_id += 1
+    return users
+
+async def run_shard(index, workers, args, bench_device, ollama_url, barrier, results):
+    """Runs the scenarios for the users of one worker, in step with the other workers."""
+    telegram = FakeTelegramRequest(args.telegram_latency)
+    processor, application, benchmark = await start_bot(args, bench_device, ollama_url, telegram)
+    loop = asyncio.get_running_loop()
+    # Every worker gets the share of the messages its users would send
+    users = lambda concurrency: shard_users(concurrency, index, workers)
+    requests = lambda concurrency: args.requests * len(users(concurrency)) // concurrency
+    try:
+        await loop.run_in_executor(None, barrier.wait)
+        async for step in run_scenarios(args, processor, benchmark, users, requests):
+            results.put(step)
+            await loop.run_in_executor(None, barrier.wait)
+    finally:
+        results.put(None)
+        await application.shutdown()
+        await processor.close()
+        await coap.shutdown()
+
+def _run_shard(index, workers, args, bench_device, ollama_url, barrier, results):
+    with contextlib.ExitStack() as stack:
+        if not args.verbose:
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+        asyncio.run(run_shard(index, workers, args, bench_device, ollama_url, barrier, results))
+
+async def run_workers(args, bench_device, ollama_url, report):
+    """Runs the bot in args.workers processes like the dispatcher does and merges their results."""
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(args.workers)
+    results = context.Queue()
+    processes = []
+    # A fresh shared state, classifications of an earlier run would answer the LLM scenarios
+    state_dir = tempfile.TemporaryDirectory()
+    for index in range(args.workers):
+        # Read by the modules of the worker when they are imported
+        os.environ.update(BOT_WORKERS=str(args.workers), BOT_WORKER_INDEX=str(index),
+                          SHARED_STATE_FILE=os.path.join(state_dir.name, "shared_state.db"))
+        process = context.Process(target=_run_shard, args=(index, args.workers, args, bench_device, ollama_url, barrier, results))
+        process.start()
+        processes.append(process)
+    loop = asyncio.get_running_loop()
+    merged = {}
+    running = args.workers
+    try:
+        while running:
+            step = await loop.run_in_executor(None, results.get)
+            if step is None:
+                running -= 1
+                continue
+            scenario, concurrency, latencies, failures, wall_time = step
+            parts = merged.setdefault((scenario, concurrency), [])
+            parts.append((latencies, failures, wall_time))
+            if len(parts) == args.workers:
+                # The workers ran at the same time, the slowest one took the wall time
+                stats = summarize([latency for part in parts for latency in part[0]], sum(part[1] for part in parts), max(part[2] for part in parts))
+                merged[(scenario, concurrency)] = stats
+                print_row(scenario, concurrency, stats, file=report)
+    finally:
+        for process in processes:
+            await loop.run_in_executor(None, process.join)
+        state_dir.cleanup()
+    results = {}
+    for (scenario, concurrency), stats in merged.items():
+        if isinstance(stats, dict):
+            results.setdefault(scenario, {})[str(concurrency)] = stats
+    return results
+
+async def main(args):
+    device = FakeDevice(args.device_latency, args.device_loss, dtls=not args.no_dtls, snapshot=not args.no_snapshot)
+    ollama = FakeOllama(args.llm_delay, args.llm_token_delay)
+    telegram = FakeTelegramRequest(args.telegram_latency)
+
+    bench_device = await device.start()
+    await ollama.start()
+    print(f"Benchmark: Device at {bench_device.server_uri}, Ollama at {ollama.url}")
+
+    results = {}
+    report = sys.stdout
+    print(f"{'scenario':<16} {'conc':>4} {'reqs':>6} {'fail':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>9}")
+    if args.workers > 1:
+        try:
+            results = await run_workers(args, bench_device, ollama.url, report)
+        finally:
+            print(f"Fake Ollama: {ollama.requests} requests, {ollama.tokens} tokens generated, {ollama.cancelled} streams cut off")
+            await ollama.stop()
+            await device.stop()
+        return finish(args, results)
+
+    processor, application, benchmark = await start_bot(args, bench_device, ollama.url, telegram)
+    try:
+        # The bot prints every request, only the results are of interest
+        with contextlib.ExitStack() as stack:
+            if not args.verbose:
+                stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+            users = lambda concurrency: range(BENCH_USER_ID, BENCH_USER_ID + concurrency)
+            async for scenario, concurrency, *measurement in run_scenarios(args, processor, benchmark, users, lambda concurrency: args.requests):
+                stats = summarize(*measurement)
+                results.setdefault(scenario, {})[str(concurrency)] = stats
+                print_row(scenario, concurrency, stats, file=report)
+    finally:
+        print(f"CoAP client metrics: {coap.get_metrics()}")
+        print(f"Sensor cache stats: {sensor_cache.get_stats()}")
+        print(f"LLM scheduler stats: {processor.scheduler.get_stats()}")
+        print(f"Fake Ollama: {ollama.requests} requests, {ollama.tokens} tokens generated, {ollama.cancelled} streams cut off")
+        print(f"Stage latencies:\n{metrics.summary()}")
+        if device.proxy is not None:
+            print(f"Lossy link: {device.proxy.dropped} datagrams dropped, {device.proxy.forwarded} forwarded")
+        await application.shutdown()
+        await processor.close()
+        await coap.shutdown()
+        await ollama.stop()
+        await device.stop()
+    return finish(args, results)
+
+def finish(args, results):
+    """Saves the results and compares them with the baseline, returns the exit code."""
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measures the bot end to end against local stand-ins for the IoT device, Ollama and Telegram.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16], help="simulated users sending at the same time")
+    parser.add_argument("--requests", type=int, default=200, help="messages per scenario and concurrency level")
+    parser.add_argument("--scenario", nargs="+", help="only run these scenarios, e.g. /humidity text llm")
+    parser.add_argument("--device-latency", type=float, default=0.05, help="seconds the fake device needs to read a sensor")
+    parser.add_argument("--device-loss", type=float, default=0.0, help="probability that a datagram to or from the device is lost")
+    parser.add_argument("--no-dtls", action="store_true", help="plain CoAP even if DTLSSocket is installed")
+    parser.add_argument("--no-snapshot", action="store_true", help="fake device without /snapshot, every sensor is asked on its own")
+    parser.add_argument("--llm-delay", type=float, default=0.3, help="seconds until the fake Ollama sends the first token")
+    parser.add_argument("--llm-token-delay", type=float, default=0.02, help="seconds per further token")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="seconds every Bot API call takes")
+    parser.add_argument("--sensor-cache-ttl", type=float, help="overrides SENSOR_CACHE_TTL, 0 asks the device every time")
+    parser.add_argument("--send-limits", action="store_true", help="pace the replies like Telegram's rate limits require")
+    parser.add_argument("--user-rate-limit", action="store_true", help="keep the per-user LLM rate limit")
+    parser.add_argument("--workers", type=int, default=1, help="bot processes the simulated users are sharded across")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the bot")
+    parser.add_argument("--save", help="write the results as JSON, e.g. as baseline")
+    parser.add_argument("--compare", help="baseline JSON to compare with, exits with 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative change against the baseline")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -1,51 +1,289 @@
 from aiocoap import *
+from aiocoap.credentials import CredentialsMissingError
+import aiocoap.error
+import asyncio
 import os
+import time
+from device_registry import device_registry
+from device_health import HealthTracker, CircuitOpenError, PROBE_INTERVAL, PROBE_INTERVAL_MAX
+from metrics import metrics
+from senml import decode_senml, SENML_CBOR, SENML_JSON
 
-PSK_IDENTITY = os.environ.get("PSK_IDENTITY").encode('utf-8')
-PSK_KEY      = os.environ.get("PSK_KEY").encode('utf-8')
+# Errors of a device that does not answer, the last known value can be used instead
+DEVICE_ERRORS = (CircuitOpenError, asyncio.TimeoutError, aiocoap.error.NetworkError, OSError)
+# Resource returning all sensor readings at once as SenML
+SNAPSHOT_RESOURCE = "snapshot"
+# Seconds before a device without snapshot resource is asked for it again, e.g. after a firmware update
+SNAPSHOT_RETRY_INTERVAL = float(os.environ.get("SNAPSHOT_RETRY_INTERVAL", 60 * 60))
+# Answers of a device that has no snapshot resource or cannot send SenML CBOR
+SNAPSHOT_UNSUPPORTED = (Code.NOT_FOUND, Code.METHOD_NOT_ALLOWED, Code.NOT_ACCEPTABLE, Code.UNSUPPORTED_CONTENT_FORMAT)
 
-# Function to send a GET request to the specified resource
-async def coap_client(resource):
-    IP_ADDRESS = os.environ.get("COAP_SERVER_IP")
-
-    if not IP_ADDRESS:
-        raise ValueError("Client: Environment variable COAP_SERVER_IP is not set")
-
-    # Target address for the RIOT device (CoAP server) and resource
-    coap_server_uri = f"coaps://[{IP_ADDRESS}]/{resource}"
-    
-    # Create a CoAP GET request
-    request = Message(code=GET, uri=coap_server_uri)
-
-    try:
-        # Initialize the CoAP protocol
-        protocol = await Context.create_client_context()
-        print(f"Send request to {coap_server_uri} ...")
-        
+class CoapClient:
+    """Long-lived CoAP/DTLS client shared by the whole bot.
+
+    The aiocoap context is created once and the DTLS session to each server
+    is kept open between requests, so only the first request to a server (or
+    the first one after a reconnect) pays for the handshake. Requests go to
+    a Device of the registry, the default device if none is given.
+    """
+    def __init__(self, registry=device_registry, retries=1):
+        self.registry = registry
+        self.retries = retries
+        self.protocol = None
+        self._lock = asyncio.Lock()
+        # Server URIs with credentials loaded into the current context
+        self._credentials = set()
+        # Format: {server_uri: remote}
+        # aiocoap only keeps DTLS connections in a weak pool, holding the remote
+        # here is what keeps the session warm between requests.
+        self._sessions = {}
+        self.health = HealthTracker()
+        # Format: {device name: Task probing the unreachable device}
+        self._probes = {}
+        # Format: {device name: time.time() when the snapshot resource is tried again}
+        self._no_snapshot = {}
+        self.metrics = {
+            "requests": 0,
+            "handshakes": 0,
+            "reused_sessions": 0,
+            "reconnects": 0,
+            "errors": 0,
+            "timeouts": 0,
+            "fast_failures": 0,
+            "snapshots": 0,
+            "snapshot_fallbacks": 0
+        }
+
+    def get_device(self, device=None):
+        if device is None or isinstance(device, str):
+            return self.registry.get(device)
+        return device
+
+    async def get_protocol(self):
+        """Returns the shared CoAP context, creating it on first use."""
+        async with self._lock:
+            if self.protocol is None:
+                self.protocol = await Context.create_client_context()
+                self._credentials.clear()
+                self._sessions.clear()
+            return self.protocol
+
+    def _load_credentials(self, protocol, device):
         # Add PSK Credentials to the server for DTLS Communication
+        server_uri = device.server_uri
+        if server_uri in self._credentials or device.scheme != "coaps":
+            return
         protocol.client_credentials.load_from_dict({
-            coap_server_uri : {
+            f"{server_uri}/*" : {
                 'dtls' : {
-                    'psk' : PSK_KEY,
-                    'client-identity' : PSK_IDENTITY
+                    'psk' : device.psk_key,
+                    'client-identity' : device.psk_identity
                 }
             }
         })
+        self._credentials.add(server_uri)
+
+    async def reconnect(self):
+        """Drops all DTLS sessions and the context, the next request starts from scratch."""
+        async with self._lock:
+            protocol = self.protocol
+            self.protocol = None
+            self._credentials.clear()
+            self._sessions.clear()
+        if protocol is not None:
+            self.metrics["reconnects"] += 1
+            try:
+                await protocol.shutdown()
+            except Exception as e:
+                print(f"Client: Error shutting down CoAP context: {e}")
+
+    async def request(self, resource, device=None, method=GET, probe=False, **kwargs):
+        """Sends a request to the resource of the device and returns the response message.
+
+        Raises CircuitOpenError right away while the device is known to be
+        down, probes are the only requests sent to it then.
+        """
+        device = self.get_device(device)
+        server_uri = device.server_uri
+        coap_server_uri = f"{server_uri}/{resource}"
+        health = self.health.get(device.name)
+        if health.is_open and not probe:
+            self.metrics["fast_failures"] += 1
+            raise CircuitOpenError(device.name, health.opened_at)
+        self.metrics["requests"] += 1
+
+        attempt = 0
+        while True:
+            protocol = await self.get_protocol()
+            self._load_credentials(protocol, device)
+            reused = server_uri in self._sessions
+            print(f"Send request to {coap_server_uri} ...")
+            # A request on a new session includes the DTLS handshake
+            stage = "coap_request" if reused else "coap_handshake"
+            start = time.perf_counter()
+            try:
+                request = Message(code=method, uri=coap_server_uri, **kwargs)
+                # Instead of aiocoap's retransmission schedule of more than a minute
+                response = await asyncio.wait_for(protocol.request(request).response, health.timeout(handshake=not reused))
+            except CredentialsMissingError as e:
+                metrics.error(stage)
+                self.metrics["errors"] += 1
+                print(f"Client: Error accessing the CoAP server: {e}")
+                raise e
+            except asyncio.TimeoutError as e:
+                metrics.error(stage)
+                self.metrics["timeouts"] += 1
+                print(f"Client: No answer from {coap_server_uri} within {health.timeout(handshake=not reused):.1f} s")
+                # The device may have lost the session, e.g. after a reboot
+                self.drop_session(device)
+                if attempt >= self.retries or probe:
+                    self._failed(device, health)
+                    raise e
+                attempt += 1
+                continue
+            except (aiocoap.error.NetworkError, OSError) as e:
+                metrics.error(stage)
+                self.metrics["errors"] += 1
+                print(f"Client: Error accessing the CoAP server: {e}")
+                if attempt >= self.retries or probe:
+                    self._sessions.pop(server_uri, None)
+                    self._failed(device, health)
+                    raise e
+                # The session or the socket is broken, start over with a fresh context
+                attempt += 1
+                await self.reconnect()
+                continue
+            except Exception as e:
+                metrics.error(stage)
+                self.metrics["errors"] += 1
+                print(f"Client: Error accessing the CoAP server: {e}")
+                raise e
+
+            rtt = time.perf_counter() - start
+            metrics.observe(stage, rtt)
+            if reused:
+                self.metrics["reused_sessions"] += 1
+            else:
+                self.metrics["handshakes"] += 1
+            self._sessions[server_uri] = response.remote
+            # Handshakes take several round trips and would distort the estimate
+            if health.record_success(rtt if reused else None):
+                print(f"Client: Device {device.name} is reachable again")
+            return response
 
-        # Send the request and wait for the response
-        response = await protocol.request(request).response
+    def _failed(self, device, health):
+        if health.record_failure():
+            print(f"Client: Device {device.name} is unreachable, failing fast until a probe succeeds")
+            if device.name not in self._probes:
+                self._probes[device.name] = asyncio.create_task(self._probe(device, health))
 
+    async def _probe(self, device, health):
+        """Asks the device in the background until it answers, which closes the circuit."""
+        interval = PROBE_INTERVAL
+        try:
+            while health.is_open:
+                await asyncio.sleep(interval)
+                try:
+                    await self.request(device.resources[0], device, probe=True)
+                except Exception:
+                    interval = min(interval * 2, PROBE_INTERVAL_MAX)
+        finally:
+            self._probes.pop(device.name, None)
+
+    def report_alive(self, device=None):
+        """Called when the device was heard from outside of request(), e.g. by a notification."""
+        device = self.get_device(device)
+        if self.health.get(device.name).record_alive():
+            print(f"Client: Device {device.name} is reachable again")
+
+    async def observe(self, resource, device=None):
+        """Registers for notifications of the resource (RFC 7641) and returns the aiocoap request.
+
+        The first response is available as request.response, notifications are
+        delivered by iterating over request.observation.
+        """
+        device = self.get_device(device)
+        coap_server_uri = f"{device.server_uri}/{resource}"
+        protocol = await self.get_protocol()
+        self._load_credentials(protocol, device)
+        print(f"Register observation of {coap_server_uri} ...")
+        return protocol.request(Message(code=GET, uri=coap_server_uri, observe=0))
+
+    def drop_session(self, device=None):
+        """Forgets the DTLS session to the device, e.g. after it rebooted."""
+        remote = self._sessions.pop(self.get_device(device).server_uri, None)
+        # Only DTLS remotes have a session to close
+        if remote is not None and hasattr(remote, "shutdown"):
+            try:
+                remote.shutdown()
+            except Exception as e:
+                print(f"Client: Error closing DTLS session: {e}")
+
+    async def get(self, resource, device=None):
+        """Sends a GET request to the resource and returns the decoded payload."""
+        response = await self.request(resource, device)
         decoded_response = response.payload.decode('utf-8')
         print(f"Client: Response from server: {decoded_response}")
         return decoded_response
 
-    except UnboundLocalError as e:
-        print("Client: Connection established, but the sensor data could not be retrieved from the IoT device.")
-        raise e
+    async def get_snapshot(self, device=None):
+        """Reads all sensors of the device with one request.
 
-    except Exception as e:
-        print(f"Client: Error accessing the CoAP server: {e}")
-        raise e
+        Returns {resource: (value, timestamp)}, or None if the device has no
+        snapshot resource; the per-resource text endpoints have to be asked
+        then. Errors of an unreachable device are raised like in request().
+        """
+        device = self.get_device(device)
+        retry_at = self._no_snapshot.get(device.name)
+        if retry_at is not None:
+            if time.time() < retry_at:
+                return None
+            del self._no_snapshot[device.name]
+        response = await self.request(SNAPSHOT_RESOURCE, device, accept=SENML_CBOR)
+        content_format = response.opt.content_format
+        if response.code in SNAPSHOT_UNSUPPORTED or (response.code.is_successful() and content_format not in (SENML_CBOR, SENML_JSON)):
+            print(f"Client: {device.name} has no SenML snapshot ({response.code}), asking every resource")
+            self._no_snapshot[device.name] = time.time() + SNAPSHOT_RETRY_INTERVAL
+            self.metrics["snapshot_fallbacks"] += 1
+            return None
+        if not response.code.is_successful():
+            print(f"Client: Snapshot of {device.name} failed with {response.code}")
+            self.metrics["snapshot_fallbacks"] += 1
+            return None
+        try:
+            records = decode_senml(response.payload, int(content_format))
+        except ValueError as e:
+            print(f"Client: Invalid snapshot of {device.name}: {e}")
+            self.metrics["snapshot_fallbacks"] += 1
+            return None
+        self.metrics["snapshots"] += 1
+        return {record["name"]: (record["value"], record["time"]) for record in records}
+
+    async def shutdown(self):
+        probes = list(self._probes.values())
+        for task in probes:
+            task.cancel()
+        await asyncio.gather(*probes, return_exceptions=True)
+        async with self._lock:
+            protocol = self.protocol
+            self.protocol = None
+            self._credentials.clear()
+            self._sessions.clear()
+        if protocol is not None:
+            await protocol.shutdown()
+
+    def get_metrics(self):
+        return {**self.metrics, "open_sessions": len(self._sessions), "open_circuits": len(self.health.open_circuits())}
+
+# Client shared by the whole bot
+coap = CoapClient()
+
+# Function to send a GET request to the specified resource
+async def coap_client(resource, device=None):
+    with metrics.span("coap_client"):
+        return await coap.get(resource, device)
 
-    finally:
-        await protocol.shutdown()
+# Function to read all sensors of the device with one request
+async def coap_snapshot(device=None):
+    with metrics.span("coap_snapshot"):
+        return await coap.get_snapshot(device)
@@ -0,0 +1,114 @@
+import os
+import time
+
+# Bounds of the adaptive request timeout in seconds
+DEVICE_TIMEOUT_MIN = float(os.environ.get("DEVICE_TIMEOUT_MIN", 1.0))
+DEVICE_TIMEOUT_MAX = float(os.environ.get("DEVICE_TIMEOUT_MAX", 10.0))
+# Timeout before the first round trip time was measured
+INITIAL_TIMEOUT = 5.0
+# A DTLS handshake takes several round trips and crypto on the device
+HANDSHAKE_FACTOR = 3
+# Failed requests in a row after which the circuit opens and requests fail fast
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", 3))
+# Seconds between two probes while the circuit is open, doubled after every failed probe
+PROBE_INTERVAL = float(os.environ.get("PROBE_INTERVAL", 5))
+PROBE_INTERVAL_MAX = 60
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request to a device that is known to be down."""
+    def __init__(self, device, since):
+        super().__init__(f"Device {device} is unreachable")
+        self.device = device
+        # time.time() when the circuit opened
+        self.since = since
+
+class DeviceHealth:
+    """Round trip times and circuit breaker state of one device.
+
+    The timeout follows RFC 6298: smoothed RTT plus four times its variance,
+    kept between DEVICE_TIMEOUT_MIN and DEVICE_TIMEOUT_MAX. After
+    CIRCUIT_FAILURE_THRESHOLD failures in a row the circuit opens; it closes
+    again on the first success, usually a background probe.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.srtt = None
+        self.rttvar = None
+        self.failures = 0
+        # time.time() when the circuit opened, None while it is closed
+        self.opened_at = None
+        self.last_success = None
+        self.stats = {
+            "successes": 0,
+            "failures": 0,
+            "circuit_opened": 0
+        }
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def timeout(self, handshake=False):
+        if self.srtt is None:
+            timeout = INITIAL_TIMEOUT
+        else:
+            timeout = self.srtt + 4 * self.rttvar
+        if handshake:
+            timeout *= HANDSHAKE_FACTOR
+        return min(max(timeout, DEVICE_TIMEOUT_MIN), DEVICE_TIMEOUT_MAX)
+
+    def record_success(self, rtt=None):
+        """Records an answer, rtt only for requests without handshake. Returns True if the circuit closed."""
+        if rtt is not None:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+                self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.stats["successes"] += 1
+        return self.record_alive()
+
+    def record_alive(self):
+        """The device was heard from, e.g. by an Observe notification. Returns True if the circuit closed."""
+        self.failures = 0
+        self.last_success = time.time()
+        if self.opened_at is None:
+            return False
+        self.opened_at = None
+        return True
+
+    def record_failure(self):
+        """Records a request that got no answer. Returns True if the circuit opened."""
+        self.failures += 1
+        self.stats["failures"] += 1
+        if self.opened_at is None and self.failures >= CIRCUIT_FAILURE_THRESHOLD:
+            self.opened_at = time.time()
+            self.stats["circuit_opened"] += 1
+            return True
+        return False
+
+    def get_stats(self):
+        return {
+            **self.stats,
+            "open": int(self.is_open),
+            "srtt": round(self.srtt, 4) if self.srtt is not None else None,
+            "timeout": round(self.timeout(), 3)
+        }
+
+class HealthTracker:
+    def __init__(self):
+        # Format: {device name: DeviceHealth}
+        self.devices = {}
+
+    def get(self, name):
+        health = self.devices.get(name)
+        if health is None:
+            health = self.devices[name] = DeviceHealth(name)
+        return health
+
+    def open_circuits(self):
+        return [name for name, health in self.devices.items() if health.is_open]
+
+    def get_stats(self):
+        return {name: health.get_stats() for name, health in self.devices.items()}
@@ -0,0 +1,122 @@
+import asyncio
+import json
+import os
+from pathlib import Path
+from intent_classifier import normalize_text
+
+script_dir = Path(__file__).parent
+DEVICES_FILE = script_dir / "devices.json"
+
+# Name of the device created from COAP_SERVER_IP if there is no devices.json
+DEFAULT_DEVICE_NAME = "default"
+# Resources every device offers unless its entry lists others
+DEFAULT_RESOURCES = ["internal_temp", "external_temp", "hum"]
+# Parallel requests and seconds per device when all devices are asked
+FANOUT_CONCURRENCY = int(os.environ.get("FANOUT_CONCURRENCY", 16))
+FANOUT_TIMEOUT = float(os.environ.get("FANOUT_TIMEOUT", 10))
+
+def _encode(value):
+    return value.encode('utf-8') if value is not None else None
+
+class Device:
+    """An IoT device running the CoAP server, with its address and DTLS credentials."""
+    def __init__(self, name, address, psk_identity=None, psk_key=None, resources=None, friendly_name=None, observe=False, scheme="coaps", port=None):
+        self.name = name
+        self.address = address
+        # None for the default CoAP port of the scheme
+        self.port = port
+        # Credentials of the environment are used if the device has none
+        self.psk_identity = _encode(psk_identity or os.environ.get("PSK_IDENTITY"))
+        self.psk_key = _encode(psk_key or os.environ.get("PSK_KEY"))
+        self.resources = resources or list(DEFAULT_RESOURCES)
+        self.friendly_name = friendly_name or name
+        # Whether the bot keeps CoAP Observe registrations on the resources
+        self.observe = observe
+        self.scheme = scheme
+
+    @property
+    def server_uri(self):
+        if not self.address:
+            raise ValueError(f"Client: No address configured for device {self.name}, set COAP_SERVER_IP or add it to devices.json")
+        if self.port:
+            return f"{self.scheme}://[{self.address}]:{self.port}"
+        return f"{self.scheme}://[{self.address}]"
+
+class DeviceRegistry:
+    """All devices the bot can reach, loaded from devices.json.
+
+    Format of devices.json:
+    [{"name": "kitchen", "address": "2001:db8::1", "psk_identity": "...", "psk_key": "...",
+      "resources": ["internal_temp", "external_temp", "hum"], "friendly_name": "Kitchen", "observe": true}]
+
+    Without the file there is one device named "default" with the address
+    from COAP_SERVER_IP and the credentials from PSK_IDENTITY and PSK_KEY.
+    """
+    def __init__(self, filepath=DEVICES_FILE):
+        self.filepath = filepath
+        # Format: {name: Device}, the first device is the default one
+        self.devices = {}
+        # Format: {normalized name or friendly name: Device}
+        self._aliases = {}
+        self.load()
+
+    def load(self):
+        devices = []
+        if self.filepath.exists():
+            with self.filepath.open("r", encoding="utf-8") as file:
+                devices = [Device(**entry) for entry in json.load(file)]
+        if not devices:
+            devices = [Device(DEFAULT_DEVICE_NAME, os.environ.get("COAP_SERVER_IP"), observe=True)]
+        self.set_devices(devices)
+
+    def set_devices(self, devices):
+        """Replaces all devices, the first one becomes the default device."""
+        self.devices = {device.name: device for device in devices}
+        self._aliases = {}
+        for device in self.devices.values():
+            self._aliases[normalize_text(device.friendly_name)] = device
+            self._aliases[normalize_text(device.name)] = device
+
+    def default(self):
+        return next(iter(self.devices.values()))
+
+    def get(self, name=None):
+        """Returns the device by name or friendly name, the default device for None. Raises KeyError."""
+        if name is None:
+            return self.default()
+        return self._aliases[normalize_text(str(name))]
+
+    def find_in_text(self, text):
+        """Returns the first device whose name or friendly name appears in the normalized text."""
+        if len(self.devices) < 2:
+            return None
+        for alias, device in self._aliases.items():
+            if f" {alias} " in f" {text} ":
+                return device
+        return None
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __iter__(self):
+        return iter(self.devices.values())
+
+    async def fan_out(self, fetch, devices=None, concurrency=FANOUT_CONCURRENCY, timeout=FANOUT_TIMEOUT):
+        """Calls fetch(device) for all devices with at most `concurrency` requests in flight.
+
+        Returns {device name: result or exception}; devices that do not
+        answer within `timeout` seconds get an asyncio.TimeoutError, the
+        others are returned anyway.
+        """
+        devices = list(devices or self.devices.values())
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch_one(device):
+            async with semaphore:
+                return await asyncio.wait_for(fetch(device), timeout)
+
+        results = await asyncio.gather(*(fetch_one(device) for device in devices), return_exceptions=True)
+        return {device.name: result for device, result in zip(devices, results)}
+
+# Registry shared by the whole bot
+device_registry = DeviceRegistry()
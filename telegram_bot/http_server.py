@@ -0,0 +1,134 @@
+import asyncio
+from http import HTTPStatus
+
+# Largest request body accepted, Telegram updates are far smaller
+MAX_BODY_SIZE = 1024 * 1024
+
+class HttpRequest:
+    def __init__(self, method, path, query, headers, body):
+        self.method = method
+        self.path = path
+        self.query = query
+        # Header names in lower case
+        self.headers = headers
+        self.body = body
+
+class HttpServer:
+    """Minimal asyncio HTTP/1.1 server for the webhook and metrics endpoints.
+
+    Handlers are coroutines taking an HttpRequest and returning
+    (status, body, content type). A body that is an async iterator is sent
+    chunk by chunk as it is produced. Connections are kept alive unless the
+    client asks otherwise.
+    """
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        # Format: {(method, path): handler}
+        self.routes = {}
+        self._server = None
+
+    def route(self, method, path, handler):
+        self.routes[(method.upper(), path)] = handler
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        # Port 0 lets the system choose a free port
+        self.port = self._server.sockets[0].getsockname()[1]
+        print(f"HTTP server: Listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    await self._respond(writer, HTTPStatus.BAD_REQUEST, keep_alive=False)
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                try:
+                    length = int(headers.get("content-length") or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await self._respond(writer, HTTPStatus.BAD_REQUEST, keep_alive=False)
+                    break
+                if length > MAX_BODY_SIZE:
+                    await self._respond(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                path, _, query = target.partition("?")
+                handler = self.routes.get((method.upper(), path))
+                if handler is None:
+                    status = HTTPStatus.METHOD_NOT_ALLOWED if any(p == path for _, p in self.routes) else HTTPStatus.NOT_FOUND
+                    await self._respond(writer, status, keep_alive=keep_alive)
+                else:
+                    try:
+                        status, response_body, content_type = await handler(HttpRequest(method.upper(), path, query, headers, body))
+                    except Exception as e:
+                        print(f"HTTP server: Handler for {method} {path} failed: {e}")
+                        status, response_body, content_type = HTTPStatus.INTERNAL_SERVER_ERROR, b"", "text/plain"
+                    await self._respond(writer, status, response_body, content_type, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, body=b"", content_type="text/plain", keep_alive=True):
+        status = HTTPStatus(status)
+        if hasattr(body, "__aiter__"):
+            await self._respond_chunked(writer, status, body, content_type, keep_alive)
+            return
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        head = (
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    async def _respond_chunked(self, writer, status, body, content_type, keep_alive):
+        head = (
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            "Transfer-Encoding: chunked\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1"))
+        try:
+            async for chunk in body:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                if chunk:
+                    writer.write(f"{len(chunk):x}\r\n".encode("latin-1") + chunk + b"\r\n")
+                    # Raises once the client is gone, which stops producing the body
+                    await writer.drain()
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        finally:
+            if hasattr(body, "aclose"):
+                await body.aclose()
@@ -0,0 +1,262 @@
+import json
+import math
+import os
+import re
+import time
+import unicodedata
+from collections import Counter
+from pathlib import Path
+
+script_dir = Path(__file__).parent
+INTENTS_FILE = script_dir / "intents.json"
+TRANSLATION_FILE = script_dir / "translations.json"
+PHRASES_FILE = script_dir / "intent_phrases.json"
+
+# Minimum confidence for an answer without asking the LLM
+INTENT_CONFIDENCE_THRESHOLD = float(os.environ.get("INTENT_CONFIDENCE_THRESHOLD", 0.6))
+
+# Commands listed in the help translations and the action they stand for
+COMMAND_ACTIONS = {
+    "help": "help",
+    "temp": "temperature",
+    "internal_temp": "get_internal_temp",
+    "external_temp": "get_external_temp",
+    "humidity": "humidity"
+}
+# Sensor actions that make the generic temperature action more specific, their qualifiers (e.g. "inside") choose the sensor
+SPECIFIC_TEMPERATURE_ACTIONS = {"get_internal_temp", "get_external_temp"}
+# Sensor actions that can be asked for in one request
+SENSOR_ACTIONS = {"get_internal_temp", "get_external_temp", "humidity"}
+# Confidence of a request a rule names, e.g. "temperature" or "help"
+RULE_CONFIDENCE = 0.9
+# Confidence of a request only hinted at, e.g. "hot" or "dry"
+HINT_CONFIDENCE = 0.75
+# Confidence lost for every word that is neither matched nor a filler word, e.g. "recipe" in "hot dog recipe"
+UNEXPLAINED_WORD_PENALTY = 0.2
+
+UMLAUTS = str.maketrans({"ä": "ae", "ö": "oe", "ü": "ue", "ß": "ss"})
+
+def normalize_text(text: str) -> str:
+    """Lower case, umlauts spelled out, punctuation removed and whitespace collapsed."""
+    text = text.casefold().translate(UMLAUTS)
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+def char_ngrams(text: str, n: int = 3) -> Counter:
+    grams = Counter()
+    for word in text.split():
+        padded = f" {word} "
+        for i in range(max(len(padded) - n + 1, 1)):
+            grams[padded[i:i + n]] += 1
+    return grams
+
+class NgramMatcher:
+    """TF-IDF weighted character n-gram matcher returning the most similar example phrase."""
+    def __init__(self, examples):
+        # Format: [(text, action)]
+        self.examples = examples
+        documents = [char_ngrams(text) for text, _ in examples]
+        document_frequency = Counter(gram for grams in documents for gram in grams)
+        self.idf = {gram: math.log((1 + len(documents)) / (1 + df)) + 1 for gram, df in document_frequency.items()}
+        self.vectors = [self._vectorize(grams) for grams in documents]
+        # Format: {gram: [example index]}
+        self.index = {}
+        for i, vector in enumerate(self.vectors):
+            for gram in vector:
+                self.index.setdefault(gram, []).append(i)
+
+    def _vectorize(self, grams):
+        vector = {gram: count * self.idf.get(gram, 0.0) for gram, count in grams.items()}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+        return {gram: weight / norm for gram, weight in vector.items()} if norm else {}
+
+    def match(self, text):
+        """Returns (example text, action, cosine similarity) of the closest example."""
+        vector = self._vectorize(char_ngrams(text))
+        scores = Counter()
+        for gram, weight in vector.items():
+            for i in self.index.get(gram, ()):
+                scores[i] += weight * self.vectors[i][gram]
+        if not scores:
+            return "", "unknown", 0.0
+        i, score = scores.most_common(1)[0]
+        return self.examples[i][0], self.examples[i][1], score
+
+class IntentClassifier:
+    """Deterministic intent classification that answers common requests without the LLM.
+
+    Keyword and regex rules per language come from intents.json and the
+    action list of the system prompt. Rules name a request ("temperature"),
+    hints only suggest one ("hot") and qualifiers ("inside") choose the
+    temperature sensor without being a request of their own. Every word of
+    the message that no rule explains and that is not a filler word lowers
+    the confidence, so "hot dog recipe" goes to the LLM. If the rules are
+    not conclusive, a character n-gram matcher compares the message with
+    the example phrases of intents.json and the command descriptions of the
+    help translations.
+    """
+    def __init__(self, system_description="", intents_file=INTENTS_FILE, translation_file=TRANSLATION_FILE, threshold=INTENT_CONFIDENCE_THRESHOLD):
+        self.threshold = threshold
+        intents = self._load_json(intents_file)
+        translations = self._load_json(translation_file)
+
+        # Format: {kind: {action: [pattern]}}, the patterns of all languages combined
+        patterns = {"rules": {}, "hints": {}, "qualifiers": {}}
+        for data in intents.values():
+            for kind, kind_patterns in patterns.items():
+                for action, rules in data.get(kind, {}).items():
+                    kind_patterns.setdefault(action, []).extend(rules)
+        for action, words in self._system_description_rules(system_description).items():
+            # The examples of the prompt are as vague as the hints, those of the sensors qualify the temperature
+            kind = "qualifiers" if action in SPECIFIC_TEMPERATURE_ACTIONS else "hints" if action in patterns["hints"] else "rules"
+            patterns[kind].setdefault(action, []).extend(re.escape(word) for word in words)
+        # Format: [(kind, action, compiled regex)]
+        self.rules = [(kind, action, re.compile(r"\b(?:" + "|".join(rules) + r")\b"))
+                      for kind, kind_patterns in patterns.items() for action, rules in kind_patterns.items()]
+        # Words that do not change the request, e.g. "the" or "please"
+        self.filler = frozenset(word for data in intents.values() for word in data.get("filler", ()))
+
+        examples = []
+        for lang, data in intents.items():
+            for action, phrases in data.get("examples", {}).items():
+                examples.extend((normalize_text(phrase), action) for phrase in phrases)
+        examples.extend(self._translation_examples(translations))
+        self.matcher = NgramMatcher(examples)
+
+    def _load_json(self, filepath):
+        if filepath.exists():
+            with filepath.open("r", encoding="utf-8") as file:
+                return json.load(file)
+        return {}
+
+    def _system_description_rules(self, system_description):
+        """Collects the example words of '**action**: ... (e.g., a, b, or c)' in the system prompt."""
+        rules = {}
+        for action, words in re.findall(r"\*\*(\w+)\*\*:[^(]*\(e\.g\., ([^)]*)\)", system_description):
+            words = [normalize_text(re.sub(r"^or ", "", word.strip())) for word in words.split(",")]
+            rules[action] = [word for word in words if word]
+        return rules
+
+    def _translation_examples(self, translations):
+        """Uses the command descriptions of the help text and the sensor button labels as examples."""
+        examples = []
+        for messages in translations.values():
+            for command, description in re.findall(r"/(\w+) - ([^\n]+)", messages.get("help", "")):
+                if command in COMMAND_ACTIONS:
+                    examples.append((normalize_text(description), COMMAND_ACTIONS[command]))
+            for key in ("internal_temp", "external_temp"):
+                if key in messages:
+                    examples.append((normalize_text(messages[key]), f"get_{key}"))
+        return examples
+
+    def match_rules(self, text):
+        """Returns the matches of the normalized text as [(start, end, kind, action)] in text order."""
+        return sorted((match.start(), match.end(), kind, action)
+                      for kind, action, rule in self.rules for match in rule.finditer(text))
+
+    def is_sensor_action(self, action):
+        # Actions of discovered resources are called get_<resource>
+        return action in SENSOR_ACTIONS or action.startswith("get_")
+
+    def resolve(self, matches, text=""):
+        """Combines the matched actions into one, returns (action, confidence).
+
+        Several measurements asked for at once, e.g. "temperature and
+        humidity" or the temperature "inside and outside", give a list of
+        actions in the order they appear in the text.
+        """
+        requests = [(kind, action) for _, _, kind, action in matches if kind != "qualifiers"]
+        if not requests:
+            return "unknown", 0.0
+        locations = list(dict.fromkeys(action for _, _, kind, action in matches if kind == "qualifiers"))
+        requested = list(dict.fromkeys(action for _, action in requests))
+        if "help" in requested and len(requested) > 1:
+            # Conflicting rules, e.g. help and a sensor
+            return "unknown", 0.0
+        if not all(action == "help" or action == "temperature" or self.is_sensor_action(action) for action in requested):
+            return "unknown", 0.0
+        actions = []
+        for action in requested:
+            if action != "temperature":
+                actions.append(action)
+            elif locations:
+                actions.extend(locations)
+            elif len(requested) > 1:
+                # The temperature next to other sensors means both temperature sensors
+                actions.extend(("get_internal_temp", "get_external_temp"))
+            else:
+                actions.append(action)
+        actions = list(dict.fromkeys(actions))
+
+        confidence = RULE_CONFIDENCE if any(kind == "rules" for kind, _ in requests) else HINT_CONFIDENCE
+        for word in re.finditer(r"\w+", text):
+            if word.group() not in self.filler and not any(start <= word.start() and word.end() <= end for start, end, _, _ in matches):
+                confidence -= UNEXPLAINED_WORD_PENALTY
+        return (actions[0] if len(actions) == 1 else actions), max(confidence, 0.0)
+
+    def classify(self, text):
+        """Returns (action, confidence) for the message, confidence is between 0 and 1.
+
+        action is a list of actions if several sensors were asked for.
+        """
+        text = normalize_text(text)
+        if not text:
+            return "unknown", 0.0
+        matches = self.match_rules(text)
+        if matches and all(kind == "qualifiers" for _, _, kind, _ in matches):
+            # A place alone, e.g. "room service", does not ask for a measurement
+            return "unknown", 0.0
+        if matches:
+            action, confidence = self.resolve(matches, text)
+            if action != "unknown":
+                return action, confidence
+        example, action, similarity = self.matcher.match(text)
+        # Words like none of the example, e.g. "service" next to "room", are not explained by it
+        grams = char_ngrams(example)
+        unexplained = sum(1 for word in text.split()
+                          if word not in self.filler and len(char_ngrams(word).keys() & grams) * 2 < len(char_ngrams(word)))
+        return action, max(similarity * 0.9 - unexplained * UNEXPLAINED_WORD_PENALTY, 0.0)
+
+    def is_confident(self, confidence):
+        return confidence >= self.threshold
+
+def evaluate(classifier, phrases_file=PHRASES_FILE):
+    """Reports accuracy and latency of the classifier against the labelled phrase set.
+
+    Phrases below the confidence threshold go to the LLM, they count as
+    correct only when labelled 'unknown' (the LLM decides those).
+    """
+    with phrases_file.open("r", encoding="utf-8") as file:
+        phrases = json.load(file)
+
+    local = correct = local_correct = 0
+    durations = []
+    for text, expected in phrases:
+        start = time.perf_counter()
+        action, confidence = classifier.classify(text)
+        durations.append(time.perf_counter() - start)
+        if classifier.is_confident(confidence):
+            local += 1
+            if action == expected:
+                correct += 1
+                local_correct += 1
+            else:
+                print(f"  wrong: {text!r} -> {action} ({confidence:.2f}), expected {expected}")
+        elif expected == "unknown":
+            correct += 1
+        else:
+            print(f"  to LLM: {text!r} -> {action} ({confidence:.2f}), expected {expected}")
+
+    durations.sort()
+    print(f"Phrases: {len(phrases)}")
+    print(f"Answered locally: {local / len(phrases):.1%}")
+    print(f"Accuracy of local answers: {local_correct / local if local else 0.0:.1%}")
+    print(f"Overall accuracy (rest sent to LLM): {correct / len(phrases):.1%}")
+    print(f"Latency: mean {sum(durations) / len(durations) * 1e6:.1f} µs, "
+          f"p99 {durations[int(len(durations) * 0.99)] * 1e6:.1f} µs, max {durations[-1] * 1e6:.1f} µs")
+
+if __name__ == '__main__':
+    from prompt_processor import Prompt_Processor
+    evaluate(Prompt_Processor().classifier)
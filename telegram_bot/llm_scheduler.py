@@ -0,0 +1,188 @@
+import asyncio
+import os
+import time
+from collections import deque
+from metrics import metrics
+
+# Seconds a user waits for an LLM answer before the request fails
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", 25))
+# Number of requests Ollama works on at the same time
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", 1))
+# Sustained LLM requests per second and user, and how many may come at once
+LLM_USER_RATE = float(os.environ.get("LLM_USER_RATE", 0.2))
+LLM_USER_BURST = int(os.environ.get("LLM_USER_BURST", 3))
+# Initial guess of the seconds one LLM request takes, refined with every request
+INITIAL_SERVICE_TIME = 5.0
+
+class SchedulerBusy(Exception):
+    """Raised when a request is rejected, reason is 'busy' or 'rate_limited'."""
+    def __init__(self, reason, expected_wait=None):
+        super().__init__(reason)
+        self.reason = reason
+        self.expected_wait = expected_wait
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+
+    def refill_time(self):
+        """Seconds an empty bucket takes to fill up."""
+        return self.capacity / self.rate if self.rate > 0 else float("inf")
+
+    def is_full(self, now):
+        """True if the bucket filled up since it was last used, it is then no different from a new one."""
+        return now - self.last >= self.refill_time()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+class _Job:
+    def __init__(self, user_id, factory, future):
+        self.user_id = user_id
+        self.factory = factory
+        self.future = future
+        self.enqueued = time.monotonic()
+        self.task = None
+
+class LLMScheduler:
+    """Admission control and fair queueing in front of the LLM.
+
+    At most `concurrency` requests run at once. Waiting requests are kept in
+    one queue per user and served round robin, so a chatty user cannot starve
+    the others. Every user has a token bucket limiting the request rate, and a
+    request whose expected queue wait exceeds the timeout is rejected right
+    away instead of failing after the timeout. Buckets idle for longer than
+    they take to refill are full and are dropped, a new one is created the
+    next time the user asks.
+    """
+    def __init__(self, concurrency=LLM_CONCURRENCY, timeout=LLM_TIMEOUT, user_rate=LLM_USER_RATE, user_burst=LLM_USER_BURST):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        # Format: {user_id: deque of _Job}
+        self._queues = {}
+        # Users with waiting requests in round robin order
+        self._ready = deque()
+        self._running = 0
+        # Format: {user_id: TokenBucket}
+        self._buckets = {}
+        # Buckets are swept at most once per refill time
+        self._next_sweep = time.monotonic()
+        self.service_time = INITIAL_SERVICE_TIME
+        self.wait_times = deque(maxlen=200)
+        self.stats = {
+            "submitted": 0,
+            "completed": 0,
+            "rejected_busy": 0,
+            "rejected_rate_limited": 0,
+            "abandoned": 0
+        }
+
+    def queue_depth(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def expected_wait(self, user_id):
+        """Seconds a new request of the user would wait, following the round robin order."""
+        own = len(self._queues.get(user_id, ()))
+        ahead = own + sum(min(len(queue), own + 1) for uid, queue in self._queues.items() if uid != user_id)
+        slots_busy = max(0, self._running + ahead - self.concurrency + 1)
+        return slots_busy * self.service_time / self.concurrency
+
+    async def submit(self, user_id, factory):
+        """Runs factory() (returning an awaitable) when it is the user's turn and returns its result."""
+        self._sweep_buckets()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.user_rate, self.user_burst)
+        if not bucket.take():
+            self.stats["rejected_rate_limited"] += 1
+            raise SchedulerBusy("rate_limited")
+
+        expected_wait = self.expected_wait(user_id)
+        if expected_wait + self.service_time > self.timeout:
+            self.stats["rejected_busy"] += 1
+            raise SchedulerBusy("busy", expected_wait)
+
+        self.stats["submitted"] += 1
+        job = _Job(user_id, factory, asyncio.get_running_loop().create_future())
+        if user_id not in self._queues:
+            self._queues[user_id] = deque()
+            self._ready.append(user_id)
+        self._queues[user_id].append(job)
+        self._dispatch()
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            # The caller gave up, don't keep the LLM busy for nobody
+            self.stats["abandoned"] += 1
+            if job.task is not None:
+                job.task.cancel()
+            raise
+
+    def _sweep_buckets(self):
+        now = time.monotonic()
+        if now < self._next_sweep:
+            return
+        refill_time = TokenBucket(self.user_rate, self.user_burst).refill_time()
+        self._next_sweep = now + refill_time
+        for user_id in [user_id for user_id, bucket in self._buckets.items() if bucket.is_full(now)]:
+            del self._buckets[user_id]
+
+    def _dispatch(self):
+        while self._running < self.concurrency and self._ready:
+            user_id = self._ready.popleft()
+            queue = self._queues[user_id]
+            job = queue.popleft()
+            if queue:
+                self._ready.append(user_id)
+            else:
+                del self._queues[user_id]
+            if job.future.done():
+                continue
+            self._running += 1
+            wait = time.monotonic() - job.enqueued
+            self.wait_times.append(wait)
+            metrics.observe("llm_queue", wait)
+            job.task = asyncio.create_task(self._run(job))
+
+    async def _run(self, job):
+        start = time.monotonic()
+        try:
+            result = await job.factory()
+            if not job.future.done():
+                job.future.set_result(result)
+            self.stats["completed"] += 1
+            # Moving average of the time a request takes
+            self.service_time = 0.8 * self.service_time + 0.2 * (time.monotonic() - start)
+        except asyncio.CancelledError:
+            if not job.future.done():
+                job.future.cancel()
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        finally:
+            self._running -= 1
+            self._dispatch()
+
+    def get_stats(self):
+        waits = sorted(self.wait_times)
+        return {
+            **self.stats,
+            "running": self._running,
+            "queue_depth": self.queue_depth(),
+            "queued_users": len(self._queues),
+            "buckets": len(self._buckets),
+            "service_time": round(self.service_time, 2),
+            "mean_wait": sum(waits) / len(waits) if waits else 0.0,
+            "p95_wait": waits[int(len(waits) * 0.95)] if waits else 0.0
+        }
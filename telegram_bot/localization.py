@@ -0,0 +1,167 @@
+import json
+import string
+import threading
+from contextvars import ContextVar
+from pathlib import Path
+
+script_dir = Path(__file__).parent
+TRANSLATION_FILE = script_dir / "translations.json"
+# Language of users who did not choose one, its texts stand in for missing translations
+DEFAULT_LANGUAGE = "en"
+# Text of keys no language has
+MISSING_TRANSLATION = "Translation file missing!"
+
+_formatter = string.Formatter()
+
+class Template:
+    """Text with named placeholders, parsed once when its language is loaded.
+
+    Filling it in only formats the values between the literal parts. Raises
+    ValueError for unbalanced braces and for placeholders that are not a
+    plain name (positional, attribute or index access, conversions, nested
+    format specs).
+    """
+    __slots__ = ("text", "parts", "fields")
+
+    def __init__(self, text):
+        self.text = text
+        parts = []
+        for literal, field, spec, conversion in _formatter.parse(text):
+            if field is not None and (not field.isidentifier() or conversion or "{" in (spec or "")):
+                raise ValueError(f"Unsupported placeholder {{{field}}}")
+            parts.append((literal, field, spec or ""))
+        # Format: ((literal text, placeholder or None, format spec), ...)
+        self.parts = tuple(parts)
+        self.fields = frozenset(field for _, field, _ in parts if field is not None)
+
+    def render(self, values):
+        """Fills in the placeholders, raises KeyError if one of them is not in values."""
+        return "".join([literal if field is None else literal + format(values[field], spec)
+                        for literal, field, spec in self.parts])
+
+class Catalog:
+    """Compiled texts of one language, including the texts of the default language it lacks."""
+    __slots__ = ("language", "messages")
+
+    def __init__(self, language, messages):
+        self.language = language
+        # Format: {key: Template, or the final text if it has no placeholders}
+        self.messages = messages
+
+    def translate(self, key, default=MISSING_TRANSLATION, **kwargs):
+        message = self.messages.get(key, default)
+        if isinstance(message, str):
+            return message
+        if not kwargs:
+            return message.text
+        try:
+            return message.render(kwargs)
+        except KeyError:
+            return f"⚠️ Missing placeholder in translation: {message.text}"
+
+    def text(self, key, default=None):
+        """The text of the key with its placeholders unfilled."""
+        message = self.messages.get(key, default)
+        return message.text if isinstance(message, Template) else message
+
+class Localization:
+    """Translation catalogs shared by the whole bot, a language is compiled when it is first used.
+
+    Compiling checks every text once: invalid placeholders are reported and
+    the text is shown as it is, as are placeholders the text of the default
+    language does not have (the callers do not pass them). Keys a language
+    lacks are answered in the default language.
+    """
+    def __init__(self, filepath=TRANSLATION_FILE, default_language=DEFAULT_LANGUAGE):
+        self.filepath = filepath
+        self.default_language = default_language
+        self._lock = threading.RLock()
+        # Format: {lang_code: {key: text}} of the languages not compiled yet, None until the file is read
+        self._sources = None
+        # Format: {lang_code: Catalog}
+        self.catalogs = {}
+
+    def _read(self):
+        try:
+            with self.filepath.open("r", encoding="utf-8") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"Localization: Could not load {self.filepath}: {e}")
+            return {}
+
+    def catalog(self, language):
+        catalog = self.catalogs.get(language)
+        if catalog is None:
+            with self._lock:
+                catalog = self._load(language)
+        return catalog
+
+    def _load(self, language):
+        if language in self.catalogs:
+            return self.catalogs[language]
+        if self._sources is None:
+            self._sources = self._read()
+        fallback = self._load(self.default_language) if language != self.default_language else None
+        source = self._sources.pop(language, None)
+        if source is None and fallback is not None:
+            # Users of an unknown language are answered in the default language
+            self.catalogs[language] = fallback
+            return fallback
+        catalog = Catalog(language, self._compile(language, source or {}, fallback))
+        self.catalogs[language] = catalog
+        return catalog
+
+    def _compile(self, language, source, fallback):
+        messages = {}
+        for key, text in source.items():
+            if not isinstance(text, str):
+                print(f"Localization: {language}/{key} is not a text, ignoring it")
+                continue
+            try:
+                template = Template(text)
+            except ValueError as e:
+                print(f"Localization: {language}/{key} is shown without placeholders: {e}")
+                messages[key] = text
+                continue
+            reference = fallback.messages.get(key) if fallback is not None else None
+            if reference is not None:
+                unknown = template.fields - (reference.fields if isinstance(reference, Template) else frozenset())
+                if unknown:
+                    print(f"Localization: {language}/{key} uses {', '.join(sorted(unknown))}, which {fallback.language}/{key} does not")
+            messages[key] = template if template.fields else template.render({})
+        if fallback is not None:
+            missing = fallback.messages.keys() - messages.keys()
+            if missing:
+                print(f"Localization: {language} lacks {', '.join(sorted(missing))}, using {fallback.language}")
+                # The texts are shared with the default language, one lookup finds either
+                messages = {**{key: fallback.messages[key] for key in missing}, **messages}
+        return messages
+
+    def get_stats(self):
+        catalogs = {id(catalog): catalog for catalog in self.catalogs.values()}.values()
+        return {
+            "languages": len(catalogs),
+            "messages": sum(len(catalog.messages) for catalog in catalogs)
+        }
+
+class UserLocale:
+    """Language and temperature unit of one user, resolved once per update.
+
+    translate(key, default, **kwargs) is the one of the catalog of the language.
+    """
+    __slots__ = ("user_id", "language", "temp_unit", "catalog", "translate")
+
+    def __init__(self, user_id, language, temp_unit, catalog):
+        self.user_id = user_id
+        self.language = language
+        self.temp_unit = temp_unit
+        self.catalog = catalog
+        self.translate = catalog.translate
+
+# Locale of the user whose update is being handled, set by the bot's callback context
+current_locale = ContextVar("current_locale", default=None)
+
+# Catalogs shared by the whole bot
+localization = Localization()
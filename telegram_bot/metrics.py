@@ -0,0 +1,168 @@
+import os
+import re
+import time
+from bisect import bisect_left
+from http_server import HttpServer
+
+# Address and port of the Prometheus endpoint, METRICS_PORT=0 disables it
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9464))
+METRICS_PATH = "/metrics"
+# Upper bounds of the histogram buckets in seconds, from cache hits to LLM answers
+STAGE_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+class Histogram:
+    """Bucket counts of one stage, made cumulative when rendered."""
+    __slots__ = ("buckets", "counts", "sum", "count", "errors")
+
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        # One more bucket for +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.errors = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def percentile(self, fraction):
+        """Estimates the percentile by interpolating inside its bucket, None without samples."""
+        if self.count == 0:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                # Samples above the largest bucket are reported as its bound
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+class Span:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.histogram.observe(time.perf_counter() - self.start)
+        if exc_type is not None:
+            self.histogram.errors += 1
+        return False
+
+def _metric_name(name):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+class Metrics:
+    """Latency histograms per stage of a request plus the stats of the other components.
+
+    A span costs two perf_counter() calls and a bisect, so it stays enabled in
+    production. Components register a collector returning their get_stats()
+    dict; its numbers are exported as gauges.
+    """
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        # Format: {stage: Histogram}
+        self.stages = {}
+        # Format: {name: function returning a dict}
+        self.collectors = {}
+        self._server = None
+
+    def histogram(self, stage):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = Histogram(self.buckets)
+        return histogram
+
+    def span(self, stage):
+        """Times the block: with metrics.span("coap_request"): ..."""
+        return Span(self.histogram(stage))
+
+    def observe(self, stage, seconds):
+        self.histogram(stage).observe(seconds)
+
+    def error(self, stage):
+        self.histogram(stage).errors += 1
+
+    def add_collector(self, name, collect):
+        self.collectors[name] = collect
+
+    def collect(self):
+        """Returns {name: {key: number}} of all collectors, skipping values that are no numbers."""
+        values = {}
+        for name, collect in self.collectors.items():
+            try:
+                stats = collect()
+            except Exception as e:
+                print(f"Metrics: Collector {name} failed: {e}")
+                continue
+            values[name] = {key: float(value) for key, value in stats.items()
+                            if isinstance(value, (int, float)) and not isinstance(value, bool)}
+        return values
+
+    def render(self):
+        """Returns all metrics in the Prometheus text format."""
+        lines = [
+            "# HELP bot_stage_duration_seconds Time spent in each stage of handling a request",
+            "# TYPE bot_stage_duration_seconds histogram"
+        ]
+        for stage, histogram in sorted(self.stages.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'bot_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'bot_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+            lines.append(f'bot_stage_duration_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'bot_stage_duration_seconds_count{{stage="{stage}"}} {histogram.count}')
+        lines.append("# HELP bot_stage_errors_total Stages that ended with an exception")
+        lines.append("# TYPE bot_stage_errors_total counter")
+        for stage, histogram in sorted(self.stages.items()):
+            lines.append(f'bot_stage_errors_total{{stage="{stage}"}} {histogram.errors}')
+        for name, stats in self.collect().items():
+            for key, value in stats.items():
+                metric = _metric_name(f"bot_{name}_{key}")
+                lines.append(f"# TYPE {metric} gauge")
+                lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Short text of the stage latencies for the /stats command."""
+        lines = []
+        for stage, histogram in sorted(self.stages.items()):
+            if histogram.count == 0:
+                continue
+            p50, p95, p99 = (histogram.percentile(fraction) * 1000 for fraction in (0.5, 0.95, 0.99))
+            errors = f", {histogram.errors} errors" if histogram.errors else ""
+            lines.append(f"{stage}: n={histogram.count}, p50 {p50:.1f} ms, p95 {p95:.1f} ms, p99 {p99:.1f} ms{errors}")
+        return "\n".join(lines)
+
+    async def _serve(self, request):
+        return 200, self.render(), "text/plain; version=0.0.4; charset=utf-8"
+
+    async def start_server(self, listen=METRICS_LISTEN, port=METRICS_PORT):
+        if not port:
+            return
+        self._server = HttpServer(listen, port)
+        self._server.route("GET", METRICS_PATH, self._serve)
+        try:
+            await self._server.start()
+        except OSError as e:
+            print(f"Metrics: Could not start the endpoint on {listen}:{port}: {e}")
+            self._server = None
+
+    async def stop_server(self):
+        if self._server is not None:
+            await self._server.stop()
+            self._server = None
+
+# Metrics shared by the whole bot
+metrics = Metrics()
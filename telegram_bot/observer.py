@@ -0,0 +1,138 @@
+import asyncio
+import os
+from client import coap
+from device_registry import device_registry
+from sensor_cache import sensor_cache, parse_sensor_value
+
+# Resources the bot observes at startup
+OBSERVED_RESOURCES = ["internal_temp", "external_temp", "hum"]
+# Seconds without a notification after which the observation is registered again.
+# The device sends a notification at least every 60 seconds.
+OBSERVE_TIMEOUT = float(os.environ.get("OBSERVE_TIMEOUT", 150))
+# Seconds to wait before registering again after a failure
+OBSERVE_RETRY_DELAY = 10
+# Longest wait before asking again whether a resource that answered without Observe option is observable now
+NOT_OBSERVABLE_MAX_DELAY = 3600
+
+class SensorObserver:
+    """Keeps CoAP Observe (RFC 7641) registrations on the sensor resources alive.
+
+    Every notification is written to the sensor cache with a TTL of
+    OBSERVE_TIMEOUT, so reads are answered from memory as long as the
+    observation delivers. If the device goes quiet (e.g. after a reboot, which
+    loses all registrations), the DTLS session is dropped and the resource is
+    registered again; in the meantime the cache falls back to GET requests.
+    A resource answering without Observe option is marked not observable
+    and read with GET requests like an unobserved one; it is registered
+    again with a delay doubling up to NOT_OBSERVABLE_MAX_DELAY, e.g. in case
+    the device is updated. Only devices with "observe" set in the registry
+    are observed.
+    """
+    def __init__(self, client=coap, cache=sensor_cache, resources=OBSERVED_RESOURCES, timeout=OBSERVE_TIMEOUT, registry=device_registry):
+        self.client = client
+        self.cache = cache
+        self.resources = resources
+        self.timeout = timeout
+        self.registry = registry
+        # Format: {(device name, resource): Task}
+        self._tasks = {}
+        # Format: {(device name, resource): seconds until the next registration}
+        self.not_observable = {}
+        self.stats = {
+            "registrations": 0,
+            "notifications": 0,
+            "timeouts": 0,
+            "errors": 0,
+            "not_observable": 0
+        }
+
+    def start(self):
+        for device in self.registry:
+            if not device.observe:
+                continue
+            for resource in self.resources:
+                if resource in device.resources and (device.name, resource) not in self._tasks:
+                    self._tasks[(device.name, resource)] = asyncio.create_task(self._observe_forever(device, resource))
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        self._tasks.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def is_observing(self, resource, device=None):
+        device = self.registry.get(device).name
+        key = (device, resource)
+        return key in self._tasks and key not in self.not_observable and self.cache.is_fresh(resource, device)
+
+    async def _observe_forever(self, device, resource):
+        key = (device.name, resource)
+        while True:
+            try:
+                if not await self._observe(device, resource):
+                    delay = self.not_observable.get(key, OBSERVE_RETRY_DELAY / 2) * 2
+                    self.not_observable[key] = min(delay, NOT_OBSERVABLE_MAX_DELAY)
+                    print(f"Observer: {device.name}/{resource} is not observable, reading it on demand and registering again in {self.not_observable[key]:g} s")
+                    await asyncio.sleep(self.not_observable[key])
+                    continue
+            except asyncio.TimeoutError:
+                self.stats["timeouts"] += 1
+                print(f"Observer: No notification for {device.name}/{resource} within {self.timeout} s, registering again")
+                self.client.drop_session(device)
+            except ValueError as e:
+                self.stats["errors"] += 1
+                print(f"Observer: Invalid configuration or payload for {device.name}/{resource}: {e}")
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"Observer: Observation of {device.name}/{resource} failed: {e}")
+                self.client.drop_session(device)
+            self.cache.release(resource, device.name)
+            await asyncio.sleep(OBSERVE_RETRY_DELAY)
+
+    async def _observe(self, device, resource):
+        """Delivers the notifications until the observation ends, returns False if the resource is not observable."""
+        request = await self.client.observe(resource, device)
+        try:
+            response = await asyncio.wait_for(request.response, self.timeout)
+            if response.opt.observe is None:
+                if not response.code.is_successful():
+                    print(f"Observer: {device.name}/{resource} answered with {response.code}")
+                    return True
+                self.stats["not_observable"] += 1
+                # A plain reading, it ages like one fetched with GET
+                self.client.report_alive(device)
+                self.cache.put(resource, parse_sensor_value(response.payload.decode('utf-8')), device=device.name)
+                return False
+            self.stats["registrations"] += 1
+            self.not_observable.pop((device.name, resource), None)
+            self._update(device, resource, response)
+
+            notifications = request.observation.__aiter__()
+            while True:
+                try:
+                    response = await asyncio.wait_for(notifications.__anext__(), self.timeout)
+                except StopAsyncIteration:
+                    print(f"Observer: Device ended the observation of {device.name}/{resource}")
+                    return True
+                self.stats["notifications"] += 1
+                self._update(device, resource, response)
+        finally:
+            if not request.observation.cancelled:
+                request.observation.cancel()
+
+    def _update(self, device, resource, response):
+        if not response.code.is_successful():
+            print(f"Observer: {device.name}/{resource} answered with {response.code}")
+            return
+        self.client.report_alive(device)
+        value = parse_sensor_value(response.payload.decode('utf-8'))
+        self.cache.put(resource, value, ttl=self.timeout, device=device.name)
+
+    def get_stats(self):
+        observed = [f"{device}/{resource}" for device, resource in self._tasks if self.is_observing(resource, device)]
+        return {**self.stats, "observed": observed,
+                "unobservable": [f"{device}/{resource}" for device, resource in self.not_observable]}
+
+# Observer shared by the whole bot
+sensor_observer = SensorObserver()
@@ -0,0 +1,82 @@
+import asyncio
+import os
+from sensor_cache import sensor_cache, SENSOR_CACHE_TTL
+
+# Seconds a prefetched reading waits for the user to choose it, at most the TTL of the sensor cache
+PREFETCH_TTL = float(os.environ.get("PREFETCH_TTL", SENSOR_CACHE_TTL))
+# Sensors offered by the temperature chooser
+TEMPERATURE_RESOURCES = ("internal_temp", "external_temp")
+
+class Prefetcher:
+    """Readings fetched per chat and user while the user still decides which one to ask for.
+
+    When a keyboard of sensors is shown, start() fetches all of them in the
+    background; the button callback takes the one chosen and answers without
+    waiting for the device. The replies are formatted in the language and
+    unit of the user who opened the keyboard, so in groups only this user
+    gets them. Readings are not kept longer than the sensor cache would keep
+    them; those not taken in time or whose sibling was chosen instead count
+    as wasted.
+    """
+    def __init__(self, ttl=PREFETCH_TTL, cache=sensor_cache):
+        self.ttl = ttl
+        self.cache = cache
+        # Format: {(chat_id, user_id, resource): Task}
+        self.entries = {}
+        self.stats = {
+            "started": 0,
+            "hits": 0,
+            "misses": 0,
+            "wasted": 0,
+            "errors": 0
+        }
+
+    def start(self, chat_id, user_id, resources, fetch):
+        """Starts fetch(resource) for every resource, replacing earlier prefetches of the user in the chat."""
+        loop = asyncio.get_running_loop()
+        for resource in resources:
+            key = (chat_id, str(user_id), resource)
+            self._discard(key)
+            task = asyncio.ensure_future(fetch(resource))
+            task.add_done_callback(self._done)
+            self.entries[key] = task
+            self.stats["started"] += 1
+            loop.call_later(min(self.ttl, self.cache.get_ttl(resource)), self._expire, key, task)
+
+    def take(self, chat_id, user_id, resource, siblings=TEMPERATURE_RESOURCES):
+        """Returns the task of the prefetched reading or None, the other readings of the user in the chat are dropped."""
+        user_id = str(user_id)
+        task = self.entries.pop((chat_id, user_id, resource), None)
+        if task is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        for sibling in siblings:
+            if sibling != resource:
+                self._discard((chat_id, user_id, sibling))
+        return task
+
+    def _discard(self, key):
+        task = self.entries.pop(key, None)
+        if task is not None:
+            # Not cancelled, a reading still in flight ends up in the sensor cache
+            self.stats["wasted"] += 1
+
+    def _expire(self, key, task):
+        if self.entries.get(key) is task:
+            self._discard(key)
+
+    def _done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            self.stats["errors"] += 1
+
+    def get_stats(self):
+        taken = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "pending": len(self.entries),
+            "hit_ratio": self.stats["hits"] / taken if taken else 0.0
+        }
+
+# Prefetches shared by the whole bot
+prefetcher = Prefetcher()
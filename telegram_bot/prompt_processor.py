@@ -1,14 +1,76 @@
 import json
 from ollama import AsyncClient
-import subprocess
 import asyncio
-from client import coap_client
+import os
+import re
+import time
+from collections import deque
+from sensor_cache import sensor_cache
+from device_registry import device_registry
+from intent_classifier import normalize_text
 from settings_handler import Settings
+from intent_classifier import IntentClassifier
+from action_cache import ActionCache, make_fingerprint
+from llm_scheduler import LLMScheduler
+from metrics import metrics
+from client import DEVICE_ERRORS, SNAPSHOT_RESOURCE
+from action_extractor import ActionExtractor
+from resource_discovery import resource_discovery
+
+# Address of the Ollama server, the default of the ollama package if unset
+OLLAMA_HOST = os.environ.get("OLLAMA_HOST")
+# How long Ollama keeps the model loaded after a request
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+# Seconds between two keep-warm pings, 0 disables them
+OLLAMA_KEEP_WARM_INTERVAL = float(os.environ.get("OLLAMA_KEEP_WARM_INTERVAL", 0))
+# Requests with a longer model load time count as cold starts
+COLD_START_THRESHOLD = 0.5
+# Stream the answer and act as soon as the action is known, 0 waits for the whole answer
+LLM_STREAM = os.environ.get("LLM_STREAM", "1") != "0"
+# Most tokens the LLM may generate, the longest answer with a device parameter needs about 25
+LLM_NUM_PREDICT = int(os.environ.get("LLM_NUM_PREDICT", 48))
+
+def format_age(seconds):
+    """Short age like '45 s', '12 min', '3 h' or '2 d'."""
+    if seconds < 60:
+        return f"{int(seconds)} s"
+    if seconds < 60 * 60:
+        return f"{int(seconds // 60)} min"
+    if seconds < 24 * 60 * 60:
+        return f"{int(seconds // 3600)} h"
+    return f"{int(seconds // 86400)} d"
+
+# Resources of the firmware that have their own actions, other discovered resources become get_<name>
+KNOWN_RESOURCE_ACTIONS = {
+    "internal_temp": "get_internal_temp",
+    "external_temp": "get_external_temp",
+    "hum": "humidity"
+}
+# Resources read by the sensor actions, used to label the lines of a reply to several actions
+ACTION_RESOURCES = {
+    "get_internal_temp": "internal_temp",
+    "get_external_temp": "external_temp",
+    "humidity": "hum",
+    "get_humidity": "hum"
+}
+# Next to other actions the generic temperature stands for both temperature sensors
+TEMPERATURE_ACTIONS = ("get_internal_temp", "get_external_temp")
 
 class Prompt_Processor:
-    def __init__(self, model="llama3.2:1b-instruct-q4_0", num_predict=None, format="json"):
+    def __init__(self, model="llama3.2:1b-instruct-q4_0", num_predict=LLM_NUM_PREDICT, format="json", host=OLLAMA_HOST, keep_alive=OLLAMA_KEEP_ALIVE, keep_warm_interval=OLLAMA_KEEP_WARM_INTERVAL, stream=LLM_STREAM):
         self.model = model
-        self.stream = False
+        self.stream = stream
+        # One client for all requests, its connection pool is reused
+        self.client = AsyncClient(host=host)
+        self.keep_alive = keep_alive
+        self.keep_warm_interval = keep_warm_interval
+        self._keep_warm_task = None
+        self._warm_up_task = None
+        # Timings of the last LLM requests in seconds
+        # Format: [{"load": float, "first_token": float, "generation": float, "total": float}]
+        self.llm_timings = deque(maxlen=100)
+        # Seconds the last warm-ups took to load the model, a reload shows up here even without requests
+        self.warm_up_loads = deque(maxlen=100)
         if num_predict:
             self.options = {
                 "num_predict": num_predict
@@ -16,7 +78,7 @@ class Prompt_Processor:
         else:
             self.options = {}
         self.format = format
-        self.system_description = (
+        self.base_description = (
             'You are a helpful assistant that processes user requests and responds strictly in JSON format. Analyze the input and select the MOST SPECIFIC action from the allowed list below: '
             # Allowed Actions: 
             '1. **unknown**: Use if the request is unclear, ambiguous, or unrelated to defined actions. '
@@ -25,11 +87,12 @@ class Prompt_Processor:
             '4. **get_internal_temp**: Use if the request explicitly or contextually refers to **indoor temperature** (e.g., inside a room, building, or device). '
             '5. **get_external_temp**: Use if the request explicitly or contextually refers to **outdoor temperature** (e.g., outside, weather, environment). '
             '6, **temperature**: Use if the request explicitly or contextually refers to **temperature** (e.g., hot, cold, warm). '
-            # Response Format: 
-            'Always respond in JSON format with the chosen action and empty parameters: '
-            '```json '
-            '{"action": "action_name"} '
         )
+        self.devices = device_registry
+        # Actions of discovered resources without an own action
+        # Format: {action: (resource, description)}
+        self.discovered_actions = {}
+        self.system_description = self.build_system_description()
 
         self.function_registry = {
             "get_temperature": self.get_temperature,
@@ -44,18 +107,102 @@ class Prompt_Processor:
             "get_humidity": self.get_humidity
         }
         self.settings = Settings()
+        self.sensor_cache = sensor_cache
+        self.classifier = IntentClassifier(self.system_description)
+        self.action_cache = ActionCache(make_fingerprint(self.model, self.system_description))
+        self.scheduler = LLMScheduler()
+        self.discovery = resource_discovery
+        self.discovery.add_listener(self.register_resources)
 
-    async def get_internal_temp(self, user_id, **kwargs):
-        return await self.get_sensor_value(user_id, resource="internal_temp")
+    def build_system_description(self):
+        """Returns the system prompt with the actions of the discovered resources."""
+        description = self.base_description
+        for number, (action, (resource, label)) in enumerate(sorted(self.discovered_actions.items()), start=7):
+            description += f'{number}. **{action}**: Use if the request explicitly or contextually refers to **{label}** (e.g., {label}). '
+        # Response Format: 
+        description += (
+            'Always respond in JSON format with the chosen action and empty parameters: '
+            '```json '
+            '{"action": "action_name"} '
+            '``` '
+            'If the user asks for several measurements at once, list all of them. A place like inside or outside only chooses the temperature sensor, it is no measurement of its own: '
+            '```json '
+            '{"actions": [{"action": "action_name"}, {"action": "action_name"}]} '
+        )
+        if len(self.devices) > 1:
+            # Optional device parameter
+            description += (
+                '``` '
+                f'If the user names one of the devices {", ".join(device.name for device in self.devices)} or all of them, add it as parameter: '
+                '```json '
+                '{"action": "action_name", "parameters": {"device": "device_name or all"}} '
+            )
+        return description
+
+    def register_resources(self, device, links):
+        """Called by the resource discovery, adds an action for every resource without one."""
+        discovered = {}
+        for device_links, _ in self.discovery.links.values():
+            for link in device_links:
+                resource = link["path"]
+                if resource in KNOWN_RESOURCE_ACTIONS or resource == SNAPSHOT_RESOURCE:
+                    continue
+                name = re.sub(r"\W+", "_", resource).strip("_").lower()
+                label = normalize_text(str(link.get("rt", name)).replace("_", " "))
+                if name and label:
+                    discovered[f"get_{name}"] = (resource, label)
+        for action in self.discovered_actions.keys() - discovered.keys():
+            self.function_registry.pop(action, None)
+        for action, (resource, _) in discovered.items():
+            if action not in self.function_registry or action in self.discovered_actions:
+                self.function_registry[action] = self.make_resource_action(resource)
+        if discovered == self.discovered_actions:
+            return
+        self.discovered_actions = discovered
+        self.system_description = self.build_system_description()
+        self.action_cache.set_fingerprint(make_fingerprint(self.model, self.system_description))
+        print(f"Prompt processor: Actions of discovered resources: {', '.join(sorted(discovered)) or 'none'}")
+        self.rebuild_classifier()
+
+    def rebuild_classifier(self):
+        """Builds the classifier for the current system prompt, off the event loop as it reads its rule files.
+
+        The example words of the prompt become classifier rules, the old
+        classifier answers until the new one is ready.
+        """
+        description = self.system_description
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.classifier = IntentClassifier(description)
+            return
 
-    async def get_external_temp(self, user_id, **kwargs):
-        return await self.get_sensor_value(user_id, resource="external_temp")
+        def done(future):
+            if future.cancelled():
+                return
+            if future.exception() is not None:
+                print(f"Prompt processor: Could not build the intent classifier: {future.exception()!r}")
+            elif description == self.system_description:
+                # Not replaced by a newer prompt in the meantime
+                self.classifier = future.result()
+        loop.run_in_executor(None, IntentClassifier, description).add_done_callback(done)
+
+    def make_resource_action(self, resource):
+        async def get_resource_value(user_id, device=None, **kwargs):
+            return await self.get_sensor_value(user_id, resource=resource, device=device)
+        return get_resource_value
+
+    async def get_internal_temp(self, user_id, device=None, **kwargs):
+        return await self.get_sensor_value(user_id, resource="internal_temp", device=device)
+
+    async def get_external_temp(self, user_id, device=None, **kwargs):
+        return await self.get_sensor_value(user_id, resource="external_temp", device=device)
 
     async def get_temperature(self, user_id, **kwargs):
         return "choose_temperature_sensor"
 
-    async def get_humidity(self, user_id, **kwargs):
-        return await self.get_sensor_value(user_id, resource="hum")
+    async def get_humidity(self, user_id, device=None, **kwargs):
+        return await self.get_sensor_value(user_id, resource="hum", device=device)
 
     def convert_temperature_unit(self, temperature, unit):
         # Temperature is already in Celsius
@@ -65,65 +212,294 @@ class Prompt_Processor:
         elif unit.lower() == "f":
             return (temperature * 9/5) + 32
 
-    async def get_sensor_value(self, user_id, resource, **kwargs):
-        """Calls the method coap_client async."""
+    def format_sensor_value(self, user_id, resource, value):
+        """Formats a raw sensor value in the unit preferred by the user."""
+        if resource == 'hum':
+            temp_unit = "%"
+            temperature = value
+        elif "temp" not in resource:
+            # Discovered resource of unknown unit
+            return f"{value:g}" if isinstance(value, float) else str(value)
+        else:
+            temp_unit = self.settings.get_locale(user_id).temp_unit
+            temperature = round(self.convert_temperature_unit(value, temp_unit), 2)
+            temp_unit = '°' + temp_unit
+        return f"{temperature} {temp_unit.upper()}"
+
+    def get_user_device(self, user_id, device=None):
+        """Returns the named device, else the one the user selected (a device name or "all"), else None for the default device."""
+        if device is None:
+            device = self.settings.get_user_setting(str(user_id), "device")
+            if device != "all" and device not in self.devices.devices:
+                # The selected device was removed from devices.json
+                device = None
+        return device
+
+    def label_device(self, device, text):
+        # Readings are only labelled if there is more than one device
+        if len(self.devices) > 1:
+            return f"{device.friendly_name}: {text}"
+        return text
+
+    async def get_sensor_value(self, user_id, resource, device=None, **kwargs):
+        """Reads the sensor value of the device through the shared sensor cache."""
+        device = self.get_user_device(user_id, device)
+        if str(device).lower() == "all":
+            return await self.get_sensor_values(user_id, resource)
+        locale = self.settings.get_locale(user_id)
         try:
-            response = await coap_client(resource) # external_temp or internal_temp
-            if response is not None:
-                try:
-                    if resource == 'hum':
-                        temp_unit = "%"
-                        temperature = response
-                    else:
-                        temp_unit = self.settings.get_user_temp_unit(str(user_id))
-                        temperature = self.convert_temperature_unit(float(response),temp_unit)
-                        temp_unit = '°' + temp_unit
-                except ValueError as e:
-                    print(f"Prompt processor: Sensor value is not a number: {response}")
-                    raise e
-                response = f"{temperature} {temp_unit.upper()}"
-                return response
-            else:
-                print("Prompt processor: Connection established, but no data received.")
-                return None
-            
+            device = self.devices.get(device)
+        except KeyError:
+            return locale.translate("unknown_device", device=device)
+        try:
+            value = await self.sensor_cache.get(resource, device.name) # external_temp or internal_temp
+            return self.label_device(device, self.format_sensor_value(user_id, resource, value))
+
+        except DEVICE_ERRORS as e:
+            print(f"Prompt processor: {device.name} does not answer: {e!r}")
+            stale = self.format_stale_value(user_id, resource, device.name)
+            if stale is None:
+                raise e
+            return self.label_device(device, stale)
+
         except ValueError as e:
-            print("Prompt processor: Environment variable COAP_SERVER_IP is not set")
+            print(f"Prompt processor: Sensor value is not a number or COAP_SERVER_IP is not set: {e}")
             raise e
         
         except Exception as e:
             print(f"Prompt processor: get_sensor_value returned exception: {e}")
             if "No suitable credentials" in str(e):
-                return self.settings.get_translation(self.settings.get_user_language(str(user_id)),"coap_credentials_error")
+                return self.settings.get_locale(user_id).translate("coap_credentials_error")
             else:
                 raise e
 
         
-    async def get_resource(self, user_id, **kwargs):
-        try:
-            result = subprocess.run(['python3', 'client.py'], capture_output=True, text=True)
-            return result.stdout
-        except Exception as e:
-            return self.settings.get_translation(self.settings.get_user_language(str(user_id)),"unknown_command",error=e)
+    def format_stale_value(self, user_id, resource, device=None):
+        """Formats the last known value with its age, None if the device never answered."""
+        entry = self.sensor_cache.peek(resource, device)
+        if entry is None:
+            return None
+        value, timestamp = entry
+        return self.settings.get_locale(user_id).translate("stale_value",
+            value=self.format_sensor_value(user_id, resource, value), age=format_age(time.time() - timestamp))
+
+    async def get_sensor_values(self, user_id, resource):
+        """Reads the resource of all devices at once, devices that fail or time out are reported as such."""
+        locale = self.settings.get_locale(user_id)
+        devices = [device for device in self.devices if resource in device.resources]
+        results = await self.devices.fan_out(lambda device: self.sensor_cache.get(resource, device.name), devices)
+        lines = []
+        for device in devices:
+            result = results[device.name]
+            if isinstance(result, DEVICE_ERRORS) and self.sensor_cache.peek(resource, device.name) is not None:
+                text = self.format_stale_value(user_id, resource, device.name)
+            elif isinstance(result, asyncio.TimeoutError):
+                text = locale.translate("device_timeout")
+            elif isinstance(result, Exception):
+                print(f"Prompt processor: {device.name}/{resource} failed: {result}")
+                text = locale.translate("device_error")
+            else:
+                text = self.format_sensor_value(user_id, resource, result)
+            lines.append(f"{device.friendly_name}: {text}")
+        return "\n".join(lines)
 
+    async def get_resource(self, user_id, device=None, **kwargs):
+        """Lists the resources the device announced in its /.well-known/core."""
+        locale = self.settings.get_locale(user_id)
+        device = self.get_user_device(user_id, device)
+        devices = list(self.devices) if str(device).lower() == "all" else None
+        if devices is None:
+            try:
+                devices = [self.devices.get(device)]
+            except KeyError:
+                return locale.translate("unknown_device", device=device)
+        lines = []
+        for device in devices:
+            links = self.discovery.get_links(device.name)
+            if not links:
+                try:
+                    links = await self.discovery.discover(device)
+                except DEVICE_ERRORS as e:
+                    print(f"Prompt processor: Could not discover the resources of {device.name}: {e!r}")
+            if links:
+                text = locale.translate("resources_list", resources=", ".join("/" + link["path"] for link in links))
+            else:
+                text = locale.translate("no_resources")
+            lines.append(self.label_device(device, text))
+        return "\n".join(lines)
 
     def unknown(self, user_id, **kwargs):
-        return self.settings.get_translation(self.settings.get_user_language(str(user_id)),"unknown_command")
+        return self.settings.get_locale(user_id).translate("unknown_command")
 
     def help(self, user_id, **kwargs):
-        return self.settings.get_translation(self.settings.get_user_language(str(user_id)),"help")
+        return self.settings.get_locale(user_id).translate("help")
 
     def unavailable(self, user_id, **kwargs):
-        return self.settings.get_translation(self.settings.get_user_language(str(user_id)),"llm_unavailable")
+        return self.settings.get_locale(user_id).translate("llm_unavailable")
 
-    async def process(self, prompt):
+    async def process(self, prompt, user_id=None):
         print("Received prompt: " + prompt)
         if prompt.lower() in self.function_registry:
             return prompt.lower()
-        response = await AsyncClient().generate(model=self.model, prompt=prompt, stream=self.stream, system=self.system_description, options=self.options, format=self.format)
-        return response['response']
+        # Common requests are answered without the LLM
+        with metrics.span("classifier"):
+            action, confidence = self.classifier.classify(prompt)
+        if self.classifier.is_confident(confidence):
+            print(f"Classified locally: {action} ({confidence:.2f})")
+            device = self.devices.find_in_text(normalize_text(prompt))
+            parameters = {"device": device.name} if device is not None else {}
+            if isinstance(action, list):
+                return {"actions": [{"action": name, "parameters": parameters} for name in action]}
+            if parameters:
+                return {"action": action, "parameters": parameters}
+            return action
+        # Repeated requests are answered from earlier classifications
+        with metrics.span("action_cache"):
+            action_data = await self.action_cache.get(prompt)
+        if action_data is not None:
+            print(f"Classification from cache: {action_data}")
+            return action_data
+        # Raises SchedulerBusy if the LLM cannot answer in time
+        action_data = await self.scheduler.submit(user_id, lambda: self.classify_with_llm(prompt))
+        if self.is_known(action_data):
+            self.action_cache.put(prompt, action_data)
+        return action_data
 
-    def parse_json(self, str) -> str:
+    def is_known(self, action_data):
+        """True if the action data only names actions of the function registry."""
+        if not isinstance(action_data, dict):
+            return False
+        if isinstance(action_data.get("actions"), list):
+            return bool(action_data["actions"]) and all(
+                isinstance(item, dict) and item.get("action") in self.function_registry for item in action_data["actions"])
+        return action_data.get("action") in self.function_registry
+
+    async def classify_with_llm(self, prompt):
+        """Asks the LLM for the action data and records the time to the action of both modes."""
+        start = time.perf_counter()
+        if self.stream:
+            action_data = await self.generate_action(prompt)
+        else:
+            response = await self.generate(prompt)
+            action_data = self.parse_json(response['response'])
+        metrics.observe("llm_action_stream" if self.stream else "llm_action_blocking", time.perf_counter() - start)
+        return action_data
+
+    async def generate(self, prompt, **kwargs):
+        """Sends the prompt to Ollama and records how long loading and generating took."""
+        start = time.perf_counter()
+        with metrics.span("llm"):
+            response = await self.client.generate(model=self.model, prompt=prompt, stream=False, system=self.system_description, options=self.options, format=self.format, keep_alive=self.keep_alive, **kwargs)
+        self.record_timing(response, time.perf_counter() - start)
+        return response
+
+    async def generate_action(self, prompt):
+        """Streams the answer and returns the action data as soon as the action is known.
+
+        Closing the stream closes the connection, which makes Ollama stop
+        generating the rest of the answer.
+        """
+        start = time.perf_counter()
+        first_token = None
+        action_data = None
+        last_chunk = {}
+        # The device parameter only matters if there is more than one device
+        extractor = ActionExtractor(self.function_registry, wait_for_parameters=len(self.devices) > 1)
+        with metrics.span("llm"):
+            stream = await self.client.generate(model=self.model, prompt=prompt, stream=True, system=self.system_description, options=self.options, format=self.format, keep_alive=self.keep_alive)
+            try:
+                async for chunk in stream:
+                    if first_token is None:
+                        first_token = time.perf_counter() - start
+                    last_chunk = chunk
+                    action_data = extractor.feed(chunk.get('response', ''))
+                    if action_data is not None or chunk.get('done'):
+                        break
+            finally:
+                await stream.aclose()
+        if action_data is None:
+            action_data = extractor.result()
+        total = time.perf_counter() - start
+        first_token = first_token if first_token is not None else total
+        if last_chunk.get('done'):
+            load = last_chunk.get('load_duration', 0) / 1e9
+        else:
+            # Ollama only reports its durations at the end of the answer, which is cut off here. The first token
+            # comes after loading the model and reading the prompt, the delay beyond the fastest earlier answer
+            # without loading is taken as the load time.
+            fastest = min((timing["first_token"] - timing["load"] for timing in self.llm_timings), default=first_token)
+            load = max(first_token - fastest, 0.0)
+        self.llm_timings.append({"load": load, "first_token": first_token, "generation": total - first_token, "total": total})
+        cold = " (cold start)" if load > COLD_START_THRESHOLD else ""
+        print(f"LLM timing (stream){cold}: load {load:.2f} s, first token {first_token:.2f} s, action after {total:.2f} s")
+        return action_data
+
+    def record_timing(self, response, wall_time):
+        # Ollama reports durations in nanoseconds
+        load = response.get('load_duration', 0) / 1e9
+        prompt_eval = response.get('prompt_eval_duration', 0) / 1e9
+        timing = {
+            "load": load,
+            "first_token": load + prompt_eval,
+            "generation": response.get('eval_duration', 0) / 1e9,
+            "total": wall_time
+        }
+        self.llm_timings.append(timing)
+        cold = " (cold start)" if load > COLD_START_THRESHOLD else ""
+        print(f"LLM timing{cold}: load {timing['load']:.2f} s, first token {timing['first_token']:.2f} s, "
+              f"generation {timing['generation']:.2f} s, total {timing['total']:.2f} s")
+
+    async def warm_up(self):
+        """Loads the model into memory, an empty prompt makes Ollama only load it."""
+        try:
+            start = time.perf_counter()
+            response = await self.client.generate(model=self.model, prompt="", keep_alive=self.keep_alive)
+            load = response.get('load_duration', 0) / 1e9
+            self.warm_up_loads.append(load)
+            print(f"LLM warm-up: {self.model} loaded in {load:.2f} s "
+                  f"({time.perf_counter() - start:.2f} s total)")
+        except Exception as e:
+            print(f"LLM warm-up failed: {e}")
+
+    async def _keep_warm(self):
+        while True:
+            await asyncio.sleep(self.keep_warm_interval)
+            await self.warm_up()
+
+    async def start(self):
+        """Called on startup, loads the model in the background."""
+        if self.keep_warm_interval > 0:
+            self._keep_warm_task = asyncio.create_task(self._keep_warm())
+        self._warm_up_task = asyncio.create_task(self.warm_up())
+
+    async def close(self):
+        """Called on shutdown."""
+        tasks = [task for task in (self._keep_warm_task, self._warm_up_task) if task is not None]
+        self._keep_warm_task = self._warm_up_task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.action_cache.save()
+        # The ollama package has no public close, the httpx client is its _client
+        http_client = getattr(self.client, "_client", None)
+        if http_client is not None:
+            await http_client.aclose()
+
+    def get_llm_stats(self):
+        timings = list(self.llm_timings)
+        # Model loads seen by requests and by warm-ups
+        cold_starts = (sum(1 for timing in timings if timing["load"] > COLD_START_THRESHOLD)
+                       + sum(1 for load in self.warm_up_loads if load > COLD_START_THRESHOLD))
+        stats = {"requests": len(timings), "warm_ups": len(self.warm_up_loads), "cold_starts": cold_starts}
+        if timings:
+            stats.update({f"mean_{key}": sum(timing[key] for timing in timings) / len(timings) for key in timings[0]})
+        return stats
+
+    def parse_json(self, str) -> dict:
+        if isinstance(str, list):
+            return {"actions": str}
+        if isinstance(str, dict):
+            return str
         try:
             data = json.loads(str)
             return data
@@ -131,14 +507,23 @@ class Prompt_Processor:
             data = json.loads('{"action": "unknown", "parameters": {}}')
             return data
 
+    async def run_action(self, action, parameters, user_id):
+        function = self.function_registry[action]
+        if asyncio.iscoroutinefunction(function):
+            return await function(user_id, **parameters)
+        return function(user_id, **parameters)
+
     async def process_action(self, response, user_id):
-        print("Received response: " + response)
+        """Executes the action, response is an action name or the (parsed) JSON answer of the LLM."""
+        print(f"Received response: {response}")
         parameters = {}
-        if response in self.function_registry:
+        if isinstance(response, str) and response in self.function_registry:
             action = response
         else:
             action_data = self.parse_json(response)
             try:
+                if isinstance(action_data.get("actions"), list):
+                    return await self.process_actions(action_data["actions"], user_id)
                 action = action_data.get("action", "unknown")
                 parameters = action_data.get("parameters", {})
             except Exception:
@@ -147,12 +532,62 @@ class Prompt_Processor:
         print("Executed action: " + action)
         if action in self.function_registry:
             try:
-                if asyncio.iscoroutinefunction(self.function_registry[action]):
-                    result = await self.function_registry[action](user_id, **parameters)                
-                else:
-                    result = self.function_registry[action](user_id, **parameters)
+                with metrics.span("action"):
+                    result = await self.run_action(action, parameters, user_id)
                 return result
             except TypeError as e:
-                return self.unknown()
+                return self.unknown(user_id)
         else:
-            return self.unknown()
+            return self.unknown(user_id)
+
+    def action_label(self, action, language):
+        """Name of the sensor the action reads, None for other actions."""
+        resource = ACTION_RESOURCES.get(action)
+        if resource is not None:
+            return self.settings.get_translation(language, resource, default=resource)
+        if action in self.discovered_actions:
+            return self.discovered_actions[action][1]
+        return None
+
+    async def process_actions(self, actions, user_id):
+        """Executes several actions at once and returns one reply with a line per action.
+
+        Actions that call the same function with the same parameters run only
+        once, reads of the same device share one request through the sensor
+        cache, so the reply takes about as long as the slowest read.
+        """
+        locale = self.settings.get_locale(user_id)
+        # Format: {(function, parameters as JSON): (action, parameters)}
+        calls = {}
+        for item in actions:
+            if isinstance(item, str):
+                item = {"action": item}
+            if not isinstance(item, dict) or not isinstance(item.get("parameters") or {}, dict):
+                continue
+            parameters = item.get("parameters") or {}
+            names = TEMPERATURE_ACTIONS if item.get("action") in ("temperature", "get_temperature") else (item.get("action"),)
+            for name in names:
+                if name in self.function_registry:
+                    calls.setdefault((self.function_registry[name], json.dumps(parameters, sort_keys=True)), (name, parameters))
+        if len(calls) <= 1:
+            action, parameters = next(iter(calls.values()), ("unknown", {}))
+            return await self.process_action({"action": action, "parameters": parameters}, user_id)
+
+        print(f"Executed actions: {', '.join(action for action, _ in calls.values())}")
+        with metrics.span("action"):
+            results = await asyncio.gather(*(self.run_action(action, parameters, user_id) for action, parameters in calls.values()),
+                                           return_exceptions=True)
+        lines = []
+        for (action, _), result in zip(calls.values(), results):
+            if isinstance(result, DEVICE_ERRORS):
+                text = locale.translate("connection_failed")
+            elif isinstance(result, TypeError):
+                text = self.unknown(user_id)
+            elif isinstance(result, Exception):
+                print(f"Prompt processor: {action} failed: {result!r}")
+                text = locale.translate("unknown_error", error=str(result))
+            else:
+                text = str(result)
+            label = self.action_label(action, locale.language)
+            lines.append(f"{label}: {text}" if label else text)
+        return "\n".join(lines)
@@ -0,0 +1,248 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+from client import SNAPSHOT_RESOURCE
+from device_registry import device_registry
+from sensor_cache import sensor_cache
+from settings_handler import Settings
+from workers import owns
+
+# Reports one user may subscribe to
+REPORT_MAX_SUBSCRIPTIONS = int(os.environ.get("REPORT_MAX_SUBSCRIPTIONS", 5))
+# Words for a report every hour, anything else is a time of day
+HOURLY = ("hourly", "stündlich")
+
+class Subscription:
+    """One periodic report of a user, every hour or every day at hour:minute (local time)."""
+    __slots__ = ("user_id", "id", "device", "hourly", "hour", "minute")
+
+    def __init__(self, user_id, id, device, hourly, hour=0, minute=0):
+        self.user_id = user_id
+        self.id = id
+        self.device = device
+        self.hourly = hourly
+        self.hour = hour
+        self.minute = minute
+
+    @classmethod
+    def from_dict(cls, user_id, data):
+        return cls(user_id, data["id"], data["device"], data["hourly"], data.get("hour", 0), data.get("minute", 0))
+
+    def to_dict(self):
+        return {"id": self.id, "device": self.device, "hourly": self.hourly, "hour": self.hour, "minute": self.minute}
+
+    def is_due(self, now):
+        return now.minute == self.minute and (self.hourly or now.hour == self.hour)
+
+class ReportScheduler:
+    """Sends the users their subscribed reports with all readings of their device.
+
+    Subscriptions are indexed by the minute they are due, a tick only looks
+    at the ones due now. Every sensor of the due reports is read once per
+    tick however many users subscribed, the messages are then formatted per
+    user from these readings in the language and unit of the user. The
+    subscriptions are stored with the user settings under "reports". With
+    several workers every one knows the subscriptions of all users but only
+    sends the reports of the users it owns.
+    """
+    def __init__(self, cache=sensor_cache, settings=None, registry=device_registry, owns=owns):
+        self.cache = cache
+        self.settings = settings or Settings()
+        self.registry = registry
+        self.owns = owns
+        # Format: {user_id: [Subscription]}
+        self.subscriptions = {}
+        # Format: {minute: [Subscription]}
+        self._due = {}
+        # Sends a text to a user, set by the bot
+        self.send = None
+        # Formats (user_id, resource, value) in the unit of the user, set by the bot
+        self.format_value = lambda user_id, resource, value: f"{value:g}"
+        self._task = None
+        # Ticks still sending their reports
+        self._ticks = set()
+        # Minute the last tick ran for, a minute is never ticked twice
+        self._last_minute = None
+        self.stats = {
+            "ticks": 0,
+            "reads": 0,
+            "reports": 0,
+            "send_errors": 0
+        }
+
+    def load(self):
+        """Builds the index from the subscriptions in the user settings."""
+        self.subscriptions.clear()
+        self._due.clear()
+        self.sync()
+
+    def sync(self):
+        """Takes over the subscriptions that changed in the user settings."""
+        user_settings = self.settings.user_settings
+        for user_id in set(self.subscriptions) | set(user_settings):
+            data = user_settings.get(user_id, {}).get("reports", [])
+            subscriptions = self.subscriptions.pop(user_id, [])
+            if [subscription.to_dict() for subscription in subscriptions] == data:
+                self.subscriptions[user_id] = subscriptions
+                continue
+            for subscription in subscriptions:
+                self._unindex(subscription)
+            for item in data:
+                try:
+                    self._index(Subscription.from_dict(user_id, item))
+                except (KeyError, TypeError) as e:
+                    print(f"Reports: Skipping invalid report of {user_id}: {e}")
+
+    def _index(self, subscription):
+        self.subscriptions.setdefault(subscription.user_id, []).append(subscription)
+        if self.owns(subscription.user_id):
+            self._due.setdefault(subscription.minute, []).append(subscription)
+
+    def _unindex(self, subscription):
+        due = self._due.get(subscription.minute, [])
+        if subscription in due:
+            due.remove(subscription)
+
+    def _save(self, user_id):
+        self.settings.set_user_setting(user_id, "reports", [subscription.to_dict() for subscription in self.subscriptions.get(user_id, [])])
+
+    def get_subscriptions(self, user_id):
+        return list(self.subscriptions.get(str(user_id), []))
+
+    def subscribe(self, user_id, hourly, hour=0, minute=0, device=None):
+        """Adds a report of the user and returns it, raises ValueError if the user has too many."""
+        user_id = str(user_id)
+        subscriptions = self.subscriptions.get(user_id, [])
+        if len(subscriptions) >= REPORT_MAX_SUBSCRIPTIONS:
+            raise ValueError(f"At most {REPORT_MAX_SUBSCRIPTIONS} reports per user")
+        subscription_id = max((subscription.id for subscription in subscriptions), default=0) + 1
+        subscription = Subscription(user_id, subscription_id, self.registry.get(device).name, hourly, hour, minute)
+        self._index(subscription)
+        self._save(user_id)
+        return subscription
+
+    def unsubscribe(self, user_id, subscription_id=None):
+        """Removes one report of the user, all of them without subscription_id. Returns the number removed."""
+        user_id = str(user_id)
+        subscriptions = self.subscriptions.get(user_id, [])
+        removed = [subscription for subscription in subscriptions if subscription_id is None or subscription.id == subscription_id]
+        for subscription in removed:
+            subscriptions.remove(subscription)
+            self._unindex(subscription)
+        if removed:
+            self._save(user_id)
+        return len(removed)
+
+    def describe(self, subscription, language):
+        """Text of the schedule in the language of the user."""
+        if subscription.hourly:
+            text = self.settings.get_translation(language, "report_hourly", minute=f"{subscription.minute:02d}")
+        else:
+            text = self.settings.get_translation(language, "report_daily", time=f"{subscription.hour:02d}:{subscription.minute:02d}")
+        if len(self.registry) > 1:
+            text = f"{self.registry.get(subscription.device).friendly_name}: {text}"
+        return text
+
+    def _resources(self, device):
+        return [resource for resource in self.registry.get(device).resources if resource != SNAPSHOT_RESOURCE]
+
+    async def read(self, devices):
+        """Reads every sensor of the devices once, returns {(device, resource): value or exception}."""
+        keys = [(device, resource) for device in devices for resource in self._resources(device)]
+        self.stats["reads"] += len(keys)
+        results = await asyncio.gather(*(self.cache.get(resource, device) for device, resource in keys), return_exceptions=True)
+        return dict(zip(keys, results))
+
+    def render(self, subscription, readings, now):
+        user_id = subscription.user_id
+        locale = self.settings.get_locale(user_id)
+        lines = [locale.translate("report_header", time=now.strftime("%H:%M"))]
+        if len(self.registry) > 1:
+            lines[0] = f"{lines[0]} {self.registry.get(subscription.device).friendly_name}"
+        for resource in self._resources(subscription.device):
+            value = readings.get((subscription.device, resource))
+            sensor = locale.translate(resource, default=resource)
+            if isinstance(value, Exception) or value is None:
+                text = locale.translate("device_error")
+            else:
+                text = self.format_value(user_id, resource, value)
+            lines.append(f"{sensor}: {text}")
+        return "\n".join(lines)
+
+    async def tick(self, now=None):
+        """Sends the reports due at now (a datetime, the current minute if None)."""
+        now = now or datetime.now()
+        due = [subscription for subscription in self._due.get(now.minute, []) if subscription.is_due(now)]
+        self.stats["ticks"] += 1
+        if not due or self.send is None:
+            return 0
+        readings = await self.read({subscription.device for subscription in due})
+        # Handed to the send queue at once, it spreads them at the broadcast rate
+        results = await asyncio.gather(*(self.send(subscription.user_id, self.render(subscription, readings, now)) for subscription in due),
+                                       return_exceptions=True)
+        for subscription, result in zip(due, results):
+            if isinstance(result, Exception):
+                self.stats["send_errors"] += 1
+                print(f"Reports: Could not send the report of {subscription.user_id}: {result}")
+            else:
+                self.stats["reports"] += 1
+        return len(due)
+
+    async def _tick(self, now):
+        try:
+            await self.tick(now)
+        except Exception as e:
+            print(f"Reports: Tick failed: {e!r}")
+
+    async def _run(self):
+        while True:
+            now = datetime.now()
+            next_minute = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+            await asyncio.sleep((next_minute - now).total_seconds())
+            # The sleep may end early or the clock may have been set back, a minute is only ticked once it started
+            minute = datetime.now().replace(second=0, microsecond=0)
+            if minute < next_minute or (self._last_minute is not None and minute <= self._last_minute):
+                continue
+            self._last_minute = minute
+            # Picks up subscriptions other workers changed, sync() is called if they did
+            self.settings.refresh_user_settings()
+            # A large broadcast may take longer than a minute, the next tick must not wait for it
+            task = asyncio.create_task(self._tick(minute))
+            self._ticks.add(task)
+            task.add_done_callback(self._ticks.discard)
+
+    def start(self, send, format_value=None):
+        self.send = send
+        if format_value is not None:
+            self.format_value = format_value
+        self.load()
+        self.settings.add_listener(self.sync)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self.settings.remove_listener(self.sync)
+        tasks = list(self._ticks) + ([self._task] if self._task is not None else [])
+        self._task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def get_stats(self):
+        return {**self.stats, "subscriptions": sum(len(subscriptions) for subscriptions in self.subscriptions.values())}
+
+def parse_schedule(args):
+    """Parses 'hourly', '[daily] [at] <hour>[:<minute>]' or 'every morning at 7' into a dict for subscribe, raises ValueError."""
+    words = [arg.lower() for arg in args if arg.lower() not in ("daily", "täglich", "every", "jeden", "at", "um", "morning", "morgen", "uhr")]
+    if len(words) == 1 and words[0] in HOURLY:
+        return {"hourly": True, "hour": 0, "minute": 0}
+    if len(words) != 1:
+        raise ValueError("Invalid schedule")
+    hour, _, minute = words[0].replace(".", ":").partition(":")
+    hour, minute = int(hour), int(minute or 0)
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise ValueError("Invalid schedule")
+    return {"hourly": False, "hour": hour, "minute": minute}
+
+# Reports shared by the whole bot
+report_scheduler = ReportScheduler()
@@ -0,0 +1,132 @@
+import asyncio
+import os
+import time
+from client import coap
+from device_registry import device_registry, FANOUT_CONCURRENCY
+
+WELL_KNOWN_CORE = ".well-known/core"
+# Seconds between two discoveries of the same device
+DISCOVERY_INTERVAL = float(os.environ.get("DISCOVERY_INTERVAL", 60 * 60))
+# Seconds before a failed discovery is tried again
+DISCOVERY_RETRY_DELAY = 60
+# Devices discovered at the same time, each needs a DTLS handshake
+DISCOVERY_CONCURRENCY = int(os.environ.get("DISCOVERY_CONCURRENCY", FANOUT_CONCURRENCY))
+
+def _split(text, separator):
+    """Splits at the separator outside of double quotes."""
+    parts = []
+    current = []
+    quoted = False
+    for char in text:
+        if char == '"':
+            quoted = not quoted
+        if char == separator and not quoted:
+            parts.append("".join(current))
+            current = []
+        else:
+            current.append(char)
+    parts.append("".join(current))
+    return parts
+
+def parse_link_format(payload):
+    """Parses CoRE link format (RFC 6690) like '</hum>;rt="humidity",</internal_temp>'.
+
+    Returns [{"path": "hum", "rt": "humidity", ...}], paths without the leading slash.
+    """
+    links = []
+    for entry in _split(payload.replace("\x00", ""), ","):
+        parts = _split(entry.strip(), ";")
+        target = parts[0].strip()
+        if not (target.startswith("<") and target.endswith(">")):
+            continue
+        link = {"path": target[1:-1].lstrip("/")}
+        for parameter in parts[1:]:
+            name, _, value = parameter.strip().partition("=")
+            if name:
+                link[name.strip()] = value.strip().strip('"') if value else True
+        links.append(link)
+    return links
+
+class ResourceDiscovery:
+    """Finds the resources of every device through its /.well-known/core.
+
+    The links are cached per device and refreshed every DISCOVERY_INTERVAL in
+    the background. Listeners are called with (device, links) whenever the
+    resources of a device change, e.g. after a firmware update.
+    """
+    def __init__(self, client=coap, registry=device_registry, interval=DISCOVERY_INTERVAL, concurrency=DISCOVERY_CONCURRENCY):
+        self.client = client
+        self.registry = registry
+        self.interval = interval
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # Format: {device name: ([link], timestamp)}
+        self.links = {}
+        self._listeners = []
+        self._tasks = {}
+        self.stats = {
+            "discoveries": 0,
+            "changes": 0,
+            "errors": 0
+        }
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def get_links(self, device=None):
+        """Returns the cached links of the device, [] if it was not discovered yet."""
+        entry = self.links.get(self.registry.get(device).name)
+        return entry[0] if entry is not None else []
+
+    async def discover(self, device=None):
+        """Asks the device for its resources and returns the links."""
+        device = self.client.get_device(device)
+        payload = await self.client.get(WELL_KNOWN_CORE, device)
+        # Links to other servers like rel="impl-info" and the discovery resource itself are no sensors
+        links = [link for link in parse_link_format(payload)
+                 if "://" not in link["path"] and not link["path"].startswith(".well-known")]
+        self.stats["discoveries"] += 1
+        old = self.links.get(device.name)
+        self.links[device.name] = (links, time.time())
+        if old is None or old[0] != links:
+            self.stats["changes"] += 1
+            if links:
+                # Known resources keep their order, the first one is used for health probes
+                paths = [link["path"] for link in links]
+                device.resources = [path for path in device.resources if path in paths] + [path for path in paths if path not in device.resources]
+            print(f"Discovery: {device.name} offers {', '.join('/' + link['path'] for link in links)}")
+            for listener in self._listeners:
+                try:
+                    listener(device, links)
+                except Exception as e:
+                    print(f"Discovery: Listener failed for {device.name}: {e}")
+        return links
+
+    async def _discover_forever(self, device):
+        while True:
+            try:
+                async with self._semaphore:
+                    await self.discover(device)
+                delay = self.interval
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"Discovery: Could not discover the resources of {device.name}: {e!r}")
+                delay = DISCOVERY_RETRY_DELAY
+            await asyncio.sleep(delay)
+
+    def start(self):
+        for device in self.registry:
+            if device.name not in self._tasks:
+                self._tasks[device.name] = asyncio.create_task(self._discover_forever(device))
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        self._tasks.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def get_stats(self):
+        return {**self.stats, "devices": len(self.links), "resources": sum(len(links) for links, _ in self.links.values())}
+
+# Discovery shared by the whole bot
+resource_discovery = ResourceDiscovery()
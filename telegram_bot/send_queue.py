@@ -0,0 +1,137 @@
+import asyncio
+import math
+import os
+from datetime import timedelta
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+import workers
+
+# Messages per second Telegram accepts from a bot overall
+SEND_RATE = float(os.environ.get("SEND_RATE", 30))
+# Messages per second to one private chat and to one group
+SEND_CHAT_RATE = float(os.environ.get("SEND_CHAT_RATE", 1))
+SEND_GROUP_RATE = float(os.environ.get("SEND_GROUP_RATE", 20 / 60))
+# Messages per second of broadcasts like the scheduled reports, the rest of SEND_RATE stays free for replies
+SEND_BROADCAST_RATE = float(os.environ.get("SEND_BROADCAST_RATE", 10))
+# Messages to one chat that may go out at once before the chat rate applies
+SEND_CHAT_BURST = 3
+# Attempts after Telegram answered 429 Too Many Requests
+SEND_MAX_RETRIES = int(os.environ.get("SEND_MAX_RETRIES", 3))
+# Value of rate_limit_args for messages that may wait behind the replies
+BROADCAST = "broadcast"
+
+class Pacer:
+    """Spaces events at rate per second, allowing bursts of up to burst events (GCRA).
+
+    reserve() books the next free slot and returns the seconds until it.
+    """
+    def __init__(self, rate, burst=1):
+        self.interval = 1 / rate
+        self.tolerance = (burst - 1) * self.interval
+        # Theoretical arrival time of the next event on the loop clock
+        self.tat = 0.0
+
+    def reserve(self, now):
+        start = max(now, self.tat - self.tolerance)
+        self.tat = max(self.tat, start) + self.interval
+        return start - now
+
+class SendQueue(BaseRateLimiter):
+    """Paces every Bot API call that sends to a chat, used by the application as its rate limiter.
+
+    Calls wait for a slot of their chat (one per second in private chats,
+    20 per minute in groups) and then for a slot of the whole bot, so bursts
+    of replies are spread instead of being rejected. Calls with
+    rate_limit_args=BROADCAST wait for a slot of the slower broadcast rate
+    first, a large broadcast leaves room for the replies to the users.
+    When Telegram answers 429 all calls pause for the retry_after it asks for
+    and the call is sent again.
+    """
+    def __init__(self, rate=SEND_RATE, chat_rate=SEND_CHAT_RATE, group_rate=SEND_GROUP_RATE, broadcast_rate=SEND_BROADCAST_RATE, max_retries=SEND_MAX_RETRIES):
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._overall = Pacer(rate, burst=max(int(rate), 1) if math.isfinite(rate) else 1)
+        self._broadcast = Pacer(broadcast_rate)
+        # Format: {chat_id: Pacer}
+        self._chats = {}
+        # Loop time until which nothing is sent after a 429
+        self._paused_until = 0.0
+        self.stats = {
+            "sent": 0,
+            "broadcasts": 0,
+            "delayed": 0,
+            "retries": 0,
+            "failures": 0
+        }
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_pacer(self, chat_id):
+        pacer = self._chats.get(chat_id)
+        if pacer is None:
+            # Negative IDs are groups and channels, string IDs are @channel names
+            group = isinstance(chat_id, str) or chat_id < 0
+            pacer = self._chats[chat_id] = Pacer(self.group_rate if group else self.chat_rate, SEND_CHAT_BURST)
+        return pacer
+
+    async def _wait(self, pacer):
+        delay = pacer.reserve(asyncio.get_running_loop().time())
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay
+
+    async def _acquire(self, chat_id, broadcast):
+        loop = asyncio.get_running_loop()
+        waited = 0.0
+        if broadcast:
+            waited += await self._wait(self._broadcast)
+        waited += await self._wait(self._chat_pacer(chat_id))
+        waited += await self._wait(self._overall)
+        while loop.time() < self._paused_until:
+            waited += self._paused_until - loop.time()
+            await asyncio.sleep(self._paused_until - loop.time())
+        if waited > 0:
+            self.stats["delayed"] += 1
+        if len(self._chats) > 10000:
+            # Pacers of chats that are idle again carry no state worth keeping
+            now = loop.time()
+            self._chats = {chat: pacer for chat, pacer in self._chats.items() if pacer.tat > now}
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            # getMe, answerCallbackQuery and the like do not count
+            return await callback(*args, **kwargs)
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+        broadcast = rate_limit_args == BROADCAST
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(chat_id, broadcast)
+            try:
+                result = await callback(*args, **kwargs)
+                self.stats["sent"] += 1
+                if broadcast:
+                    self.stats["broadcasts"] += 1
+                return result
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    self.stats["failures"] += 1
+                    raise
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                self.stats["retries"] += 1
+                print(f"Send queue: Telegram asks to wait {retry_after:g} s before sending to {chat_id}")
+                self._paused_until = max(self._paused_until, asyncio.get_running_loop().time() + retry_after + 0.1)
+
+    def get_stats(self):
+        return {**self.stats, "chats": len(self._chats)}
+
+# Send queue shared by the whole bot, workers share the limits of the bot
+send_queue = SendQueue(rate=SEND_RATE / workers.BOT_WORKERS, broadcast_rate=SEND_BROADCAST_RATE / workers.BOT_WORKERS)
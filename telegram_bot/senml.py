@@ -0,0 +1,173 @@
+import json
+import math
+import struct
+import time
+
+try:
+    # C implementation, the built-in decoder below is used without it
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# CoAP content formats of SenML (RFC 8428)
+SENML_JSON = 110
+SENML_CBOR = 112
+# SenML labels are integers in CBOR
+# Format: {CBOR label: JSON label}
+SENML_LABELS = {
+    -2: "bn",
+    -3: "bt",
+    -4: "bu",
+    -5: "bv",
+    0: "n",
+    1: "u",
+    2: "v",
+    3: "vs",
+    4: "vb",
+    5: "s",
+    6: "t",
+    7: "ut"
+}
+# Times below 2**28 are relative to now (RFC 8428, section 4.5.3)
+RELATIVE_TIME_LIMIT = 2 ** 28
+
+def _read_argument(data, offset, info):
+    if info < 24:
+        return info, offset
+    if info > 27:
+        raise ValueError("Indefinite lengths are not supported")
+    size = 1 << (info - 24)
+    return int.from_bytes(data[offset:offset + size], "big"), offset + size
+
+def _decode_item(data, offset):
+    initial = data[offset]
+    offset += 1
+    major, info = initial >> 5, initial & 0x1f
+    if major == 7:
+        if info in (25, 26, 27):
+            size, fmt = {25: (2, ">e"), 26: (4, ">f"), 27: (8, ">d")}[info]
+            return struct.unpack(fmt, data[offset:offset + size])[0], offset + size
+        simple = {20: False, 21: True, 22: None, 23: None}
+        if info not in simple:
+            raise ValueError(f"Unsupported CBOR simple value {info}")
+        return simple[info], offset
+    argument, offset = _read_argument(data, offset, info)
+    if major == 0:
+        return argument, offset
+    if major == 1:
+        return -1 - argument, offset
+    if major in (2, 3):
+        value = bytes(data[offset:offset + argument])
+        if len(value) < argument:
+            raise ValueError("Truncated CBOR string")
+        return (value.decode("utf-8") if major == 3 else value), offset + argument
+    if major == 4:
+        items = []
+        for _ in range(argument):
+            item, offset = _decode_item(data, offset)
+            items.append(item)
+        return items, offset
+    if major == 5:
+        items = {}
+        for _ in range(argument):
+            key, offset = _decode_item(data, offset)
+            items[key], offset = _decode_item(data, offset)
+        return items, offset
+    # Tags carry no meaning for SenML, only the tagged item is kept
+    return _decode_item(data, offset)
+
+def loads_cbor(data):
+    """Decodes the CBOR subset SenML uses: integers, floats, strings, arrays and maps."""
+    if cbor2 is not None:
+        return cbor2.loads(data)
+    try:
+        value, offset = _decode_item(memoryview(data), 0)
+    except (IndexError, struct.error, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid CBOR: {e}") from e
+    if offset != len(data):
+        raise ValueError("Trailing bytes after CBOR item")
+    return value
+
+def _encode_head(major, argument):
+    if argument < 24:
+        return bytes([major << 5 | argument])
+    for info, size in ((24, 1), (25, 2), (26, 4), (27, 8)):
+        if argument < 1 << (8 * size):
+            return bytes([major << 5 | info]) + argument.to_bytes(size, "big")
+    raise ValueError(f"Integer too large for CBOR: {argument}")
+
+def dumps_cbor(value):
+    """Encodes like loads_cbor decodes, floats as single precision if that loses nothing."""
+    if cbor2 is not None:
+        return cbor2.dumps(value)
+    if value is None:
+        return b"\xf6"
+    if isinstance(value, bool):
+        return b"\xf5" if value else b"\xf4"
+    if isinstance(value, int):
+        return _encode_head(0, value) if value >= 0 else _encode_head(1, -1 - value)
+    if isinstance(value, float):
+        single = struct.pack(">f", value)
+        if math.isnan(value) or struct.unpack(">f", single)[0] == value:
+            return b"\xfa" + single
+        return b"\xfb" + struct.pack(">d", value)
+    if isinstance(value, str):
+        encoded = value.encode("utf-8")
+        return _encode_head(3, len(encoded)) + encoded
+    if isinstance(value, bytes):
+        return _encode_head(2, len(value)) + value
+    if isinstance(value, (list, tuple)):
+        return _encode_head(4, len(value)) + b"".join(dumps_cbor(item) for item in value)
+    if isinstance(value, dict):
+        return _encode_head(5, len(value)) + b"".join(dumps_cbor(key) + dumps_cbor(item) for key, item in value.items())
+    raise TypeError(f"Cannot encode {type(value).__name__} as CBOR")
+
+def decode_senml(payload, content_format=SENML_CBOR, now=None):
+    """Resolves a SenML pack into [{"name": str, "unit": str, "value": float, "time": float}].
+
+    Base name, time, unit and value are applied, relative times are turned
+    into time.time() timestamps. Records without a numeric value are skipped.
+    """
+    if content_format == SENML_CBOR:
+        pack = loads_cbor(payload)
+    elif content_format == SENML_JSON:
+        pack = json.loads(payload)
+    else:
+        raise ValueError(f"Not a SenML content format: {content_format}")
+    if not isinstance(pack, list):
+        raise ValueError("SenML pack is not an array")
+    if now is None:
+        now = time.time()
+    records = []
+    base_name, base_time, base_unit, base_value = "", 0, None, 0
+    for record in pack:
+        if not isinstance(record, dict):
+            raise ValueError("SenML record is not a map")
+        record = {SENML_LABELS.get(label, label): value for label, value in record.items()}
+        base_name = record.get("bn", base_name)
+        base_time = record.get("bt", base_time)
+        base_unit = record.get("bu", base_unit)
+        base_value = record.get("bv", base_value)
+        value = record.get("v")
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            continue
+        timestamp = base_time + record.get("t", 0)
+        if timestamp < RELATIVE_TIME_LIMIT:
+            timestamp += now
+        records.append({
+            "name": base_name + record.get("n", ""),
+            "unit": record.get("u", base_unit),
+            "value": float(value + base_value),
+            "time": timestamp
+        })
+    return records
+
+def encode_senml(readings, content_format=SENML_CBOR, now=None):
+    """Encodes {name: (value, timestamp, unit)} as a SenML pack with times relative to now."""
+    if now is None:
+        now = time.time()
+    if content_format == SENML_JSON:
+        return json.dumps([{"n": name, "u": unit, "v": value, "t": round(timestamp - now)}
+                           for name, (value, timestamp, unit) in readings.items()]).encode("utf-8")
+    return dumps_cbor([{0: name, 1: unit, 2: value, 6: round(timestamp - now)}
+                       for name, (value, timestamp, unit) in readings.items()])
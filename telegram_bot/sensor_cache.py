@@ -0,0 +1,216 @@
+import asyncio
+import os
+import time
+from client import coap_client, coap_snapshot
+from device_registry import device_registry
+from shared_state import shared_state
+
+# Seconds a sensor reading is served from the cache before the device is asked again
+SENSOR_CACHE_TTL = float(os.environ.get("SENSOR_CACHE_TTL", 5))
+# The DHT11 behind external_temp and hum cannot be sampled more often than every 2 seconds
+MIN_TTLS = {
+    "external_temp": 2,
+    "hum": 2
+}
+
+def parse_sensor_value(payload: str) -> float:
+    """Extracts the number from a sensor payload like '21.50 °C' or '45.0'."""
+    parts = payload.replace('\x00', ' ').split()
+    if not parts:
+        raise ValueError(f"Empty sensor payload: {payload!r}")
+    return float(parts[0])
+
+class SensorCache:
+    """Per-device and per-resource cache of raw sensor values.
+
+    A value is served from memory until its TTL expires. Concurrent misses for
+    the same resource of a device share one in-flight request to the device.
+    A miss first asks for the snapshot of all sensors of the device, which
+    refreshes every resource with one request; only resources missing from it
+    are fetched one by one. Devices are given by name, None is the default device.
+
+    With several workers the readings are also written to the shared state,
+    a worker asks the device only if no other worker has a fresh reading.
+    """
+    def __init__(self, fetch=coap_client, ttl=SENSOR_CACHE_TTL, ttls=None, registry=device_registry, snapshot=coap_snapshot, shared=shared_state):
+        self.fetch = fetch
+        self.shared = shared
+        # Returns {resource: (value, timestamp)} of the device or None, None disables snapshots
+        self.snapshot = snapshot
+        self.ttl = ttl
+        self.ttls = ttls or {}
+        self.registry = registry
+        # Format: {(device, resource): (value, timestamp)}
+        self._values = {}
+        # TTL of single entries that differ from the resource TTL
+        # Format: {(device, resource): ttl}
+        self._entry_ttls = {}
+        # Format: {(device, resource): Task}
+        self._inflight = {}
+        # Format: {device: Task}
+        self._inflight_snapshots = {}
+        # Called with (resource, value, timestamp, device) for every new reading
+        self._listeners = []
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "snapshots": 0,
+            "shared_hits": 0,
+            "errors": 0
+        }
+
+    def get_ttl(self, resource):
+        ttl = self.ttls.get(resource, self.ttl)
+        return max(ttl, MIN_TTLS.get(resource, 0))
+
+    def _key(self, resource, device=None):
+        # Raises KeyError for unknown devices
+        return (self.registry.get(device).name, resource)
+
+    def peek(self, resource, device=None):
+        """Returns (value, timestamp) of the last reading, fresh or not, or None."""
+        return self._values.get(self._key(resource, device))
+
+    def age(self, resource, device=None):
+        entry = self._values.get(self._key(resource, device))
+        if entry is None:
+            return None
+        return time.time() - entry[1]
+
+    def is_fresh(self, resource, device=None):
+        age = self.age(resource, device)
+        ttl = self._entry_ttls.get(self._key(resource, device), self.get_ttl(resource))
+        return age is not None and age < ttl
+
+    def put(self, resource, value, timestamp=None, ttl=None, device=None, publish=True):
+        """Stores a value, ttl overrides the resource TTL for this entry only.
+
+        publish=False keeps a reading taken from the shared state out of it.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        key = self._key(resource, device)
+        self._values[key] = (value, timestamp)
+        if ttl is None:
+            self._entry_ttls.pop(key, None)
+        else:
+            self._entry_ttls[key] = ttl
+        if publish and self.shared is not None:
+            future = self.shared.submit(self.shared.put_sensor_value, key[0], resource, value, timestamp, ttl)
+            future.add_done_callback(lambda future: self._shared(resource, future))
+        for listener in self._listeners:
+            try:
+                listener(resource, value, timestamp, key[0])
+            except Exception as e:
+                print(f"Sensor cache: Listener failed for {resource}: {e}")
+
+    def _shared(self, resource, future):
+        if not future.cancelled() and future.exception() is not None:
+            print(f"Sensor cache: Could not share {resource}: {future.exception()}")
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def release(self, resource, device=None):
+        """Falls back to the resource TTL for the current entry."""
+        self._entry_ttls.pop(self._key(resource, device), None)
+
+    async def get(self, resource, device=None):
+        """Returns the raw value of the resource, asking the device only if the cached one is stale."""
+        key = self._key(resource, device)
+        if self.is_fresh(resource, key[0]):
+            self.stats["hits"] += 1
+            return self._values[key][0]
+        if self.shared is not None:
+            value = await self._get_shared(key)
+            if value is not None:
+                return value
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["misses"] += 1
+            task = asyncio.ensure_future(self._refresh(key))
+            self._inflight[key] = task
+        # Shielded, a caller that gives up must not cancel the request for everyone else
+        return await asyncio.shield(task)
+
+    async def _get_shared(self, key):
+        """Returns the value another worker read if it is still fresh, else None."""
+        device, resource = key
+        try:
+            entry = await self.shared.run(self.shared.get_sensor_value, device, resource)
+        except Exception as e:
+            print(f"Sensor cache: Could not read the shared {resource}: {e}")
+            return None
+        if entry is None:
+            return None
+        value, timestamp, ttl = entry
+        if time.time() - timestamp >= (ttl if ttl is not None else self.get_ttl(resource)):
+            return None
+        self.stats["shared_hits"] += 1
+        if key not in self._values or self._values[key][1] < timestamp:
+            self.put(resource, value, timestamp, ttl, device, publish=False)
+        return value
+
+    async def _refresh(self, key):
+        device, resource = key
+        try:
+            if self.snapshot is not None:
+                readings = await self._get_snapshot(device)
+                if readings is not None and resource in readings:
+                    return self._values[key][0]
+            payload = await self.fetch(resource, device)
+            value = parse_sensor_value(payload)
+            self.put(resource, value, device=device)
+            return value
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    async def _get_snapshot(self, device):
+        # Misses of several resources of the device share one snapshot request
+        task = self._inflight_snapshots.get(device)
+        if task is None:
+            task = asyncio.ensure_future(self._refresh_snapshot(device))
+            self._inflight_snapshots[device] = task
+        return await asyncio.shield(task)
+
+    async def _refresh_snapshot(self, device):
+        try:
+            readings = await self.snapshot(device)
+            if readings is None:
+                return None
+            self.stats["snapshots"] += 1
+            received = time.time()
+            for resource, (value, timestamp) in readings.items():
+                key = (device, resource)
+                entry = self._values.get(key)
+                # Skips readings that are already cached or older than a notification of the observer
+                if entry is None or entry[1] < timestamp:
+                    # The device samples its sensors only every few seconds, a reading is valid for the TTL
+                    # after it was received. A longer TTL the observer set still applies.
+                    ttl = max(self.get_ttl(resource) + max(received - timestamp, 0.0), self._entry_ttls.get(key, 0.0))
+                    self.put(resource, value, timestamp, ttl, device)
+            return readings
+        finally:
+            self._inflight_snapshots.pop(device, None)
+
+    def get_stats(self):
+        lookups = self.stats["hits"] + self.stats["misses"] + self.stats["coalesced"] + self.stats["shared_hits"]
+        return {
+            **self.stats,
+            "hit_rate": (self.stats["hits"] + self.stats["coalesced"] + self.stats["shared_hits"]) / lookups if lookups else 0.0,
+            "ages": {f"{device}/{resource}": round(self.age(resource, device), 1) for device, resource in self._values}
+        }
+
+# Cache shared by the whole bot
+sensor_cache = SensorCache()
@@ -0,0 +1,208 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from pathlib import Path
+from sensor_cache import sensor_cache
+
+script_dir = Path(__file__).parent
+HISTORY_DB_FILE = script_dir / "sensor_history.db"
+
+# Resources recorded in the history
+HISTORY_RESOURCES = ["internal_temp", "external_temp", "hum"]
+# Seconds between two samples taken by the background sampler
+HISTORY_SAMPLE_INTERVAL = float(os.environ.get("HISTORY_SAMPLE_INTERVAL", 60))
+# Seconds between two writes of new samples to the database
+HISTORY_FLUSH_INTERVAL = 30
+# Samples per resource kept in memory, about 3 days at one sample per minute
+RING_SIZE = 4096
+# Rollup resolutions in seconds: minute, hour and day
+ROLLUP_RESOLUTIONS = [60, 60 * 60, 24 * 60 * 60]
+
+class RingBuffer:
+    """Fixed size buffer of (timestamp, value) samples backed by two arrays of doubles."""
+    def __init__(self, size=RING_SIZE):
+        self.size = size
+        self.timestamps = array('d', bytes(8 * size))
+        self.values = array('d', bytes(8 * size))
+        self.count = 0
+        self.head = 0
+
+    def append(self, timestamp, value):
+        self.timestamps[self.head] = timestamp
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def oldest(self):
+        if self.count == 0:
+            return None
+        return self.timestamps[(self.head - self.count) % self.size]
+
+    def range(self, start, end):
+        """Returns the values with start <= timestamp < end, oldest first."""
+        values = []
+        for i in range(self.count):
+            index = (self.head - self.count + i) % self.size
+            if start <= self.timestamps[index] < end:
+                values.append(self.values[index])
+        return values
+
+class SensorHistory:
+    """Append-only history of sensor readings with min/max/mean rollups.
+
+    Every reading that reaches the sensor cache is recorded: the newest
+    samples in an in-memory ring buffer per resource, all of them in SQLite
+    together with per minute, hour and day rollups that are updated as
+    samples arrive. A background sampler reads the sensors every
+    HISTORY_SAMPLE_INTERVAL so there is a reading even if nobody asks.
+    """
+    def __init__(self, filepath=HISTORY_DB_FILE, cache=sensor_cache, resources=HISTORY_RESOURCES, sample_interval=HISTORY_SAMPLE_INTERVAL):
+        self.filepath = filepath
+        self.cache = cache
+        self.resources = resources
+        self.sample_interval = sample_interval
+        # Format: {resource: RingBuffer}
+        self.buffers = {resource: RingBuffer() for resource in resources}
+        # Samples not written yet
+        # Format: [(resource, timestamp, value)]
+        self._pending = []
+        self._tasks = []
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(filepath, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS samples (resource TEXT NOT NULL, ts REAL NOT NULL, value REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS samples_resource_ts ON samples (resource, ts)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS rollups ("
+            "resource TEXT NOT NULL, resolution INTEGER NOT NULL, bucket INTEGER NOT NULL, "
+            "min REAL NOT NULL, max REAL NOT NULL, sum REAL NOT NULL, count INTEGER NOT NULL, "
+            "PRIMARY KEY (resource, resolution, bucket))"
+        )
+        self._db.commit()
+        self._load_recent()
+
+    def _load_recent(self):
+        """Fills the ring buffers with the newest samples of the database."""
+        for resource, buffer in self.buffers.items():
+            rows = self._db.execute(
+                "SELECT ts, value FROM (SELECT ts, value FROM samples WHERE resource = ? ORDER BY ts DESC LIMIT ?) ORDER BY ts",
+                (resource, buffer.size)
+            ).fetchall()
+            for timestamp, value in rows:
+                buffer.append(timestamp, value)
+
+    def record(self, resource, value, timestamp, device=None):
+        """Listener of the sensor cache, called for every new reading of the default device."""
+        if resource not in self.buffers or (device is not None and device != self.cache.registry.default().name):
+            return
+        self.buffers[resource].append(timestamp, value)
+        self._pending.append((resource, timestamp, value))
+
+    def _write(self, samples):
+        rollups = []
+        for resource, timestamp, value in samples:
+            for resolution in ROLLUP_RESOLUTIONS:
+                bucket = int(timestamp // resolution * resolution)
+                rollups.append((resource, resolution, bucket, value, value, value))
+        with self._db_lock, self._db:
+            self._db.executemany("INSERT INTO samples VALUES (?, ?, ?)", samples)
+            self._db.executemany(
+                "INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?, 1) "
+                "ON CONFLICT (resource, resolution, bucket) DO UPDATE SET "
+                "min = MIN(min, excluded.min), max = MAX(max, excluded.max), "
+                "sum = sum + excluded.sum, count = count + 1",
+                rollups
+            )
+
+    async def flush(self):
+        samples, self._pending = self._pending, []
+        if not samples:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, samples)
+        except Exception as e:
+            print(f"History: Could not save samples: {e}")
+            self._pending = samples + self._pending
+
+    def _read_rollups(self, resource, resolution, start, end):
+        with self._db_lock:
+            return self._db.execute(
+                "SELECT bucket, min, max, sum, count FROM rollups "
+                "WHERE resource = ? AND resolution = ? AND bucket >= ? AND bucket < ? ORDER BY bucket",
+                (resource, resolution, int(start // resolution * resolution), end)
+            ).fetchall()
+
+    def choose_resolution(self, duration):
+        """Uses the finest rollup that gives at most a few hundred buckets."""
+        for resolution in ROLLUP_RESOLUTIONS:
+            if duration / resolution <= 500:
+                return resolution
+        return ROLLUP_RESOLUTIONS[-1]
+
+    async def query(self, resource, start, end=None):
+        """Returns min, max, mean and count of the readings between start and end,
+        plus the rollup buckets as [(bucket, min, max, mean)]."""
+        end = end or time.time()
+        buffer = self.buffers.get(resource)
+        oldest = buffer.oldest() if buffer is not None else None
+        if oldest is not None and oldest <= start:
+            # The range is still in memory
+            values = buffer.range(start, end)
+            if not values:
+                return None
+            return {
+                "min": min(values),
+                "max": max(values),
+                "mean": sum(values) / len(values),
+                "count": len(values),
+                "buckets": []
+            }
+
+        await self.flush()
+        resolution = self.choose_resolution(end - start)
+        rows = await asyncio.get_running_loop().run_in_executor(None, self._read_rollups, resource, resolution, start, end)
+        if not rows:
+            return None
+        count = sum(row[4] for row in rows)
+        return {
+            "min": min(row[1] for row in rows),
+            "max": max(row[2] for row in rows),
+            "mean": sum(row[3] for row in rows) / count,
+            "count": count,
+            "buckets": [(bucket, low, high, total / n) for bucket, low, high, total, n in rows]
+        }
+
+    async def _sample(self):
+        while True:
+            for resource in self.resources:
+                try:
+                    # Answered from the observed state if possible, new readings reach record()
+                    await self.cache.get(resource)
+                except Exception as e:
+                    print(f"History: Could not sample /{resource}: {e}")
+            await asyncio.sleep(self.sample_interval)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(HISTORY_FLUSH_INTERVAL)
+            await self.flush()
+
+    def start(self):
+        self.cache.add_listener(self.record)
+        self._tasks = [
+            asyncio.create_task(self._sample()),
+            asyncio.create_task(self._flush_periodically())
+        ]
+
+    async def close(self):
+        self.cache.remove_listener(self.record)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
+        with self._db_lock:
+            self._db.close()
@@ -0,0 +1,260 @@
+import asyncio
+import heapq
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+
+script_dir = Path(__file__).parent
+SESSION_DB_FILE = script_dir / "sessions.db"
+# File the sessions were stored in before, imported once into an empty database
+LEGACY_AUTH_LOG_FILE = script_dir / "authenticated_users.json"
+
+# Seconds between two runs of the sweeper that removes expired sessions
+SWEEP_INTERVAL = 60
+# Seconds between two writes of changed sessions to the database
+PERSIST_INTERVAL = 30
+
+class SessionStore:
+    """Authentication sessions kept in memory and persisted to SQLite.
+
+    Lookups and sliding-expiry refreshes only touch the dict. Expired sessions
+    are removed by a background sweeper using a heap ordered by expiry time;
+    a refresh does not update the heap, the sweeper pushes an entry again when
+    it pops one that was extended in the meantime. Changed sessions are
+    written in one transaction every PERSIST_INTERVAL, logins and logouts
+    trigger an early write.
+
+    With several workers (shared=True) a user may write in chats handled by
+    different workers. Every worker keeps all sessions and reads them again
+    when another worker committed a change, except those it changed itself
+    and did not write yet. Logins and logouts trigger an early write, so
+    they reach the other workers quickly. The dispatcher imports
+    the legacy file before the workers start (import_legacy=False for them).
+    """
+    def __init__(self, filepath=SESSION_DB_FILE, session_timeout=None, sweep_interval=SWEEP_INTERVAL, persist_interval=PERSIST_INTERVAL, shared=False, import_legacy=True):
+        self.filepath = filepath
+        self.shared = shared
+        self.import_legacy = import_legacy
+        self.session_timeout = session_timeout
+        self.sweep_interval = sweep_interval
+        self.persist_interval = persist_interval
+        # Format: {user_id: {"expires": datetime, "attempts": int, "locked_until": datetime}}
+        self.sessions = {}
+        # Format: [(expires, user_id)]
+        self._expiry_heap = []
+        # User IDs changed since the last write
+        self._dirty = set()
+        # User IDs being written
+        self._writing = set()
+        # PRAGMA data_version when the sessions were read, it changes when another connection commits
+        self._version = None
+        self._flush_requested = None
+        self._task = None
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(filepath, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id TEXT PRIMARY KEY, expires TEXT, attempts INTEGER NOT NULL DEFAULT 0, locked_until TEXT)"
+        )
+        self._db.commit()
+        self.load()
+
+    def load(self):
+        self._version = self._db.execute("PRAGMA data_version").fetchone()[0]
+        rows = self._db.execute("SELECT user_id, expires, attempts, locked_until FROM sessions").fetchall()
+        if not rows:
+            if self.import_legacy:
+                self._import_legacy_file()
+            return
+        for row in rows:
+            self._set(row[0], self._from_row(row))
+
+    def _from_row(self, row):
+        _, expires, attempts, locked_until = row
+        session = {"attempts": attempts}
+        if expires is not None:
+            session["expires"] = datetime.fromisoformat(expires)
+        if locked_until is not None:
+            session["locked_until"] = datetime.fromisoformat(locked_until)
+        return session
+
+    def _lookup(self, user_id):
+        """Returns the session of the user, read again first if another worker changed the sessions."""
+        if self.shared:
+            self._refresh()
+        return self.sessions.get(user_id)
+
+    def _refresh(self):
+        with self._db_lock:
+            version = self._db.execute("PRAGMA data_version").fetchone()[0]
+            if version == self._version:
+                return
+            rows = self._db.execute("SELECT user_id, expires, attempts, locked_until FROM sessions").fetchall()
+        self._version = version
+        sessions = {row[0]: self._from_row(row) for row in rows}
+        # Changes of this worker not in the database yet win
+        for user_id in self._dirty | self._writing:
+            if user_id in self.sessions:
+                sessions[user_id] = self.sessions[user_id]
+            else:
+                sessions.pop(user_id, None)
+        self.sessions = sessions
+        self._expiry_heap = [(session["expires"], user_id) for user_id, session in sessions.items() if "expires" in session]
+        heapq.heapify(self._expiry_heap)
+
+    def _import_legacy_file(self, filepath=LEGACY_AUTH_LOG_FILE):
+        if not os.path.exists(filepath):
+            return
+        try:
+            with open(filepath, "r") as file:
+                data = json.load(file)
+            for user_id, session in data.items():
+                if "expires" in session:
+                    session["expires"] = datetime.fromisoformat(session["expires"])
+                if "locked_until" in session:
+                    session["locked_until"] = datetime.fromisoformat(session["locked_until"])
+                self._set(user_id, session)
+                self._dirty.add(user_id)
+            self._write(self._collect_changes())
+        except (json.JSONDecodeError, ValueError) as e:
+            print(f"Sessions: Could not import {filepath}: {e}")
+
+    def _set(self, user_id, session):
+        self.sessions[user_id] = session
+        if "expires" in session:
+            heapq.heappush(self._expiry_heap, (session["expires"], user_id))
+
+    def _changed(self, user_id, urgent=False):
+        self._dirty.add(user_id)
+        if urgent and self._flush_requested is not None:
+            self._flush_requested.set()
+
+    def get(self, user_id):
+        return self._lookup(user_id)
+
+    def is_authenticated(self, user_id, now=None):
+        session = self._lookup(user_id)
+        if session is None or "expires" not in session:
+            return False
+        return session["expires"] > (now or datetime.now())
+
+    def touch(self, user_id, now=None):
+        """Extends the session of the user, in memory only."""
+        session = self._lookup(user_id)
+        if session is not None:
+            session["expires"] = (now or datetime.now()) + self.session_timeout
+            self._dirty.add(user_id)
+
+    def login(self, user_id, now=None):
+        self._set(user_id, {
+            "expires": (now or datetime.now()) + self.session_timeout,
+            "attempts": 0
+        })
+        self._changed(user_id, urgent=True)
+
+    def set(self, user_id, session):
+        self._set(user_id, session)
+        self._changed(user_id, urgent=True)
+
+    def delete(self, user_id):
+        if self.sessions.pop(user_id, None) is not None:
+            self._changed(user_id, urgent=True)
+
+    def expire(self, now=None):
+        """Removes all sessions that expired, returns their user IDs."""
+        now = now or datetime.now()
+        if self.shared:
+            # Sessions other workers extended are not expired
+            self._refresh()
+        expired = []
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            _, user_id = heapq.heappop(self._expiry_heap)
+            session = self.sessions.get(user_id)
+            if session is None or "expires" not in session:
+                continue
+            if session["expires"] > now:
+                # Extended since it was pushed, check again later
+                heapq.heappush(self._expiry_heap, (session["expires"], user_id))
+                continue
+            del self.sessions[user_id]
+            self._dirty.add(user_id)
+            expired.append(user_id)
+        return expired
+
+    def _collect_changes(self):
+        changes = []
+        for user_id in self._dirty:
+            session = self.sessions.get(user_id)
+            if session is None:
+                changes.append((user_id, None))
+            else:
+                changes.append((user_id, (
+                    user_id,
+                    session["expires"].isoformat() if "expires" in session else None,
+                    session.get("attempts", 0),
+                    session["locked_until"].isoformat() if "locked_until" in session else None
+                )))
+        self._dirty.clear()
+        return changes
+
+    def _write(self, changes):
+        with self._db_lock, self._db:
+            for user_id, row in changes:
+                if row is None:
+                    self._db.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+                else:
+                    self._db.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)", row)
+
+    async def flush(self):
+        changes = self._collect_changes()
+        if not changes:
+            return
+        self._writing = {user_id for user_id, _ in changes}
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, changes)
+        except Exception as e:
+            print(f"Sessions: Could not save sessions: {e}")
+            self._dirty.update(self._writing)
+        finally:
+            self._writing = set()
+
+    def start(self):
+        if self._task is None:
+            self._flush_requested = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_sweep = loop.time() + self.sweep_interval
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), self.persist_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            if loop.time() >= next_sweep:
+                next_sweep = loop.time() + self.sweep_interval
+                self.expire()
+            await self.flush()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        with self._db_lock:
+            self._db.close()
+
+def import_legacy_sessions(filepath=SESSION_DB_FILE):
+    """Imports the legacy file into an empty database, done once by the dispatcher for all workers."""
+    store = SessionStore(filepath)
+    with store._db_lock:
+        store._db.close()
@@ -1,70 +1,290 @@
+import asyncio
 import json
+import os
+import tempfile
+import time
 from pathlib import Path
+from localization import localization, current_locale, UserLocale, MISSING_TRANSLATION
+from metrics import metrics
+from shared_state import shared_state
 
 script_dir = Path(__file__).parent
 USER_SETTINGS_FILE = script_dir / "user_settings.json"
-TRANSLATION_FILE = script_dir / "translations.json"
+
+# Seconds changes are collected before they are written to disk
+SAVE_DELAY = 1.0
+# Seconds between two checks whether the file was changed by someone else
+RELOAD_CHECK_INTERVAL = 2.0
+
+def write_json_atomic(filepath, data):
+    """Writes data to a temporary file next to filepath and renames it over filepath.
+
+    data is either an object or an already serialized JSON string. A crash
+    leaves either the old or the new file behind, never a half written one.
+    """
+    if not isinstance(data, str):
+        data = json.dumps(data)
+    fd, tmp_path = tempfile.mkstemp(dir=filepath.parent, prefix=f".{filepath.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+class UserSettingsStore:
+    """In-memory user settings, persisted in batches off the event loop.
+
+    The memory copy is authoritative. The file is only read again when its
+    mtime changed (checked at most every RELOAD_CHECK_INTERVAL) and no own
+    changes are waiting to be written.
+    """
+    def __init__(self, filepath=USER_SETTINGS_FILE, save_delay=SAVE_DELAY):
+        self.filepath = filepath
+        self.save_delay = save_delay
+        # Format: {user_id: {lang_code: lang_code, temp_unit: unit}}
+        self.settings = {}
+        self._mtime = None
+        self._last_check = time.monotonic()
+        self._dirty = False
+        self._save_handle = None
+        self._save_task = None
+        # Called after the settings were read again because someone else changed them
+        self.listeners = []
+        self.load()
+
+    def load(self):
+        try:
+            mtime = os.stat(self.filepath).st_mtime_ns
+            with self.filepath.open("r", encoding="utf-8") as file:
+                self.settings = json.load(file)
+            self._mtime = mtime
+        except FileNotFoundError:
+            self.settings = {}
+        except json.JSONDecodeError as e:
+            print(f"Settings: {self.filepath} is not valid JSON, keeping the settings in memory: {e}")
+
+    def refresh(self):
+        now = time.monotonic()
+        if now - self._last_check < RELOAD_CHECK_INTERVAL:
+            return
+        self._last_check = now
+        if self._dirty or self._save_task is not None:
+            return
+        with metrics.span("settings_refresh"):
+            try:
+                mtime = os.stat(self.filepath).st_mtime_ns
+            except FileNotFoundError:
+                return
+            if mtime != self._mtime:
+                self.load()
+                self._notify()
+
+    def _notify(self):
+        for listener in self.listeners:
+            try:
+                listener()
+            except Exception as e:
+                print(f"Settings: Listener failed: {e!r}")
+
+    def get(self, user_id: str, key: str, default=None):
+        self.refresh()
+        return self.settings.get(user_id, {}).get(key, default)
+
+    def set(self, user_id: str, key: str, value):
+        self.refresh()
+        if user_id not in self.settings:
+            self.settings[user_id] = {}
+        self.settings[user_id][key] = value
+        self._dirty = True
+        self._schedule_save()
+
+    def _collect(self):
+        """Returns the data to write and marks it as written."""
+        self._dirty = False
+        return json.dumps(self.settings)
+
+    def _restore(self, data):
+        """Marks the data of a failed write as not written."""
+        self._dirty = True
+
+    def _schedule_save(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (e.g. scripts), write right away
+            self._write(self._collect())
+            return
+        if self._save_handle is None and self._save_task is None:
+            self._save_handle = loop.call_later(self.save_delay, self._start_save, loop)
+
+    def _start_save(self, loop):
+        self._save_handle = None
+        self._save_task = loop.create_task(self._save(loop))
+
+    async def _save(self, loop):
+        try:
+            # Changes made while writing are picked up by the next round
+            while self._dirty:
+                data = self._collect()
+                await loop.run_in_executor(None, self._write, data)
+        except Exception as e:
+            self._restore(data)
+            print(f"Settings: Could not save {self.filepath}: {e}")
+        finally:
+            self._save_task = None
+
+    def _write(self, data):
+        with metrics.span("settings_save"):
+            write_json_atomic(self.filepath, data)
+            self._mtime = os.stat(self.filepath).st_mtime_ns
+
+    async def close(self):
+        """Writes pending changes, called on shutdown."""
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+        if self._save_task is not None:
+            await self._save_task
+        if self._dirty:
+            self._write(self._collect())
+
+class SharedUserSettingsStore(UserSettingsStore):
+    """User settings in the database shared by the workers, one row per user and key.
+
+    Only changed keys are written, so workers changing the settings of
+    different users at the same time keep each other's changes. The
+    settings are read again when another worker changed settings. The
+    settings file is imported once into an empty database.
+    """
+    def __init__(self, shared, filepath=USER_SETTINGS_FILE, save_delay=SAVE_DELAY):
+        self.shared = shared
+        self._version = None
+        super().__init__(filepath, save_delay)
+        # Format: {(user_id, key)}
+        self._dirty = set()
+
+    def load(self):
+        # Read first, a change made while reading the settings is picked up by the next refresh
+        version = self.shared.settings_version()
+        settings = self.shared.get_user_settings()
+        if not settings and self.filepath.exists():
+            super().load()
+            self.shared.set_user_settings(self.settings)
+            version = self.shared.settings_version()
+            settings = self.shared.get_user_settings()
+        self.settings = settings
+        self._version = version
+
+    def refresh(self):
+        now = time.monotonic()
+        if now - self._last_check < RELOAD_CHECK_INTERVAL:
+            return
+        self._last_check = now
+        if self._dirty or self._save_task is not None:
+            return
+        with metrics.span("settings_refresh"):
+            if self.shared.settings_version() != self._version:
+                self.load()
+                self._notify()
+
+    def set(self, user_id: str, key: str, value):
+        self.refresh()
+        self.settings.setdefault(user_id, {})[key] = value
+        self._dirty.add((user_id, key))
+        self._schedule_save()
+
+    def _collect(self):
+        changes = {}
+        for user_id, key in self._dirty:
+            changes.setdefault(user_id, {})[key] = self.settings[user_id][key]
+        self._dirty = set()
+        return changes
+
+    def _restore(self, data):
+        self._dirty.update((user_id, key) for user_id, values in data.items() for key in values)
+
+    def _write(self, data):
+        with metrics.span("settings_save"):
+            self.shared.set_user_settings(data)
+
+# One store per settings file, shared by all Settings instances
+# Format: {filepath: UserSettingsStore}
+_user_settings_stores = {}
+
+def get_user_settings_store(filepath=USER_SETTINGS_FILE):
+    if filepath not in _user_settings_stores:
+        if shared_state is not None:
+            _user_settings_stores[filepath] = SharedUserSettingsStore(shared_state, filepath)
+        else:
+            _user_settings_stores[filepath] = UserSettingsStore(filepath)
+    return _user_settings_stores[filepath]
 
 class Settings:
     def __init__(self):
         # Load user languages from file
         # Format: {user_id: {lang_code: lang_code, temp_unit: unit}}
-        self.user_settings = self._load_user_settings()
-        # Load translations from file
-        # Format: {lang_code: {key: translation}}
-        self.translations = self._load_translations()
-
-    def _load_user_settings(self, filepath=USER_SETTINGS_FILE):
-        if filepath.exists():
-            with filepath.open("r", encoding="utf-8") as file:
-                return json.load(file)
-        return {}
-    
-    def _load_translations(self, filepath=TRANSLATION_FILE):
-        if filepath.exists():
-            with filepath.open("r", encoding="utf-8") as file:
-                return json.load(file)
-        return {}
+        self.store = get_user_settings_store()
+        # Translations, compiled once and shared by all instances
+        self.localization = localization
+
+    @property
+    def user_settings(self):
+        return self.store.settings
 
     def refresh_user_settings(self):
-        self.user_settings = self._load_user_settings()
+        self.store.refresh()
+
+    def add_listener(self, listener):
+        """Calls listener() whenever the settings were read again, e.g. after another worker changed them."""
+        self.store.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.store.listeners:
+            self.store.listeners.remove(listener)
+
+    async def close(self):
+        await self.store.close()
 
-    def save_user_settings(self, settings, filepath=USER_SETTINGS_FILE):
-        with filepath.open("w", encoding="utf-8") as file:
-            json.dump(settings, file)
+    def get_user_setting(self, user_id: str, key: str, default=None):
+        return self.store.get(user_id, key, default)
+
+    def set_user_setting(self, user_id: str, key: str, value):
+        self.store.set(user_id, key, value)
 
     def set_user_language(self, user_id: str, lang_code: str):
-        self.refresh_user_settings()
-        if user_id not in self.user_settings:
-            self.user_settings[user_id] = {}
-        self.user_settings[user_id]['lang_code'] = lang_code
-        self.save_user_settings(self.user_settings)
+        self.store.set(user_id, 'lang_code', lang_code)
+        self._forget_locale(user_id)
 
     def get_user_language(self, user_id: str, default: str = "en") -> str:
-        self.refresh_user_settings()
-        return self.user_settings.get(user_id, {}).get('lang_code', default)
+        return self.store.get(user_id, 'lang_code', default)
 
     def set_user_temp_unit(self, user_id: str, unit: str):
-        self.refresh_user_settings()
-        if user_id not in self.user_settings:
-            self.user_settings[user_id] = {}
-        self.user_settings[user_id]['temp_unit'] = unit
-        self.save_user_settings(self.user_settings)
+        self.store.set(user_id, 'temp_unit', unit)
+        self._forget_locale(user_id)
 
     def get_user_temp_unit(self, user_id: str, default: str = "C") -> str:
-        self.refresh_user_settings()
-        return self.user_settings.get(user_id, {}).get('temp_unit', default)
-
-    def get_translation(self, lang_code: str, key: str, default: str = 'Translation file missing!', **kwargs) -> str:
-        message = self.translations.get(lang_code, {}).get(key, default)
-        if kwargs:
-            # Only format if there are placeholders to replace.
-            try:
-                return message.format(**kwargs)
-            except (KeyError, IndexError):
-                return f"⚠️ Missing placeholder in translation: {message}"
-        else:
-            return message
+        return self.store.get(user_id, 'temp_unit', default)
 
+    def get_locale(self, user_id) -> UserLocale:
+        """Language and unit of the user, the ones resolved for the current update if it is from this user."""
+        user_id = str(user_id)
+        locale = current_locale.get()
+        if locale is not None and locale.user_id == user_id:
+            return locale
+        self.store.refresh()
+        values = self.store.settings.get(user_id, {})
+        language = values.get('lang_code', "en")
+        return UserLocale(user_id, language, values.get('temp_unit', "C"), self.localization.catalog(language))
 
+    def _forget_locale(self, user_id: str):
+        locale = current_locale.get()
+        if locale is not None and locale.user_id == user_id:
+            current_locale.set(None)
 
+    def get_translation(self, lang_code: str, key: str, default: str = MISSING_TRANSLATION, **kwargs) -> str:
+        return self.localization.catalog(lang_code).translate(key, default, **kwargs)
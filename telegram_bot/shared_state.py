@@ -0,0 +1,137 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import workers
+
+script_dir = Path(__file__).parent
+SHARED_STATE_FILE = Path(os.environ.get("SHARED_STATE_FILE", script_dir / "shared_state.db"))
+# Seconds a worker waits for another one holding the write lock
+BUSY_TIMEOUT = 5
+
+class SharedState:
+    """User settings, sensor readings and LLM classifications shared by the worker processes.
+
+    Every process opens its own connection to one SQLite database in WAL
+    mode, so readers never wait for the writer. Writes are upserts of single
+    rows: workers only change the settings of their own users, and a sensor
+    reading only replaces an older one.
+
+    Writers of other workers can hold the database for up to BUSY_TIMEOUT,
+    so the bot runs the queries with submit() or run() in the thread of the
+    shared state, one at a time and in order, never on the event loop.
+    """
+    def __init__(self, filepath=SHARED_STATE_FILE):
+        self.filepath = filepath
+        self._db_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared_state")
+        self._db = sqlite3.connect(filepath, check_same_thread=False, timeout=BUSY_TIMEOUT)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # A crash may lose the last transactions but never corrupts the database
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS user_settings ("
+            "user_id TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (user_id, key))"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sensor_values ("
+            "device TEXT NOT NULL, resource TEXT NOT NULL, value REAL NOT NULL, ts REAL NOT NULL, ttl REAL, "
+            "PRIMARY KEY (device, resource))"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS action_cache ("
+            "prompt TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, action_data TEXT NOT NULL, ts REAL NOT NULL)"
+        )
+        # Counts the changes of a table, readers only reload it when its count changed
+        self._db.execute("CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+        self._db.commit()
+        self.stats = {
+            "reads": 0,
+            "writes": 0
+        }
+
+    def submit(self, function, *args, **kwargs):
+        """Calls function(*args, **kwargs) in the thread of the shared state, returns a concurrent.futures.Future."""
+        return self._executor.submit(function, *args, **kwargs)
+
+    async def run(self, function, *args, **kwargs):
+        """Awaits function(*args, **kwargs) called in the thread of the shared state."""
+        return await asyncio.wrap_future(self.submit(function, *args, **kwargs))
+
+    def _read(self, query, parameters=()):
+        with self._db_lock:
+            self.stats["reads"] += 1
+            return self._db.execute(query, parameters).fetchall()
+
+    def _write(self, query, parameters=()):
+        with self._db_lock, self._db:
+            self.stats["writes"] += 1
+            self._db.execute(query, parameters)
+
+    def settings_version(self):
+        """Changes whenever a worker changed user settings, unlike PRAGMA data_version not with every sensor reading."""
+        rows = self._read("SELECT version FROM versions WHERE name = 'user_settings'")
+        return rows[0][0] if rows else 0
+
+    def get_user_settings(self):
+        """Returns {user_id: {key: value}} of all users."""
+        settings = {}
+        for user_id, key, value in self._read("SELECT user_id, key, value FROM user_settings"):
+            settings.setdefault(user_id, {})[key] = json.loads(value)
+        return settings
+
+    def set_user_settings(self, user_settings):
+        """Stores {user_id: {key: value}}, keys that are not given stay as they are."""
+        rows = [(user_id, key, json.dumps(value)) for user_id, values in user_settings.items() for key, value in values.items()]
+        with self._db_lock, self._db:
+            self.stats["writes"] += 1
+            self._db.executemany("INSERT OR REPLACE INTO user_settings VALUES (?, ?, ?)", rows)
+            self._db.execute("INSERT INTO versions VALUES ('user_settings', 1) ON CONFLICT (name) DO UPDATE SET version = version + 1")
+
+    def get_sensor_value(self, device, resource):
+        """Returns (value, timestamp, ttl) of the newest reading any worker made, or None.
+
+        ttl is None if the reading is valid for the TTL of the resource.
+        """
+        rows = self._read("SELECT value, ts, ttl FROM sensor_values WHERE device = ? AND resource = ?", (device, resource))
+        return rows[0] if rows else None
+
+    def put_sensor_value(self, device, resource, value, timestamp, ttl=None):
+        self._write(
+            "INSERT INTO sensor_values VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (device, resource) DO UPDATE SET value = excluded.value, ts = excluded.ts, ttl = excluded.ttl "
+            "WHERE excluded.ts >= ts",
+            (device, resource, value, timestamp, ttl)
+        )
+
+    def get_action(self, prompt, fingerprint):
+        """Returns (action data, timestamp) of the classification of the normalized prompt, or None."""
+        rows = self._read("SELECT action_data, ts FROM action_cache WHERE prompt = ? AND fingerprint = ?", (prompt, fingerprint))
+        return (json.loads(rows[0][0]), rows[0][1]) if rows else None
+
+    def put_action(self, prompt, fingerprint, action_data, timestamp, expired=None):
+        """Stores the classification and drops those older than the expired timestamp."""
+        with self._db_lock, self._db:
+            self.stats["writes"] += 1
+            self._db.execute("INSERT OR REPLACE INTO action_cache VALUES (?, ?, ?, ?)", (prompt, fingerprint, json.dumps(action_data), timestamp))
+            if expired is not None:
+                self._db.execute("DELETE FROM action_cache WHERE ts < ?", (expired,))
+
+    def drop_actions(self, fingerprint):
+        """Drops the classifications made with another model or system prompt."""
+        self._write("DELETE FROM action_cache WHERE fingerprint != ?", (fingerprint,))
+
+    def get_stats(self):
+        return dict(self.stats)
+
+    def close(self):
+        # Writes still queued are finished first
+        self._executor.shutdown(wait=True)
+        with self._db_lock:
+            self._db.close()
+
+# State shared with the other workers, None if the bot runs in one process
+shared_state = SharedState() if workers.BOT_WORKERS > 1 else None
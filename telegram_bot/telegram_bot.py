@@ -1,85 +1,121 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler, ContextTypes
 from prompt_processor import Prompt_Processor
+from llm_scheduler import SchedulerBusy, LLM_TIMEOUT
 import asyncio
-import os
 import json
+import os
+import time
 from datetime import datetime, timedelta
 from functools import wraps
 from settings_handler import Settings
+from localization import localization, current_locale
+from client import coap, DEVICE_ERRORS
+from sensor_cache import sensor_cache
+from observer import sensor_observer
+from session_store import SessionStore
+from sensor_history import SensorHistory, HISTORY_RESOURCES
+from device_registry import device_registry
+from metrics import metrics, METRICS_PORT
+from resource_discovery import resource_discovery
+from alerts import alert_engine, parse_rule, ALERT_MAX_RULES
+from reports import report_scheduler, parse_schedule, REPORT_MAX_SUBSCRIPTIONS
+from send_queue import send_queue, BROADCAST
+from prefetch import prefetcher, TEMPERATURE_RESOURCES
+from webhook import TimedApplication, run_webhook, update_latency, BOT_MODE, BOT_CONCURRENT_UPDATES
+from workers import is_primary, run_dispatcher, BOT_WORKERS, BOT_WORKER_INDEX
+from shared_state import shared_state
 
-# Files to store user data
-AUTH_LOG_FILE = "authenticated_users.json"
 settings = Settings()
 
 # Configuration
+BOT_TOKEN = "YOUR_TOKEN"  # Replace with the token of your bot
 AUTH_PASSWORD = os.environ.get("BOT_AUTH_PASSWORD")  # Set this as environment variable
 SESSION_TIMEOUT = timedelta(hours=1)  # Session expires after 1 hour
 MAX_LOGIN_ATTEMPTS = 3
 LOCKOUT_TIME = timedelta(minutes=30)
-
-# Load authenticated users from file
-def load_authenticated_users():
-    if os.path.exists(AUTH_LOG_FILE):
-        try:
-            with open(AUTH_LOG_FILE, "r") as file:
-                data = json.load(file)
-                # Convert string dates back to datetime objects
-                for user_id, session in data.items():
-                    if "expires" in session:
-                        session["expires"] = datetime.fromisoformat(session["expires"])
-                    if "locked_until" in session:
-                        session["locked_until"] = datetime.fromisoformat(session["locked_until"])
-                return data
-        except (json.JSONDecodeError, ValueError):
-            return {}
-    return {}
-
-# Save authenticated users to file
-def save_authenticated_users():
-    with open(AUTH_LOG_FILE, "w") as file:
-        # Convert datetime objects to strings
-        data = {}
-        for user_id, session in authenticated_users.items():
-            session_data = {**session}
-            if "expires" in session:
-                session_data["expires"] = session["expires"].isoformat()
-            if "locked_until" in session:
-                session_data["locked_until"] = session["locked_until"].isoformat()
-            data[user_id] = session_data
-        json.dump(data, file)
-
-# Dictionary to store authenticated sessions
-# Format: {user_id: {"expires": datetime, "attempts": int}}
-authenticated_users = load_authenticated_users()
+# Comma separated Telegram user IDs allowed to use /stats
+BOT_ADMIN_IDS = {user_id.strip() for user_id in os.environ.get("BOT_ADMIN_IDS", "").split(",") if user_id.strip()}
+
+# Authenticated sessions, login attempts and lockouts
+# Format: {user_id: {"expires": datetime, "attempts": int, "locked_until": datetime}}
+sessions = None
+
+# Recorded sensor readings for /history
+history = None
+
+def create_stores():
+    """Opens the session and history databases of this process.
+
+    Not done on import: a spawned worker imports this script a second time
+    as __mp_main__, which would open them twice.
+    """
+    global sessions, history
+    if sessions is None:
+        # Workers read the sessions again when another worker changed them
+        sessions = SessionStore(session_timeout=SESSION_TIMEOUT, shared=BOT_WORKERS > 1, import_legacy=BOT_WORKERS == 1)
+        history = SensorHistory()
+
+# Longest text Telegram accepts in one message
+MAX_MESSAGE_LENGTH = 4096
+
+def split_message(text, limit=MAX_MESSAGE_LENGTH):
+    """Splits a long text at line breaks into messages Telegram accepts."""
+    chunks = []
+    current = ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        chunks.append(current)
+    return chunks
+
+class BotContext(CallbackContext):
+    """Callback context resolving the language and unit of the user once per update."""
+    @classmethod
+    def from_update(cls, update, application):
+        # Without concurrent updates one task handles them all, the locale of the previous update must not be reused
+        current_locale.set(None)
+        context = super().from_update(update, application)
+        context.refresh_locale()
+        return context
+
+    def refresh_locale(self):
+        """Resolves the locale again, after the user changed the language or unit."""
+        self._locale = settings.get_locale(self._user_id)
+        # The prompt processor and the other modules find it there for the rest of the update
+        current_locale.set(self._locale)
+
+    @property
+    def locale(self):
+        return self._locale
 
 def check_auth(func):
     """Decorator to check if user is authenticated"""
     @wraps(func)
     async def wrapped(update: Update, context: CallbackContext, *args, **kwargs):
         user_id = str(update.effective_user.id)
-
-        # Remove expired sessions
         now = datetime.now()
-        expired_users = [uid for uid, session in authenticated_users.items() if "expires" in session and session["expires"] <= now]
-        for uid in expired_users:
-            del authenticated_users[uid]
-        save_authenticated_users()
-
-        # Check if user is authenticated and session is valid
-        if user_id in authenticated_users:
-            session = authenticated_users[user_id]
-            if "expires" in session and session["expires"] > now:
+
+        with metrics.span("auth"):
+            # Check if user is authenticated and session is valid
+            authenticated = sessions.is_authenticated(user_id, now)
+            if authenticated:
                 # Update session expiry time
-                authenticated_users[user_id]["expires"] = now + SESSION_TIMEOUT
-                save_authenticated_users()
-                return await func(update, context, *args, **kwargs)
-            else:
+                sessions.touch(user_id, now)
+            elif "expires" in (sessions.get(user_id) or {}):
                 # Session expired
-                del authenticated_users[user_id]
-                save_authenticated_users()
+                sessions.delete(user_id)
+        if authenticated:
+            return await func(update, context, *args, **kwargs)
 
-        await update.message.reply_text(settings.get_translation(settings.get_user_language(str(context._user_id)),"not_authenticated"))
+        await update.message.reply_text(context.locale.translate("not_authenticated"))
         return None
     return wrapped
 
@@ -90,65 +126,60 @@ async def login(update: Update, context: CallbackContext) -> None:
     await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=update.message.message_id)
 
     # Check if user is already authenticated
-    if user_id in authenticated_users:
-        session = authenticated_users[user_id]
-        if "expires" in session and session["expires"] > datetime.now():
-            await update.message.reply_text(settings.get_translation(settings.get_user_language(str(context._user_id)),"already_authenticated"))
-            return
+    if sessions.is_authenticated(user_id):
+        await update.message.reply_text(context.locale.translate("already_authenticated"))
+        return
 
     # Check if user is locked out
-    if user_id in authenticated_users and authenticated_users[user_id].get("locked_until"):
-        if authenticated_users[user_id]["locked_until"] > datetime.now():
-            await update.message.reply_text(settings.get_translation(settings.get_user_language(str(context._user_id)),"locked_out"))
+    session = sessions.get(user_id)
+    if session is not None and session.get("locked_until"):
+        if session["locked_until"] > datetime.now():
+            await update.message.reply_text(context.locale.translate("locked_out"))
             return
         else:
             # Reset lockout
-            authenticated_users[user_id] = {"attempts": 0}
+            sessions.set(user_id, {"attempts": 0})
 
     # Get password from command
     if not context.args or len(context.args) != 1:
-        await update.message.reply_text(settings.get_translation(settings.get_user_language(str(context._user_id)),"login_explanation"))
+        await update.message.reply_text(context.locale.translate("login_explanation"))
         return
 
     password = context.args[0]
 
     # Check password
     if password == AUTH_PASSWORD:
-        authenticated_users[user_id] = {
-            "expires": datetime.now() + SESSION_TIMEOUT,
-            "attempts": 0
-        }
-        save_authenticated_users()
-        await update.message.reply_text(settings.get_translation(settings.get_user_language(str(context._user_id)),"login_success"))
+        sessions.login(user_id)
+        await update.message.reply_text(context.locale.translate("login_success"))
     else:
         # Handle failed attempt
-        if user_id not in authenticated_users:
-            authenticated_users[user_id] = {"attempts": 1}
+        session = sessions.get(user_id)
+        if session is None:
+            session = {"attempts": 1}
         else:
-            authenticated_users[user_id]["attempts"] += 1
+            session["attempts"] += 1
 
         # Check if max attempts reached
-        if authenticated_users[user_id]["attempts"] >= MAX_LOGIN_ATTEMPTS:
-            authenticated_users[user_id]["locked_until"] = datetime.now() + LOCKOUT_TIME
-            save_authenticated_users()
-            await update.message.reply_text(settings.get_translation(settings.get_user_language(str(context._user_id)),"locked_out"))
+        if session["attempts"] >= MAX_LOGIN_ATTEMPTS:
+            session["locked_until"] = datetime.now() + LOCKOUT_TIME
+            sessions.set(user_id, session)
+            await update.message.reply_text(context.locale.translate("locked_out"))
         else:
-            save_authenticated_users()
-            await update.message.reply_text(settings.get_translation(settings.get_user_language(str(context._user_id)),"login_failure"))
+            sessions.set(user_id, session)
+            await update.message.reply_text(context.locale.translate("login_failure"))
 
 async def logout(update: Update, context: CallbackContext) -> None:
     user_id = str(update.effective_user.id)
-    if user_id in authenticated_users:
-        del authenticated_users[user_id]
-        save_authenticated_users()
-        await update.message.reply_text(settings.get_translation(settings.get_user_language(str(context._user_id)),"logged_out"))
+    if sessions.get(user_id) is not None:
+        sessions.delete(user_id)
+        await update.message.reply_text(context.locale.translate("logged_out"))
     else:
-        await update.message.reply_text(settings.get_translation(settings.get_user_language(str(context._user_id)),"not_authenticated"))
+        await update.message.reply_text(context.locale.translate("not_authenticated"))
 
 # Function that gets called on the /start command
 @check_auth
 async def start(update: Update, context: CallbackContext) -> None:
-    await update.message.reply_text(settings.get_translation(settings.get_user_language(str(context._user_id)),"greeting"))
+    await update.message.reply_text(context.locale.translate("greeting"))
 
 # Function that gets called on the /help command
 @check_auth
@@ -157,35 +188,52 @@ async def help(update: Update, context: CallbackContext, processor: Prompt_Proce
 
 @check_auth
 async def temp(update: Update, context: CallbackContext, processor: Prompt_Processor, resource) -> None:
+    # An optional device name after the command, e.g. /humidity kitchen
+    device = " ".join(context.args) if context.args else None
     try:
-        response = await processor.get_sensor_value(user_id=context._user_id, resource=resource)
+        # A tap in the temperature chooser finds the reading already fetched
+        prefetched = prefetcher.take(update.effective_chat.id, context._user_id, resource) if update.callback_query else None
+        with metrics.span("sensor"):
+            if prefetched is not None:
+                response = await prefetched
+            else:
+                response = await processor.get_sensor_value(user_id=context._user_id, resource=resource, device=device)
         if "No suitable credentials" in response:
             if update.callback_query:
-                await update.callback_query.message.reply_text(settings.get_translation(settings.get_user_language(str(context._user_id)),"connection_failed"))
+                await update.callback_query.message.reply_text(context.locale.translate("connection_failed"))
             else:
-                await update.message.reply_text(settings.get_translation(settings.get_user_language(str(context._user_id)),"connection_failed"))
+                await update.message.reply_text(context.locale.translate("connection_failed"))
         elif response is not None:
-            if update.callback_query:
-                await update.callback_query.message.reply_text(response)
-            else:
-                await update.message.reply_text(response)
+            with metrics.span("reply"):
+                for chunk in split_message(response):
+                    if update.callback_query:
+                        await update.callback_query.message.reply_text(chunk)
+                    else:
+                        await update.message.reply_text(chunk)
         else:
             if update.callback_query:
-                await update.callback_query.message.reply_text(settings.get_translation(settings.get_user_language(str(context._user_id)),"no_data"))
+                await update.callback_query.message.reply_text(context.locale.translate("no_data"))
             else:
-                await update.message.reply_text(settings.get_translation(settings.get_user_language(str(context._user_id)),"no_data"))
+                await update.message.reply_text(context.locale.translate("no_data"))
     
+    except DEVICE_ERRORS as e:
+        # The device does not answer and there is no earlier reading
+        if update.callback_query:
+            await update.callback_query.message.reply_text(context.locale.translate("connection_failed"))
+        else:
+            await update.message.reply_text(context.locale.translate("connection_failed"))
+
     except ValueError as e:
         if update.callback_query:
-            await update.callback_query.message.reply_text(settings.get_translation(settings.get_user_language(str(context._user_id)),"network_error"))
+            await update.callback_query.message.reply_text(context.locale.translate("network_error"))
         else:
-            await update.message.reply_text(settings.get_translation(settings.get_user_language(str(context._user_id)),"network_error"))
+            await update.message.reply_text(context.locale.translate("network_error"))
 
     except Exception as e:
         if update.callback_query:
-            await update.callback_query.message.reply_text(settings.get_translation(settings.get_user_language(str(context._user_id)),"unknown_error", error=str(e)))
+            await update.callback_query.message.reply_text(context.locale.translate("unknown_error", error=str(e)))
         else:
-            await update.message.reply_text(settings.get_translation(settings.get_user_language(str(context._user_id)),"unknown_error", error=str(e)))
+            await update.message.reply_text(context.locale.translate("unknown_error", error=str(e)))
 
 # Function that gets called on the /internal_temp command
 @check_auth
@@ -202,6 +250,221 @@ async def external_temp(update: Update, context: CallbackContext, processor: Pro
 async def get_humidity(update: Update, context: CallbackContext, processor: Prompt_Processor) -> None:
     await temp(update, context, processor, "hum")
 
+# Names of the sensors accepted by the /history command
+history_resources = {
+    "internal_temp": "internal_temp",
+    "internal": "internal_temp",
+    "external_temp": "external_temp",
+    "external": "external_temp",
+    "humidity": "hum",
+    "hum": "hum"
+}
+
+# Function that gets called on the /history command
+@check_auth
+async def show_history(update: Update, context: CallbackContext, processor: Prompt_Processor) -> None:
+    user_id = str(context._user_id)
+    locale = context.locale
+    resources = HISTORY_RESOURCES
+    hours = 24
+    for arg in context.args or []:
+        if arg.lower() in history_resources:
+            resources = [history_resources[arg.lower()]]
+            continue
+        try:
+            hours = float(arg)
+            if hours <= 0:
+                raise ValueError
+        except ValueError:
+            await update.message.reply_text(locale.translate("history_usage"))
+            return
+
+    lines = []
+    for resource in resources:
+        result = await history.query(resource, time.time() - hours * 60 * 60)
+        sensor = locale.translate(resource)
+        if result is None:
+            lines.append(locale.translate("history_no_data", sensor=sensor, hours=f"{hours:g}"))
+        else:
+            lines.append(locale.translate("history_summary", sensor=sensor, hours=f"{hours:g}",
+                min=processor.format_sensor_value(user_id, resource, round(result["min"], 1)),
+                max=processor.format_sensor_value(user_id, resource, round(result["max"], 1)),
+                mean=processor.format_sensor_value(user_id, resource, round(result["mean"], 1)),
+                count=result["count"]))
+    await update.message.reply_text("\n".join(lines))
+
+# Function that gets called on the /devices command
+@check_auth
+async def list_devices(update: Update, context: CallbackContext) -> None:
+    user_id = str(context._user_id)
+    selected = settings.get_user_setting(user_id, "device")
+    lines = [context.locale.translate("devices_list_header")]
+    for i, device in enumerate(device_registry):
+        marker = "▶️ " if device.name == selected or (selected is None and i == 0) else "• "
+        lines.append(f"{marker}{device.friendly_name} ({device.name}): {', '.join(device.resources)}")
+    for chunk in split_message("\n".join(lines)):
+        await update.message.reply_text(chunk)
+
+# Function that gets called on the /device command
+@check_auth
+async def select_device(update: Update, context: CallbackContext) -> None:
+    user_id = str(context._user_id)
+    locale = context.locale
+    if not context.args:
+        await update.message.reply_text(locale.translate("device_usage"))
+        return
+    name = " ".join(context.args)
+    if name.lower() == "all":
+        settings.set_user_setting(user_id, "device", "all")
+        await update.message.reply_text(locale.translate("device_set", device="all"))
+        return
+    try:
+        device = device_registry.get(name)
+    except KeyError:
+        await update.message.reply_text(locale.translate("unknown_device", device=name))
+        return
+    settings.set_user_setting(user_id, "device", device.name)
+    await update.message.reply_text(locale.translate("device_set", device=device.friendly_name))
+
+# Function that gets called on the /all command
+@check_auth
+async def ask_all_devices(update: Update, context: CallbackContext, processor: Prompt_Processor) -> None:
+    user_id = str(context._user_id)
+    args = context.args or ["internal_temp"]
+    resource = history_resources.get(args[0].lower())
+    if resource is None or len(args) > 1:
+        await update.message.reply_text(context.locale.translate("all_usage"))
+        return
+    response = await processor.get_sensor_values(user_id, resource)
+    for chunk in split_message(response):
+        await update.message.reply_text(chunk)
+
+def convert_alert_threshold(user_id, rule):
+    """Alerts are stored in Celsius, users with Fahrenheit enter their thresholds in Fahrenheit."""
+    if "temp" in rule["resource"] and settings.get_locale(user_id).temp_unit.lower() == "f":
+        if rule["kind"] == "rate":
+            rule["threshold"] = rule["threshold"] * 5 / 9
+        else:
+            rule["threshold"] = (rule["threshold"] - 32) * 5 / 9
+    return rule
+
+# Function that gets called on the /alert command, e.g. /alert external < 3
+@check_auth
+async def add_alert(update: Update, context: CallbackContext, processor: Prompt_Processor) -> None:
+    user_id = str(context._user_id)
+    locale = context.locale
+    try:
+        rule = convert_alert_threshold(user_id, parse_rule(context.args or [], history_resources))
+    except ValueError:
+        await update.message.reply_text(locale.translate("alert_usage"))
+        return
+    device = processor.get_user_device(user_id)
+    try:
+        # Alerts of users asking all devices watch the default device
+        rule = alert_engine.add_rule(user_id, device=None if device == "all" else device, **rule)
+    except ValueError:
+        await update.message.reply_text(locale.translate("alert_limit", max=ALERT_MAX_RULES))
+        return
+    await update.message.reply_text(locale.translate("alert_added", id=rule.id, rule=alert_engine.describe(rule, locale.language)))
+
+# Function that gets called on the /alerts command
+@check_auth
+async def list_alerts(update: Update, context: CallbackContext) -> None:
+    user_id = str(context._user_id)
+    locale = context.locale
+    rules = alert_engine.get_rules(user_id)
+    if not rules:
+        await update.message.reply_text(locale.translate("no_alerts"))
+        return
+    lines = [locale.translate("alerts_header")]
+    for rule in rules:
+        marker = "🔔 " if rule.state == "firing" else ""
+        lines.append(f"{rule.id}. {marker}{alert_engine.describe(rule, locale.language)}")
+    for chunk in split_message("\n".join(lines)):
+        await update.message.reply_text(chunk)
+
+# Function that gets called on the /unalert command, e.g. /unalert 2 or /unalert all
+@check_auth
+async def remove_alert(update: Update, context: CallbackContext) -> None:
+    user_id = str(context._user_id)
+    locale = context.locale
+    args = context.args or []
+    if len(args) != 1 or not (args[0].isdigit() or args[0].lower() == "all"):
+        await update.message.reply_text(locale.translate("unalert_usage"))
+        return
+    if args[0].lower() == "all":
+        alert_engine.remove_rule(user_id)
+        await update.message.reply_text(locale.translate("alerts_removed"))
+    elif alert_engine.remove_rule(user_id, int(args[0])):
+        await update.message.reply_text(locale.translate("alert_removed", id=args[0]))
+    else:
+        await update.message.reply_text(locale.translate("alert_not_found", id=args[0]))
+
+# Function that gets called on the /report command, e.g. /report 7 or /report hourly
+@check_auth
+async def add_report(update: Update, context: CallbackContext, processor: Prompt_Processor) -> None:
+    user_id = str(context._user_id)
+    locale = context.locale
+    try:
+        schedule = parse_schedule(context.args or [])
+    except ValueError:
+        await update.message.reply_text(locale.translate("report_usage"))
+        return
+    device = processor.get_user_device(user_id)
+    try:
+        # Reports of users asking all devices show the default device
+        subscription = report_scheduler.subscribe(user_id, device=None if device == "all" else device, **schedule)
+    except ValueError:
+        await update.message.reply_text(locale.translate("report_limit", max=REPORT_MAX_SUBSCRIPTIONS))
+        return
+    await update.message.reply_text(locale.translate("report_added", id=subscription.id,
+        schedule=report_scheduler.describe(subscription, locale.language)))
+
+# Function that gets called on the /reports command
+@check_auth
+async def list_reports(update: Update, context: CallbackContext) -> None:
+    user_id = str(context._user_id)
+    locale = context.locale
+    subscriptions = report_scheduler.get_subscriptions(user_id)
+    if not subscriptions:
+        await update.message.reply_text(locale.translate("no_reports"))
+        return
+    lines = [locale.translate("reports_header")]
+    for subscription in subscriptions:
+        lines.append(f"{subscription.id}. {report_scheduler.describe(subscription, locale.language)}")
+    for chunk in split_message("\n".join(lines)):
+        await update.message.reply_text(chunk)
+
+# Function that gets called on the /unreport command, e.g. /unreport 2 or /unreport all
+@check_auth
+async def remove_report(update: Update, context: CallbackContext) -> None:
+    user_id = str(context._user_id)
+    locale = context.locale
+    args = context.args or []
+    if len(args) != 1 or not (args[0].isdigit() or args[0].lower() == "all"):
+        await update.message.reply_text(locale.translate("unreport_usage"))
+        return
+    if args[0].lower() == "all":
+        report_scheduler.unsubscribe(user_id)
+        await update.message.reply_text(locale.translate("reports_removed"))
+    elif report_scheduler.unsubscribe(user_id, int(args[0])):
+        await update.message.reply_text(locale.translate("report_removed", id=args[0]))
+    else:
+        await update.message.reply_text(locale.translate("report_not_found", id=args[0]))
+
+# Function that gets called on the /stats command, only for the users in BOT_ADMIN_IDS
+@check_auth
+async def stats(update: Update, context: CallbackContext) -> None:
+    user_id = str(context._user_id)
+    if user_id not in BOT_ADMIN_IDS:
+        await update.message.reply_text(context.locale.translate("admin_only"))
+        return
+    lines = [metrics.summary() or "No requests yet"]
+    for name, values in metrics.collect().items():
+        lines.append(f"{name}: " + ", ".join(f"{key}={value:g}" for key, value in values.items()))
+    for chunk in split_message("\n".join(lines)):
+        await update.message.reply_text(chunk)
+
 # Function for reacting on text messages
 @check_auth
 async def handle_message(update: Update, context: CallbackContext, processor: Prompt_Processor) -> None:
@@ -210,10 +473,10 @@ async def handle_message(update: Update, context: CallbackContext, processor: Pr
       try:
         await update.message.chat.send_action("typing")
         await asyncio.sleep(3)
-        await update.message.reply_text(settings.get_translation(settings.get_user_language(str(context._user_id)),"loading"))
+        await update.message.reply_text(context.locale.translate("loading"))
         await update.message.chat.send_action("typing")
         await asyncio.sleep(5)
-        await update.message.reply_text(settings.get_translation(settings.get_user_language(str(context._user_id)),"extended_loading"))
+        await update.message.reply_text(context.locale.translate("extended_loading"))
         while True:
             await update.message.chat.send_action("typing")
             await asyncio.sleep(5)  # send typing action every 5 seconds
@@ -223,14 +486,24 @@ async def handle_message(update: Update, context: CallbackContext, processor: Pr
     typing_task = asyncio.create_task(send_typing_action())
 
     try:
-      # Answer should be given within 15 seconds, otherwise -> error
-        action = await asyncio.wait_for(
-            processor.process(text_received),
-            timeout=25
-        )
-        response = await processor.process_action(action,user_id=context._user_id)
+      # Answer should be given within LLM_TIMEOUT seconds, otherwise -> error
+        with metrics.span("process"):
+            action = await asyncio.wait_for(
+                processor.process(text_received, user_id=context._user_id),
+                timeout=LLM_TIMEOUT
+            )
+        try:
+            with metrics.span("process_action"):
+                response = await processor.process_action(action,user_id=context._user_id)
+        except DEVICE_ERRORS:
+            # Not the LLM timeout below, the device does not answer
+            response = context.locale.translate("connection_failed")
+    except SchedulerBusy as e:
+        # Too many requests, answer right away instead of after the timeout
+        await update.message.reply_text(context.locale.translate(f"llm_{e.reason}"))
+        return
     except asyncio.TimeoutError:
-        await update.message.reply_text(settings.get_translation(settings.get_user_language(str(context._user_id)),"timeout_error"))
+        await update.message.reply_text(context.locale.translate("timeout_error"))
         await update.message.chat.send_sticker('CAACAgIAAxkBAAExH49nlOhu-7i3UqCcXRmVkKTsGxBNFgAC8wADVp29Cmob68TH-pb-NgQ')
         return
     finally:
@@ -243,18 +516,23 @@ async def handle_message(update: Update, context: CallbackContext, processor: Pr
     if response == "choose_temperature_sensor":
         await choose_temperature_sensor(update, context, processor)
     else:
-        await update.message.reply_text(response)
+        with metrics.span("reply"):
+            for chunk in split_message(str(response)):
+                await update.message.reply_text(chunk)
 
 
 # Function that gets called on the /temp command
 @check_auth
 async def choose_temperature_sensor(update: Update, context: CallbackContext, processor: Prompt_Processor) -> None:
     keyboard = [
-        [InlineKeyboardButton(settings.get_translation(settings.get_user_language(str(context._user_id)),"external_temp"), callback_data='temp_external' )],
-        [InlineKeyboardButton(settings.get_translation(settings.get_user_language(str(context._user_id)),"internal_temp"), callback_data='temp_internal')],
+        [InlineKeyboardButton(context.locale.translate("external_temp"), callback_data='temp_external' )],
+        [InlineKeyboardButton(context.locale.translate("internal_temp"), callback_data='temp_internal')],
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(settings.get_translation(settings.get_user_language(str(context._user_id)),"choose_temperature_sensor"), reply_markup=reply_markup)
+    # Read both sensors while the user decides, the tap then answers at once
+    prefetcher.start(update.effective_chat.id, context._user_id, TEMPERATURE_RESOURCES,
+                     lambda resource: processor.get_sensor_value(user_id=context._user_id, resource=resource))
+    await update.message.reply_text(context.locale.translate("choose_temperature_sensor"), reply_markup=reply_markup)
 
 # Function that gets called on the /lang command
 @check_auth
@@ -264,7 +542,7 @@ async def language(update: Update, context: CallbackContext) -> None:
         [InlineKeyboardButton("🇩🇪 Deutsch", callback_data='lang_de')],
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(settings.get_translation(settings.get_user_language(str(context._user_id)),"choose_language"), reply_markup=reply_markup)
+    await update.message.reply_text(context.locale.translate("choose_language"), reply_markup=reply_markup)
 
 @check_auth
 async def tempunit(update: Update, context: CallbackContext) -> None:
@@ -273,7 +551,7 @@ async def tempunit(update: Update, context: CallbackContext) -> None:
         [InlineKeyboardButton("°F", callback_data='tempunit_f')],
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(settings.get_translation(settings.get_user_language(str(context._user_id)), "choose_temp_unit"), reply_markup=reply_markup)
+    await update.message.reply_text(context.locale.translate("choose_temp_unit"), reply_markup=reply_markup)
 
 langs = {
     "en": "English",
@@ -296,26 +574,110 @@ async def button(update: Update, context: CallbackContext, processor: Prompt_Pro
         language = langs.get(lang_code, "English")
         # Set the user's language preference using your language handler
         settings.set_user_language(user_id, lang_code)
-        await query.edit_message_text(text=settings.get_translation(settings.get_user_language(user_id), "language_set", language=language))
+        context.refresh_locale()
+        await query.edit_message_text(text=context.locale.translate("language_set", language=language))
     elif data[0] == "tempunit":
         # For temperature unit selection:
         tempunit = data[1].lower()  # Expecting 'C' or 'F'
         temp = tempunits.get(tempunit, "°C")
         settings.set_user_temp_unit(user_id, tempunit)
+        context.refresh_locale()
         # Confirm the selection with the user (the translation can include a placeholder for the unit)
-        await query.edit_message_text(text=settings.get_translation(settings.get_user_language(user_id), "tempunit_set", unit=temp))
+        await query.edit_message_text(text=context.locale.translate("tempunit_set", unit=temp))
     elif data[0] == "temp":
         if data[1] == "internal":
-            await query.edit_message_text(text=settings.get_translation(settings.get_user_language(user_id), "internal_temp_requested"))
+            await query.edit_message_text(text=context.locale.translate("internal_temp_requested"))
             await internal_temp(update, context, processor)
         elif data[1] == "external":
-            await query.edit_message_text(text=settings.get_translation(settings.get_user_language(user_id), "external_temp_requested"))
+            await query.edit_message_text(text=context.locale.translate("external_temp_requested"))
             await external_temp(update, context, processor)
 
-def main() -> None:
-    processor = Prompt_Processor()
-
-    application = Application.builder().token("YOUR_TOKEN").build()
+# Called once before the bot starts polling
+async def startup(application: Application) -> None:
+    # Expire and persist sessions in the background
+    sessions.start()
+    # Load the LLM before the first question arrives
+    await application.bot_data["processor"].start()
+    # With several workers the first one reads the devices for all of them
+    if is_primary():
+        # Keep the latest sensor values in memory via CoAP Observe
+        sensor_observer.start()
+        # Record the sensor readings for /history
+        history.start()
+    # Turn new sensors of the firmware into actions
+    resource_discovery.start()
+    # Push notifications for the alerts of the users
+    async def send_alert(user_id, text):
+        for chunk in split_message(text):
+            await application.bot.send_message(chat_id=int(user_id), text=chunk)
+    alert_engine.start(send_alert, application.bot_data["processor"].format_sensor_value)
+    # Scheduled reports, paced by the send queue behind the replies
+    async def send_report(user_id, text):
+        for chunk in split_message(text):
+            await application.bot.send_message(chat_id=int(user_id), text=chunk, rate_limit_args=BROADCAST)
+    report_scheduler.start(send_report, application.bot_data["processor"].format_sensor_value)
+    # Stats of the components next to the stage latencies on /metrics and /stats
+    processor = application.bot_data["processor"]
+    metrics.add_collector("coap", coap.get_metrics)
+    for name in device_registry.devices:
+        metrics.add_collector(f"device_{name}", lambda name=name: coap.health.get(name).get_stats())
+    metrics.add_collector("sensor_cache", sensor_cache.get_stats)
+    metrics.add_collector("observer", sensor_observer.get_stats)
+    metrics.add_collector("discovery", resource_discovery.get_stats)
+    metrics.add_collector("alerts", alert_engine.get_stats)
+    metrics.add_collector("reports", report_scheduler.get_stats)
+    metrics.add_collector("send_queue", send_queue.get_stats)
+    metrics.add_collector("prefetch", prefetcher.get_stats)
+    metrics.add_collector("localization", localization.get_stats)
+    metrics.add_collector("llm_scheduler", processor.scheduler.get_stats)
+    metrics.add_collector("action_cache", processor.action_cache.get_stats)
+    metrics.add_collector("updates", update_latency.get_stats)
+    if shared_state is not None:
+        metrics.add_collector("shared_state", shared_state.get_stats)
+    # Every worker has its own metrics endpoint
+    await metrics.start_server(port=METRICS_PORT + BOT_WORKER_INDEX if METRICS_PORT else 0)
+
+# Called once after the bot has stopped
+async def shutdown(application: Application) -> None:
+    await metrics.stop_server()
+    await alert_engine.stop()
+    await report_scheduler.stop()
+    await history.close()
+    await resource_discovery.stop()
+    await sensor_observer.stop()
+    await application.bot_data["processor"].close()
+    print(f"Action cache stats: {application.bot_data['processor'].action_cache.get_stats()}")
+    print(f"LLM stats: {application.bot_data['processor'].get_llm_stats()}")
+    print(f"LLM scheduler stats: {application.bot_data['processor'].scheduler.get_stats()}")
+    await settings.close()
+    await sessions.close()
+    print(f"Observer stats: {sensor_observer.get_stats()}")
+    print(f"CoAP client metrics: {coap.get_metrics()}")
+    print(f"Sensor cache stats: {sensor_cache.get_stats()}")
+    print(f"Update latency: {update_latency.get_stats()}")
+    if shared_state is not None:
+        shared_state.close()
+    await coap.shutdown()
+
+def build_application(processor: Prompt_Processor, token: str, polling: bool = True, request=None, rate_limiter=send_queue) -> Application:
+    """Creates the application with all handlers, request replaces the HTTP client talking to Telegram.
+
+    Every message the bot sends goes through the rate limiter.
+    """
+    create_stores()
+    builder = (Application.builder().token(token)
+               .application_class(TimedApplication)
+               .context_types(ContextTypes(context=BotContext))
+               .rate_limiter(rate_limiter)
+               .post_init(startup)
+               .post_shutdown(shutdown))
+    if not polling:
+        # Updates arrive through our own HTTP endpoint, polling keeps handling them one after another in order
+        builder = builder.updater(None).concurrent_updates(BOT_CONCURRENT_UPDATES)
+    if request is not None:
+        builder = builder.request(request)
+    application = builder.build()
+    application.bot_data["processor"] = processor
 
     # authentication handlers
     application.add_handler(CommandHandler("login", login))
@@ -330,15 +692,59 @@ def main() -> None:
     application.add_handler(CommandHandler("internal_temp", lambda update, context: internal_temp(update, context, processor)))
     application.add_handler(CommandHandler("external_temp", lambda update, context: external_temp(update, context, processor)))
     application.add_handler(CommandHandler("humidity", lambda update, context: get_humidity(update, context, processor)))
+    application.add_handler(CommandHandler("history", lambda update, context: show_history(update, context, processor)))
+    application.add_handler(CommandHandler("devices", list_devices))
+    application.add_handler(CommandHandler("device", select_device))
+    application.add_handler(CommandHandler("all", lambda update, context: ask_all_devices(update, context, processor)))
+    application.add_handler(CommandHandler("alert", lambda update, context: add_alert(update, context, processor)))
+    application.add_handler(CommandHandler("alerts", list_alerts))
+    application.add_handler(CommandHandler("unalert", remove_alert))
+    application.add_handler(CommandHandler("report", lambda update, context: add_report(update, context, processor)))
+    application.add_handler(CommandHandler("reports", list_reports))
+    application.add_handler(CommandHandler("unreport", remove_report))
+    application.add_handler(CommandHandler("stats", stats))
 
     # Callback query handler for button presses (handles both language and temperature unit)
     application.add_handler(CallbackQueryHandler(lambda update, context: button(update, context, processor)))
 
     # Text message handlers
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, lambda update, context: handle_message(update, context, processor)))
+    return application
+
+async def run_worker(updates) -> None:
+    """Runs the bot of one worker, fed with the updates the dispatcher puts into the queue until it puts None."""
+    processor = Prompt_Processor()
+    application = build_application(processor, BOT_TOKEN, polling=False)
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    loop = asyncio.get_running_loop()
+    print(f"Worker {BOT_WORKER_INDEX}: Ready")
+    try:
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(json.loads(data), application.bot))
+    finally:
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        await application.post_shutdown(application)
+
+def main() -> None:
+    if BOT_WORKERS > 1:
+        # Every worker builds its own application in its own process
+        asyncio.run(run_dispatcher(BOT_TOKEN, BOT_MODE))
+        return
+    processor = Prompt_Processor()
+    application = build_application(processor, BOT_TOKEN, polling=BOT_MODE != "webhook")
 
     # Start the bot
-    application.run_polling()
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
     main()
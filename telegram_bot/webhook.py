@@ -0,0 +1,147 @@
+import asyncio
+import hmac
+import json
+import os
+import signal
+import sys
+import time
+import urllib.request
+from collections import deque
+from telegram import Update
+from telegram.ext import Application
+from http_server import HttpServer
+from metrics import metrics
+
+# "polling" or "webhook"
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+# Address and port the webhook endpoint listens on
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+# Public base URL registered at Telegram, e.g. https://bot.example.org (behind a reverse proxy).
+# If unset the webhook is not registered, which is what local testing needs.
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+# Telegram sends it in the X-Telegram-Bot-Api-Secret-Token header of every update
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+# Number of updates processed at the same time
+BOT_CONCURRENT_UPDATES = int(os.environ.get("BOT_CONCURRENT_UPDATES", 16))
+
+class UpdateLatency:
+    """Seconds from receiving an update until all its handlers (and so the reply) are done."""
+    def __init__(self, size=1000):
+        self.mode = BOT_MODE
+        self.samples = deque(maxlen=size)
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+
+    def get_stats(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return {"mode": self.mode, "updates": 0}
+        return {
+            "mode": self.mode,
+            "updates": len(samples),
+            "p50": samples[int(len(samples) * 0.5)],
+            "p95": samples[int(len(samples) * 0.95)],
+            "p99": samples[int(len(samples) * 0.99)]
+        }
+
+update_latency = UpdateLatency()
+# Arrival times of the updates received by the webhook, in the order they arrived
+# Format: {update_id: perf_counter}
+_arrivals = {}
+# Seconds after which the arrival of an update that was never processed is forgotten
+ARRIVAL_TIMEOUT = 300
+
+def _record_arrival(update_id):
+    now = time.perf_counter()
+    # Updates dropped before processing (e.g. on shutdown) would stay forever
+    while _arrivals:
+        oldest = next(iter(_arrivals))
+        if now - _arrivals[oldest] < ARRIVAL_TIMEOUT:
+            break
+        del _arrivals[oldest]
+    _arrivals[update_id] = now
+
+class TimedApplication(Application):
+    """Application recording the update-to-reply latency of every update.
+
+    Webhook updates are timed from their arrival at the HTTP endpoint,
+    polled updates from the moment they are handed to the handlers.
+    """
+    async def process_update(self, update):
+        start = _arrivals.pop(getattr(update, "update_id", None), None) or time.perf_counter()
+        try:
+            await super().process_update(update)
+        finally:
+            elapsed = time.perf_counter() - start
+            update_latency.record(elapsed)
+            metrics.observe("update", elapsed)
+
+async def run_webhook(application, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, path=WEBHOOK_PATH, url=WEBHOOK_URL, secret=WEBHOOK_SECRET):
+    """Runs the bot with an embedded HTTP endpoint receiving the updates, until SIGINT or SIGTERM.
+
+    The application has to be built without updater (builder.updater(None)).
+    """
+    if not secret:
+        raise ValueError("Webhook: Environment variable WEBHOOK_SECRET is not set")
+
+    async def receive_update(request):
+        token = request.headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(token.encode("utf-8"), secret.encode("utf-8")):
+            return 403, b"", "text/plain"
+        try:
+            update = Update.de_json(json.loads(request.body), application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            print(f"Webhook: Invalid update: {e}")
+            return 400, b"", "text/plain"
+        if update is None:
+            return 400, b"", "text/plain"
+        _record_arrival(update.update_id)
+        await application.update_queue.put(update)
+        return 200, b"", "text/plain"
+
+    server = HttpServer(listen, port)
+    server.route("POST", path, receive_update)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    update_latency.mode = "webhook"
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    try:
+        if url:
+            await application.bot.set_webhook(url=url.rstrip("/") + path, secret_token=secret, allowed_updates=Update.ALL_TYPES)
+        await server.start()
+        await stop.wait()
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+def post_updates(filepaths, url=None, secret=WEBHOOK_SECRET):
+    """Posts recorded update JSON files to the local webhook endpoint."""
+    url = url or f"http://{WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}"
+    for filepath in filepaths:
+        with open(filepath, "rb") as file:
+            body = file.read()
+        request = urllib.request.Request(url, data=body, method="POST", headers={
+            "Content-Type": "application/json",
+            "X-Telegram-Bot-Api-Secret-Token": secret or ""
+        })
+        start = time.perf_counter()
+        with urllib.request.urlopen(request) as response:
+            print(f"{filepath}: HTTP {response.status} in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+if __name__ == '__main__':
+    # Usage: python3 webhook.py <update.json> [<update.json> ...]
+    post_updates(sys.argv[1:])
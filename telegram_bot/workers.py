@@ -0,0 +1,201 @@
+import asyncio
+import hmac
+import json
+import multiprocessing
+import os
+import signal
+import sys
+from http_server import HttpServer
+from session_store import import_legacy_sessions
+
+# Number of bot processes, 1 runs the bot in this process without dispatcher
+BOT_WORKERS = int(os.environ.get("BOT_WORKERS", 1))
+# Index of this process among the workers, set by the dispatcher for every worker it starts
+BOT_WORKER_INDEX = int(os.environ.get("BOT_WORKER_INDEX", 0))
+# Updates waiting for a worker before the dispatcher stops taking new ones
+WORKER_QUEUE_SIZE = 1000
+# Seconds getUpdates waits for new updates
+POLL_TIMEOUT = 30
+
+def shard(chat_id, workers=None):
+    """Index of the worker that handles the chat."""
+    return int(chat_id) % (workers or BOT_WORKERS)
+
+def owns(user_id):
+    """True if this process runs the alerts and reports of the user.
+
+    That is the worker of the private chat with the user, whose chat ID is
+    the user ID. Commands of the user in groups may reach other workers,
+    which share the sessions and settings through the database.
+    """
+    return BOT_WORKERS == 1 or shard(user_id) == BOT_WORKER_INDEX
+
+def is_primary():
+    """The first worker observes and records the sensors for all workers."""
+    return BOT_WORKER_INDEX == 0
+
+def update_chat_id(data):
+    """Chat ID of an update as sent by Telegram.
+
+    Updates without chat (e.g. inline queries) go by the user ID, updates
+    with neither are 0.
+    """
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if key in data:
+            return data[key]["chat"]["id"]
+    if "callback_query" in data:
+        query = data["callback_query"]
+        return query.get("message", {}).get("chat", {}).get("id", query["from"]["id"])
+    for value in data.values():
+        if isinstance(value, dict):
+            if "chat" in value:
+                return value["chat"]["id"]
+            if "from" in value:
+                return value["from"]["id"]
+    return 0
+
+def _run_worker(updates):
+    """Entry point of a worker process: the whole bot, fed with the updates of its shard.
+
+    The worker index and count are in the environment the process was
+    started with, the modules read them on import. That includes the launch
+    script, which a spawned process imports again as __mp_main__ before
+    this runs.
+    """
+    # The dispatcher stops the workers through their queues
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    from telegram_bot import run_worker
+    asyncio.run(run_worker(updates))
+
+class Dispatcher:
+    """Receives the updates and shards them by chat ID across worker processes.
+
+    The updates of a chat are handled by one worker in the order they came
+    in. Every worker runs the complete bot for its chats and answers
+    Telegram itself. State shared by all workers (sessions, user settings, sensor
+    readings and LLM classifications) lives in SQLite databases in WAL mode.
+    """
+    def __init__(self, workers=None):
+        self.workers = workers or BOT_WORKERS
+        self.processes = []
+        self.queues = []
+        self.stats = {
+            "dispatched": [0] * self.workers
+        }
+
+    def start(self):
+        # Workers must not inherit the event loop and sockets of the dispatcher
+        context = multiprocessing.get_context("spawn")
+        environment = {key: os.environ.get(key) for key in ("BOT_WORKERS", "BOT_WORKER_INDEX")}
+        try:
+            for index in range(self.workers):
+                # A spawned process starts with a copy of the environment
+                os.environ["BOT_WORKERS"] = str(self.workers)
+                os.environ["BOT_WORKER_INDEX"] = str(index)
+                queue = context.Queue(WORKER_QUEUE_SIZE)
+                process = context.Process(target=_run_worker, args=(queue,), name=f"bot-worker-{index}")
+                process.start()
+                self.queues.append(queue)
+                self.processes.append(process)
+        finally:
+            for key, value in environment.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+        print(f"Dispatcher: Started {self.workers} workers")
+
+    async def dispatch(self, data):
+        """Hands the update (a dict as sent by Telegram) to the worker of its chat."""
+        index = shard(update_chat_id(data), self.workers)
+        self.stats["dispatched"][index] += 1
+        # Blocks only if the worker is far behind
+        await asyncio.get_running_loop().run_in_executor(None, self.queues[index].put, json.dumps(data))
+
+    def stop(self):
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+        print(f"Dispatcher: Updates per worker {self.stats['dispatched']}")
+
+    async def run_polling(self, bot, stop):
+        """Fetches the updates with getUpdates until stop is set."""
+        offset = None
+        await bot.initialize()
+        await bot.delete_webhook()
+        try:
+            while not stop.is_set():
+                try:
+                    updates = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT)
+                except Exception as e:
+                    print(f"Dispatcher: Could not get updates: {e}")
+                    await asyncio.sleep(1)
+                    continue
+                for update in updates:
+                    offset = update.update_id + 1
+                    await self.dispatch(update.to_dict())
+        finally:
+            await bot.shutdown()
+
+    async def run_webhook(self, server, path, secret, stop):
+        """Receives the updates at the webhook endpoint until stop is set."""
+        async def receive_update(request):
+            token = request.headers.get("x-telegram-bot-api-secret-token", "")
+            if not hmac.compare_digest(token.encode("utf-8"), secret.encode("utf-8")):
+                return 403, b"", "text/plain"
+            try:
+                data = json.loads(request.body)
+            except ValueError as e:
+                print(f"Dispatcher: Invalid update: {e}")
+                return 400, b"", "text/plain"
+            if not isinstance(data, dict) or "update_id" not in data:
+                return 400, b"", "text/plain"
+            await self.dispatch(data)
+            return 200, b"", "text/plain"
+
+        server.route("POST", path, receive_update)
+        await server.start()
+        try:
+            await stop.wait()
+        finally:
+            await server.stop()
+
+async def run_dispatcher(token, mode, workers=None):
+    """Runs the dispatcher with its workers until SIGINT or SIGTERM."""
+    from telegram import Bot
+    from webhook import WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_SECRET
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    # Before the workers start, every one of them would import all sessions otherwise
+    import_legacy_sessions()
+    dispatcher = Dispatcher(workers)
+    dispatcher.start()
+    try:
+        if mode == "webhook":
+            if not WEBHOOK_SECRET:
+                raise ValueError("Webhook: Environment variable WEBHOOK_SECRET is not set")
+            if WEBHOOK_URL:
+                async with Bot(token) as bot:
+                    await bot.set_webhook(url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+            await dispatcher.run_webhook(HttpServer(WEBHOOK_LISTEN, WEBHOOK_PORT), WEBHOOK_PATH, WEBHOOK_SECRET, stop)
+        else:
+            poller = asyncio.create_task(dispatcher.run_polling(Bot(token), stop))
+            await stop.wait()
+            poller.cancel()
+            await asyncio.gather(poller, return_exceptions=True)
+    finally:
+        await loop.run_in_executor(None, dispatcher.stop)
+
+if __name__ == '__main__':
+    # Usage: python3 workers.py <update.json>, prints the worker the update goes to
+    with open(sys.argv[1], "r", encoding="utf-8") as file:
+        data = json.load(file)
+    print(f"Chat {update_chat_id(data)} -> worker {shard(update_chat_id(data))} of {BOT_WORKERS}")